@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import logging
+import random
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from cell_matching import CELL_MATCHERS, MATCHING_CELL_THRESHOLD, CellMatcher, levenshtein_score, make_cell_matcher
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+WORDS = ['df', 'x', 'y', 'model', 'fit', 'predict', 'np', 'pd', 'plt', 'train', 'test', 'mean', 'std', 'col', 'data']
+
+
+def make_counter():
+    current = 0
+
+    def _counter():
+        nonlocal current
+        current += 1
+        return current - 1
+    return _counter
+
+
+def format_for_matching(idx, source):
+    # roughly what replay-session.py hands to the matcher: cell header + source, indented
+    return '\n'.join('    ' + line for line in f'# + Cell {idx + 1}\n{source}'.strip().split('\n'))
+
+
+class BruteForceCellMatcher(CellMatcher):
+    # scores every variant seen so far; what the shingle matcher should answer, only slower.
+    # Ties go to the variant sharing more q-grams, then the earliest seen.
+    def __init__(self, new_cell_id, threshold=MATCHING_CELL_THRESHOLD, gram_size=3):
+        super().__init__(new_cell_id, threshold=threshold)
+        self.gram_size = gram_size
+        self.cell_id_by_variant = {}
+
+    def _grams(self, value):
+        return collections.Counter(value[i:i + self.gram_size] for i in range(len(value) - self.gram_size + 1))
+
+    def get_cell_id(self, source):
+        lvalue = source.lower()
+        cell_id = self.cell_id_by_variant.get(lvalue)
+        if cell_id is not None:
+            return cell_id
+        grams = self._grams(lvalue)
+        best = (-1., -1, 0, None)
+        for order, variant in enumerate(self.cell_id_by_variant.keys()):
+            score = levenshtein_score(lvalue, variant)
+            if score < max(self.threshold, best[0]):
+                continue
+            num_shared = sum((grams & self._grams(variant)).values())
+            best = max(best, (score, num_shared, -order, variant))
+        if best[0] >= self.threshold:
+            cell_id = self.cell_id_by_variant[best[3]]
+        else:
+            cell_id = self.new_cell_id()
+        self.cell_id_by_variant[lvalue] = cell_id
+        return cell_id
+
+
+def make_random_line(rng):
+    return f'{rng.choice(WORDS)}_{rng.randint(0, 20)} = {rng.choice(WORDS)}.{rng.choice(WORDS)}({rng.randint(0, 99)})'
+
+
+def make_synthetic_session(num_execs, num_cells, seed):
+    # a notebook whose cells get re-executed, occasionally edited, and occasionally added to
+    rng = random.Random(seed)
+    cells = [[make_random_line(rng) for _ in range(rng.randint(2, 12))] for _ in range(num_cells)]
+    session = []
+    for _ in range(num_execs):
+        if rng.random() < 0.01:
+            cells.append([make_random_line(rng) for _ in range(rng.randint(2, 12))])
+        cell = cells[len(cells) - 1 - min(int(rng.expovariate(0.3)), len(cells) - 1)]
+        if rng.random() < 0.3:
+            cell[rng.randrange(len(cell))] = make_random_line(rng)
+        session.append('\n'.join(cell))
+    return session
+
+
+def get_longest_sessions(conn, num_sessions):
+    sessions = conn.execute("""
+SELECT trace, session
+FROM cell_execs
+GROUP BY trace, session
+ORDER BY count(*) DESC
+LIMIT ?""", (num_sessions,)).fetchall()
+    for trace, session in sessions:
+        sources = conn.execute(
+            'SELECT source FROM cell_execs WHERE trace = ? AND session = ? ORDER BY counter ASC', (trace, session)
+        ).fetchall()
+        yield f'trace {trace} session {session}', [source for source, in sources]
+
+
+def run_matcher(name, sources, threshold):
+    if name == 'bruteforce':
+        matcher = BruteForceCellMatcher(make_counter(), threshold=threshold)
+    else:
+        matcher = make_cell_matcher(name, make_counter(), threshold=threshold)
+    cell_ids = []
+    lookup_times = []
+    for source in sources:
+        start_time = timer()
+        cell_ids.append(matcher.get_cell_id(source))
+        lookup_times.append(timer() - start_time)
+    return cell_ids, lookup_times
+
+
+def mean_ms(times):
+    return 1000. * sum(times) / max(len(times), 1)
+
+
+def main(args):
+    if args.db is None:
+        sessions = [
+            (f'synthetic session {idx}', make_synthetic_session(args.synthetic_execs, 20, seed=args.seed + idx))
+            for idx in range(args.num_sessions)
+        ]
+    else:
+        conn = sqlite3.connect(args.db)
+        try:
+            sessions = list(get_longest_sessions(conn, args.num_sessions))
+        finally:
+            conn.close()
+    num_disagreeing = collections.Counter()
+    num_total = 0
+    for label, sources in sessions:
+        sources = [format_for_matching(idx, source) for idx, source in enumerate(sources)]
+        results = {name: run_matcher(name, sources, args.threshold) for name in args.matchers}
+        logger.info('%s: %d cell executions', label, len(sources))
+        quarter = max(len(sources) // 4, 1)
+        for name, (cell_ids, lookup_times) in results.items():
+            logger.info(
+                '  %-10s total %8.1fms, per lookup: first quarter %.3fms, last quarter %.3fms; %d cells',
+                name, 1000. * sum(lookup_times), mean_ms(lookup_times[:quarter]),
+                mean_ms(lookup_times[-quarter:]), max(cell_ids) + 1
+            )
+        reference_ids = results[args.matchers[0]][0]
+        num_total += len(sources)
+        for name in args.matchers[1:]:
+            num_agreeing = sum(a == b for a, b in zip(reference_ids, results[name][0]))
+            num_disagreeing[name] += len(sources) - num_agreeing
+            logger.info(
+                '  %s agrees with %s on %d of %d cell ids', name, args.matchers[0], num_agreeing, len(sources)
+            )
+    for name in args.matchers[1:]:
+        logger.info(
+            'overall, %s disagrees with %s on %d of %d cell ids (%.2f%%)', name, args.matchers[0],
+            num_disagreeing[name], num_total, 100. * num_disagreeing[name] / max(num_total, 1)
+        )
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare cell matchers on long sessions')
+    parser.add_argument('--db', help='traces.sqlite to take the longest sessions from (synthetic sessions if unset)')
+    parser.add_argument('--num-sessions', type=int, default=3)
+    parser.add_argument('--synthetic-execs', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threshold', type=float, default=MATCHING_CELL_THRESHOLD)
+    parser.add_argument(
+        '--matchers', nargs='+', choices=sorted(CELL_MATCHERS.keys()) + ['bruteforce'], default=['fuzzyset', 'shingle'],
+        help='the first one is the reference the others are compared to; bruteforce scores every variant seen so far'
+    )
+    args = parser.parse_args()
+    sys.exit(main(args))
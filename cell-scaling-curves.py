@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import csv
+import logging
+import sqlite3
+import sys
+
+from cell_stats import SCALING_AXES, get_scaling_curve
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    try:
+        curve = get_scaling_curve(conn, args.version, axis=args.axis, bucket_size=args.bucket_size)
+    finally:
+        conn.close()
+    if len(curve) == 0:
+        logger.error('no per-cell stats recorded for version %d', args.version)
+        return 1
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(curve[0].keys()))
+    writer.writeheader()
+    writer.writerows(curve)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print per-phase cell timings from replay_cell_stats as a csv curve')
+    parser.add_argument('-v', '--version', type=int, required=True)
+    parser.add_argument('--axis', choices=SCALING_AXES, default='exec_index', help='What to bucket cells by')
+    parser.add_argument('--bucket-size', type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import math
+
+import Levenshtein
+
+try:
+    from cfuzzyset import cFuzzySet as FuzzySet
+except ImportError:
+    from fuzzyset import FuzzySet
+
+logger = logging.getLogger(__name__)
+
+MATCHING_CELL_THRESHOLD = 0.8
+DEFAULT_GRAM_SIZE = 3
+
+
+def levenshtein_score(str1, str2, score_cutoff=None):
+    # same score as fuzzyset: 1 - (edit distance / length of the longer string)
+    max_len = max(len(str1), len(str2))
+    if max_len == 0:
+        return 1.
+    if score_cutoff is None:
+        distance = Levenshtein.distance(str1, str2)
+    else:
+        distance = Levenshtein.distance(str1, str2, score_cutoff=score_cutoff)
+    return 1 - float(distance) / max_len
+
+
+class CellMatcher(object):
+    def __init__(self, new_cell_id, threshold=MATCHING_CELL_THRESHOLD):
+        self.new_cell_id = new_cell_id
+        self.threshold = threshold
+
+    def get_cell_id(self, source):
+        raise NotImplementedError
+
+
+class FuzzySetCellMatcher(CellMatcher):
+    # the original matcher: every variant ever seen stays in the FuzzySet, so lookups get
+    # slower (and the top-50 cosine prefilter less reliable) as sessions get longer
+    def __init__(self, new_cell_id, threshold=MATCHING_CELL_THRESHOLD):
+        super().__init__(new_cell_id, threshold=threshold)
+        self.cell_id_by_source = {}
+        self.executed_cells = FuzzySet()
+
+    def get_cell_id(self, source):
+        match = self.executed_cells.get(source)
+        if match is None:
+            score, old_source = -1, None
+        else:
+            score, old_source = match[0]
+        if score >= self.threshold:
+            cell_id = self.cell_id_by_source[old_source]
+        else:
+            cell_id = self.new_cell_id()
+        self.cell_id_by_source[source] = cell_id
+        self.executed_cells.add(source)
+        return cell_id
+
+
+class ShingleCellMatcher(CellMatcher):
+    # Finds the previously seen variant with the best fuzzyset-style levenshtein score, using an
+    # inverted index of q-grams. Every variant is kept, and the length and prefix filters can't
+    # drop one that scores >= threshold, so the answer is the best match over the whole session.
+    # Each match found raises the bar for the rest: a variant has to score at least as well as the
+    # best so far, which shrinks the prefix to probe down to the few rarest grams, so lookups stay
+    # flat as the session grows. This can differ from FuzzySet, which only rescores the top 50
+    # variants by cosine similarity: when the best variant isn't among them, FuzzySet settles for
+    # a worse one (or none). Ties go to the variant sharing more q-grams, then the earliest seen.
+    def __init__(self, new_cell_id, threshold=MATCHING_CELL_THRESHOLD, gram_size=DEFAULT_GRAM_SIZE):
+        super().__init__(new_cell_id, threshold=threshold)
+        self.gram_size = gram_size
+        self.cell_id_by_variant = {}
+        self.variant_order = {}
+        # gram -> length -> variants containing it, so probes only walk the lengths that can match
+        self.postings = collections.defaultdict(lambda: collections.defaultdict(list))
+        self.gram_counts = collections.Counter()
+        # variants too short for the prefix filter to say anything get found by length instead
+        self.variants_by_length = collections.defaultdict(list)
+
+    def _grams(self, value):
+        return collections.Counter(value[i:i + self.gram_size] for i in range(len(value) - self.gram_size + 1))
+
+    def _num_shared_grams(self, grams, variant):
+        variant_grams = self._grams(variant)
+        return sum(min(occ, variant_grams.get(gram, 0)) for gram, occ in grams.items())
+
+    @staticmethod
+    def _max_distance(max_len, threshold):
+        return int(math.floor((1 - threshold) * max_len + 1e-9))
+
+    def _min_shared_grams_lower_bound(self, length, threshold):
+        # q-gram lemma: strings within edit distance d share at least max_len - q + 1 - q * d grams;
+        # this is its lower bound over all lengths a match for a string of this length can have
+        slope = 1 - self.gram_size * (1 - threshold)
+        if slope <= 0:
+            return 0
+        return int(math.ceil(slope * length - self.gram_size + 1 - 1e-6))
+
+    @staticmethod
+    def _length_range(length, threshold):
+        # lengths a variant can have and still be within _max_distance of a string of this length
+        return range(int(math.ceil(threshold * length - 1e-9)), int(length / threshold + 1e-9) + 1)
+
+    def _best_match(self, lvalue):
+        grams = self._grams(lvalue)
+        length = len(lvalue)
+        threshold = self.threshold
+        best_score, best_shared, best_variant = -1., None, None
+        seen = set()
+
+        def consider(variant):
+            nonlocal threshold, best_score, best_shared, best_variant
+            max_distance = self._max_distance(max(length, len(variant)), threshold)
+            score = levenshtein_score(lvalue, variant, score_cutoff=max_distance)
+            if score < threshold:
+                return
+            if score == best_score:
+                if best_shared is None:
+                    best_shared = self._num_shared_grams(grams, best_variant)
+                num_shared = self._num_shared_grams(grams, variant)
+                if (num_shared, -self.variant_order[variant]) <= (best_shared, -self.variant_order[best_variant]):
+                    return
+                best_shared, best_variant = num_shared, variant
+            elif score > best_score:
+                best_score, best_shared, best_variant = score, None, variant
+            threshold = max(threshold, score)
+
+        if self._min_shared_grams_lower_bound(length, threshold) <= 0:
+            for other_length in self._length_range(length, threshold):
+                for variant in self.variants_by_length.get(other_length, ()):
+                    consider(variant)
+            return best_score, best_variant
+
+        # prefix filter: any variant sharing at least `min_shared` grams with lvalue has to share one
+        # of its (num grams - min_shared + 1) rarest grams, so only those postings need probing; both
+        # the prefix and the range of lengths to look at shrink every time a better match pushes the
+        # threshold up
+        grams_by_rarity = sorted(
+            (gram for gram, occ in grams.items() for _ in range(occ)),
+            key=lambda gram: self.gram_counts.get(gram, 0)
+        )
+        probed = 0
+        while probed < len(grams_by_rarity) - self._min_shared_grams_lower_bound(length, threshold) + 1:
+            variants_by_length = self.postings.get(grams_by_rarity[probed], {})
+            lengths = self._length_range(length, threshold)
+            if len(variants_by_length) < len(lengths):
+                lengths = [other_length for other_length in variants_by_length if other_length in lengths]
+            for other_length in lengths:
+                for variant in variants_by_length.get(other_length, ()):
+                    if variant not in seen:
+                        seen.add(variant)
+                        consider(variant)
+            probed += 1
+        return best_score, best_variant
+
+    def _add_variant(self, lvalue, cell_id):
+        self.cell_id_by_variant[lvalue] = cell_id
+        self.variant_order[lvalue] = len(self.variant_order)
+        self.variants_by_length[len(lvalue)].append(lvalue)
+        for gram in self._grams(lvalue):
+            self.postings[gram][len(lvalue)].append(lvalue)
+            self.gram_counts[gram] += 1
+
+    def get_cell_id(self, source):
+        lvalue = source.lower()
+        cell_id = self.cell_id_by_variant.get(lvalue)
+        if cell_id is not None:
+            return cell_id
+        score, variant = self._best_match(lvalue)
+        if score >= self.threshold:
+            cell_id = self.cell_id_by_variant[variant]
+        else:
+            cell_id = self.new_cell_id()
+        self._add_variant(lvalue, cell_id)
+        return cell_id
+
+
+CELL_MATCHERS = {
+    'fuzzyset': FuzzySetCellMatcher,
+    'shingle': ShingleCellMatcher,
+}
+
+
+def make_cell_matcher(name, new_cell_id, threshold=MATCHING_CELL_THRESHOLD):
+    return CELL_MATCHERS[name](new_cell_id, threshold=threshold)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+from schema import CELL_STATS_DDL
+
+CELL_STATS_COLUMNS = [
+    'version',
+    'trace',
+    'session',
+    'exec_index',
+    'cell_id',
+    'counter',
+    'source_bytes',
+    'preprocess_time',
+    'execution_time',
+    'tracing_time',
+    'checking_time',
+    'raised',
+    'timed_out',
+]
+
+# what the scaling curves can be plotted against
+SCALING_AXES = ['exec_index', 'cell_id', 'source_bytes']
+
+
+def make_cell_stats_row(
+    version, trace, session, exec_index, cell_id, counter, source, preprocess_time, run_time, checking_time,
+    traced, raised, timed_out
+):
+    # cells run under nbsafety can't be timed apart from its tracer, so the time spent running
+    # them is their tracing_time; execution_time is only set for untraced replays (comparing the
+    # two across versions gives per-cell tracing overhead)
+    return dict(
+        version=version,
+        trace=trace,
+        session=session,
+        exec_index=exec_index,
+        cell_id=cell_id,
+        counter=counter,
+        source_bytes=len(source.encode('utf-8')),
+        preprocess_time=preprocess_time,
+        execution_time=None if traced else run_time,
+        tracing_time=run_time if traced else None,
+        checking_time=checking_time,
+        raised=int(raised),
+        timed_out=int(timed_out),
+    )
+
+
+def insert_cell_stats(conn, version, trace, session, rows):
+    # runs inside whatever transaction the caller has open (see result_sink.py)
+    conn.execute(CELL_STATS_DDL)
+    # replace the session's rows wholesale, since a rerun may have executed fewer cells
+    conn.execute(
+        'DELETE FROM replay_cell_stats WHERE version = ? AND trace = ? AND session = ?', (version, trace, session)
+    )
+    conn.executemany(
+        f"INSERT INTO replay_cell_stats({','.join(CELL_STATS_COLUMNS)}) "
+        f"VALUES ({','.join('?' for _ in CELL_STATS_COLUMNS)})",
+        [tuple(row[col] for col in CELL_STATS_COLUMNS) for row in rows]
+    )
+
+
+def get_scaling_curve(conn, version, axis='exec_index', bucket_size=10):
+    # mean / max time per phase for cells bucketed by `axis`, over every session replayed under
+    # `version`; returns one dict per nonempty bucket, in order
+    if axis not in SCALING_AXES:
+        raise ValueError(f'unknown scaling axis {axis}; expected one of {SCALING_AXES}')
+    try:
+        rows = conn.execute(f"""
+SELECT
+    ({axis} / ?) * ? AS bucket,
+    count(*),
+    count(DISTINCT trace || ':' || session),
+    avg(preprocess_time),
+    avg(execution_time),
+    avg(tracing_time),
+    avg(checking_time),
+    max(coalesce(tracing_time, execution_time)),
+    max(checking_time),
+    avg(raised),
+    avg(timed_out)
+FROM replay_cell_stats
+WHERE version = ?
+GROUP BY bucket
+ORDER BY bucket""", (bucket_size, bucket_size, version)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    return [
+        dict(
+            bucket=bucket,
+            num_cells=num_cells,
+            num_sessions=num_sessions,
+            avg_preprocess_time=avg_preprocess_time,
+            avg_execution_time=avg_execution_time,
+            avg_tracing_time=avg_tracing_time,
+            avg_checking_time=avg_checking_time,
+            max_run_time=max_run_time,
+            max_checking_time=max_checking_time,
+            raised_rate=raised_rate,
+            timeout_rate=timeout_rate,
+        )
+        for (
+            bucket, num_cells, num_sessions, avg_preprocess_time, avg_execution_time, avg_tracing_time,
+            avg_checking_time, max_run_time, max_checking_time, raised_rate, timeout_rate
+        ) in rows
+    ]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import heapq
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# interpreter / ipython startup, package resolution, etc. that wall_time doesn't include
+SESSION_OVERHEAD_SECONDS = 10.
+# used when there is no replay history at all to fit against
+DEFAULT_SECONDS_PER_CELL = 0.5
+DEFAULT_SECONDS_PER_KB = 0.
+
+
+def get_session_shapes(conn, sessions):
+    # one range scan of the cell_execs(trace, session, counter) index per candidate session, so
+    # only the candidates' cells get read rather than every cell in the corpus
+    shapes = {}
+    for trace, session in sessions:
+        num_cells, source_bytes = conn.execute(
+            'SELECT count(*), sum(length(source)) FROM cell_execs WHERE trace = ? AND session = ?', (trace, session)
+        ).fetchone()
+        if num_cells > 0:
+            shapes[trace, session] = (num_cells, source_bytes or 0)
+    return shapes
+
+
+def get_replay_history(conn):
+    try:
+        rows = conn.execute("""
+SELECT trace, session, avg(wall_time)
+FROM replay_stats
+WHERE wall_time IS NOT NULL
+GROUP BY trace, session""").fetchall()
+    except Exception as e:
+        logger.warning('unable to read replay history: %s', e)
+        return {}
+    return {(trace, session): wall_time for trace, session, wall_time in rows}
+
+
+def fit_cost_coefficients(shapes, history):
+    observed = [(shapes[key], wall_time) for key, wall_time in history.items() if key in shapes]
+    if len(observed) < 2:
+        return DEFAULT_SECONDS_PER_CELL, DEFAULT_SECONDS_PER_KB
+    features = np.array([[num_cells, source_bytes / 1024.] for (num_cells, source_bytes), _ in observed])
+    wall_times = np.array([wall_time for _, wall_time in observed])
+    (per_cell, per_kb), *_ = np.linalg.lstsq(features, wall_times, rcond=None)
+    if per_cell < 0 or per_kb < 0:
+        # fall back to a plain per-cell rate rather than extrapolating a nonsensical fit
+        return float(wall_times.sum() / max(features[:, 0].sum(), 1.)), 0.
+    return float(per_cell), float(per_kb)
+
+
+def estimate_session_costs(conn, sessions):
+    shapes = get_session_shapes(conn, sessions)
+    history = get_replay_history(conn)
+    per_cell, per_kb = fit_cost_coefficients(shapes, history)
+    logger.info(
+        'cost model: %.3fs per cell + %.3fs per KB of source (fit on %d replayed sessions)',
+        per_cell, per_kb, sum(key in shapes for key in history)
+    )
+    costs = {}
+    for key in sessions:
+        if key in history:
+            costs[key] = SESSION_OVERHEAD_SECONDS + history[key]
+        else:
+            num_cells, source_bytes = shapes.get(key, (0, 0))
+            costs[key] = SESSION_OVERHEAD_SECONDS + per_cell * num_cells + per_kb * source_bytes / 1024.
+    return costs
+
+
+def predict_makespan(costs_in_dispatch_order, num_workers):
+    # simulate greedy dispatch: each session goes to whichever worker frees up first
+    worker_finish_times = [0.] * max(num_workers, 1)
+    for cost in costs_in_dispatch_order:
+        heapq.heappush(worker_finish_times, heapq.heappop(worker_finish_times) + cost)
+    return max(worker_finish_times)
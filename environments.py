@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import pathlib
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+from resolvers import PACKAGES_BY_IMPORT
+from schema import ENVIRONMENTS_DDL, SESSION_ENVIRONMENTS_DDL, ensure_session_environments_columns
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENV_ROOT = './data/envs'
+DEFAULT_MAX_ENV_REQUIREMENTS = 40
+
+# `pip check` output: "foo 1.0 has requirement bar<2, but you have bar 2.1." and
+# "foo 1.0 requires bar, which is not installed."
+PIP_CHECK_LINE_RE = re.compile(r'^(\S+) \S+ (?:has requirement|requires) ')
+
+# never worth trying to pip install these
+IGNORED_IMPORTS = set(sys.stdlib_module_names) | {'__future__', 'itertools', 'readline'}
+
+
+def _version_tuple(vstr):
+    return tuple(int(part) if part.isdigit() else -1 for part in vstr.split('.'))
+
+
+def get_known_pins(cache_conn):
+    # import statement -> (package, version) for statements that needed a specific version
+    # installed the last time PipResolver resolved them (see resolution_cache.py)
+    try:
+        rows = cache_conn.execute(
+            'SELECT import_stmt, package, version FROM import_resolutions WHERE version IS NOT NULL'
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    pins = {}
+    for import_stmt, package, version in rows:
+        if import_stmt not in pins or _version_tuple(version) > _version_tuple(pins[import_stmt][1]):
+            pins[import_stmt] = (package, version)
+    return pins
+
+
+def get_session_requirements(imports, known_pins):
+    # imports are [import stmt source, [top-level names]] as stored by preprocess_session; returns
+    # {pypi package: pinned version or None}, or None if two imports pin the same package differently
+    requirements = {}
+    for import_stmt, pkg_names in imports:
+        for pkg in pkg_names:
+            if pkg in IGNORED_IMPORTS:
+                continue
+            requirements.setdefault(PACKAGES_BY_IMPORT.get(pkg, {'package': pkg})['package'], None)
+        if import_stmt in known_pins:
+            package, version = known_pins[import_stmt]
+            if requirements.get(package) not in (None, version):
+                return None
+            requirements[package] = version
+    return requirements
+
+
+def format_requirement(package, version):
+    return package if version is None else f'{package}=={version}'
+
+
+def _make_env_id(requirements):
+    return hashlib.sha1(json.dumps(requirements).encode('utf-8')).hexdigest()[:12]
+
+
+def cluster_sessions(requirements_by_session, max_requirements=DEFAULT_MAX_ENV_REQUIREMENTS):
+    # Sessions are compatible iff they don't pin any package to different versions; each cluster
+    # gets one environment with the union of its sessions' requirements, pinned wherever one of
+    # them pins. Clusters stay under max_requirements packages (a session that needs more than that
+    # gets one to itself), so that no environment turns into every package anyone ever imported.
+    # Sessions go biggest first into whichever cluster they add the fewest new packages to.
+    # Sessions whose own pins conflict are left out and resolve packages at replay time as before.
+    sessions = sorted(
+        (session for session, requirements in requirements_by_session.items() if requirements is not None),
+        key=lambda session: (-len(requirements_by_session[session]), session)
+    )
+    clusters = []
+    for session in sessions:
+        requirements = requirements_by_session[session]
+        packages = set(requirements.keys())
+        pins = {pkg: version for pkg, version in requirements.items() if version is not None}
+        best = None
+        for cluster in clusters:
+            num_new = len(packages - cluster['packages'])
+            if len(cluster['packages']) + num_new > max_requirements:
+                continue
+            if any(cluster['pins'].get(pkg, version) != version for pkg, version in pins.items()):
+                continue
+            if best is None or num_new < best[0]:
+                best = (num_new, cluster)
+                if num_new == 0:
+                    break
+        if best is None:
+            cluster = {'packages': set(), 'pins': {}, 'sessions': []}
+            clusters.append(cluster)
+        else:
+            cluster = best[1]
+        cluster['packages'] |= packages
+        cluster['pins'].update(pins)
+        cluster['sessions'].append(session)
+    planned = []
+    for cluster in clusters:
+        requirements = sorted(format_requirement(pkg, cluster['pins'].get(pkg)) for pkg in cluster['packages'])
+        planned.append((_make_env_id(requirements), requirements, sorted(cluster['sessions'])))
+    return planned
+
+
+def store_environment_plan(conn, clusters, env_root, requirements_by_session):
+    env_root = pathlib.Path(env_root).resolve()
+    with conn:
+        conn.execute(ENVIRONMENTS_DDL)
+        conn.execute(SESSION_ENVIRONMENTS_DDL)
+        ensure_session_environments_columns(conn)
+        conn.execute('DELETE FROM session_environments')
+        conn.executemany(
+            'INSERT OR IGNORE INTO replay_environments(env_id, requirements, path) VALUES (?, ?, ?)',
+            [(env_id, json.dumps(requirements), str(env_root.joinpath(env_id))) for env_id, requirements, _ in clusters]
+        )
+        conn.executemany(
+            'INSERT INTO session_environments(trace, session, env_id, packages) VALUES (?, ?, ?, ?)',
+            [
+                (trace, session, env_id, json.dumps(sorted(requirements_by_session[trace, session].keys())))
+                for env_id, _, sessions in clusters for trace, session in sessions
+            ]
+        )
+
+
+def get_unbuilt_environments(conn):
+    conn.execute(ENVIRONMENTS_DDL)
+    return [
+        (env_id, json.loads(requirements), path) for env_id, requirements, path in conn.execute(
+            'SELECT env_id, requirements, path FROM replay_environments WHERE built = 0'
+        )
+    ]
+
+
+def get_env_python(env_path):
+    return pathlib.Path(env_path).joinpath('bin', 'python')
+
+
+def _canonical_package(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _requirement_package(requirement):
+    return _canonical_package(requirement.split('==')[0])
+
+
+def get_broken_packages(python):
+    # canonical names of installed distributions whose own dependencies `pip check` finds missing
+    # or at the wrong version, e.g. after a later install up- or downgraded something they need
+    result = subprocess.run(
+        [str(python), '-m', 'pip', 'check'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    broken = set()
+    for line in result.stdout.splitlines():
+        match = PIP_CHECK_LINE_RE.match(line)
+        if match is not None:
+            broken.add(_canonical_package(match.group(1)))
+    return broken
+
+
+def build_environment(env_path, requirements, pip_args=''):
+    # the venv sees the system site-packages so that ipython, nbsafety etc. don't need to be
+    # reinstalled everywhere. All requirements go to a single pip install first, so that pip
+    # resolves them together; if that fails, they go in one at a time, since some imports aren't on
+    # pypi at all (local modules and the like) and those shouldn't take the rest down with them.
+    # Requirements that fail to install, or that pip check reports broken afterwards, are returned.
+    env_path = pathlib.Path(env_path)
+    if env_path.exists():
+        shutil.rmtree(env_path)
+    subprocess.check_call([sys.executable, '-m', 'venv', '--system-site-packages', str(env_path)])
+    python = get_env_python(env_path)
+    failed = []
+    with open('/dev/null', 'w') as devnull:
+        try:
+            subprocess.check_call(
+                f'{python} -m pip install {pip_args} {" ".join(requirements)}',
+                shell=True, stdout=devnull, stderr=subprocess.STDOUT
+            )
+        except subprocess.CalledProcessError:
+            logger.info('unable to install all requirements of %s at once; installing them one at a time', env_path)
+            for requirement in requirements:
+                try:
+                    subprocess.check_call(
+                        f'{python} -m pip install {pip_args} {requirement}',
+                        shell=True, stdout=devnull, stderr=subprocess.STDOUT
+                    )
+                except subprocess.CalledProcessError:
+                    logger.warning('unable to install %s into %s', requirement, env_path)
+                    failed.append(requirement)
+    broken = get_broken_packages(python)
+    for requirement in requirements:
+        if requirement not in failed and _requirement_package(requirement) in broken:
+            logger.warning('%s has conflicting dependencies in %s', requirement, env_path)
+            failed.append(requirement)
+    return failed
+
+
+def mark_environment_built(conn, env_id, failed_requirements):
+    with conn:
+        conn.execute(
+            'UPDATE replay_environments SET built = 1, failed_requirements = ? WHERE env_id = ?',
+            (json.dumps(failed_requirements), env_id)
+        )
+
+
+def get_session_environments(conn):
+    # (trace, session) -> interpreter of the prebuilt environment to replay it in. Sessions that
+    # need a requirement their environment failed to install (or that was left broken there) get
+    # none, and so resolve packages at replay time as before.
+    try:
+        rows = conn.execute("""
+SELECT se.trace, se.session, se.packages, re.path, re.failed_requirements
+FROM session_environments se
+JOIN replay_environments re ON re.env_id = se.env_id
+WHERE re.built = 1""").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    session_environments = {}
+    for trace, session, packages, path, failed_requirements in rows:
+        failed = {_requirement_package(requirement) for requirement in json.loads(failed_requirements or '[]')}
+        if len(failed) > 0:
+            # plans made before sessions' own packages were stored: assume the session needs them all
+            if packages is None or any(_canonical_package(pkg) in failed for pkg in json.loads(packages)):
+                continue
+        session_environments[trace, session] = str(get_env_python(path))
+    return session_environments
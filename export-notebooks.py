@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import csv
+import itertools
+import logging
+import multiprocessing
+import os
+import pathlib
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from notebook_export import session_notebook_name, write_notebook
+from preprocessing import Python2Converter
+from session_pack import SessionPack
+from source_cache import SOURCE_CACHE_DB
+from source_index import ensure_source_index, format_sessions_matching_any
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+SESSIONS_PER_TASK = 16
+
+converter = None
+output_dir = None
+session_pack = None
+
+
+def init_worker(convert, source_cache_db, out_dir, session_pack_path):
+    global converter
+    global output_dir
+    global session_pack
+    if convert:
+        converter = Python2Converter(db_path=source_cache_db)
+    output_dir = out_dir
+    if session_pack_path is not None:
+        # each worker maps the pack itself; the pages are shared through the page cache
+        session_pack = SessionPack(session_pack_path)
+
+
+def export_sessions(sessions):
+    # each worker reads its own sessions, so the parent only hands out (trace, session) pairs
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    num_exported = 0
+    try:
+        for trace, session in sessions:
+            if session_pack is not None and (trace, session) in session_pack:
+                cells = session_pack.get_session(trace, session)
+            else:
+                # not in the pack (e.g. gathered after it was built)
+                cells = conn.execute(
+                    'SELECT counter, source FROM cell_execs WHERE trace = ? AND session = ? ORDER BY counter ASC',
+                    (trace, session)
+                ).fetchall()
+            if len(cells) == 0:
+                logger.warning('no cells for trace %d session %d', trace, session)
+                continue
+            if converter is not None:
+                cells = [(counter, converter.convert(source)) for counter, source in cells]
+            write_notebook(output_dir.joinpath(session_notebook_name(trace, session)), cells)
+            num_exported += 1
+    finally:
+        conn.close()
+    return num_exported
+
+
+def read_sessions_file(fname):
+    # same format as sessions-with-safety-errors.csv
+    with open(fname) as f:
+        return [(int(row['trace']), int(row['session'])) for row in csv.DictReader(f)]
+
+
+def select_sessions(conn, args):
+    if args.sessions_file is not None:
+        return read_sessions_file(args.sessions_file)
+    if len(args.session) > 0:
+        return [tuple(map(int, session.split(':'))) for session in args.session]
+    if len(args.matching) > 0:
+        sql, params = format_sessions_matching_any(args.matching, use_index=ensure_source_index(conn))
+        sql = f"""
+SELECT trace, session FROM cell_execs
+WHERE (trace, session) IN ({sql})
+GROUP BY trace, session
+HAVING count(*) >= ?"""
+        params = list(params) + [args.min_cells]
+    elif args.session_pack is not None:
+        pack = SessionPack(args.session_pack)
+        try:
+            return [
+                key for key, count in zip(pack.session_keys(), pack.sessions['count'].tolist())
+                if count >= args.min_cells
+            ]
+        finally:
+            pack.close()
+    else:
+        sql = 'SELECT trace, session FROM cell_execs GROUP BY trace, session HAVING count(*) >= ?'
+        params = [args.min_cells]
+    return conn.execute(sql, params).fetchall()
+
+
+def chunks(items, size):
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    try:
+        sessions = select_sessions(conn, args)
+    finally:
+        conn.close()
+    out_dir = pathlib.Path(args.output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    source_cache_db = None if args.no_source_cache else SOURCE_CACHE_DB
+    logger.info('exporting %d sessions to %s', len(sessions), out_dir)
+    start_time = timer()
+    num_exported = 0
+    with multiprocessing.Pool(
+        args.jobs, initializer=init_worker, initargs=(not args.raw, source_cache_db, out_dir, args.session_pack)
+    ) as pool:
+        for num_in_chunk in pool.imap_unordered(export_sessions, chunks(sessions, SESSIONS_PER_TASK)):
+            num_exported += num_in_chunk
+    elapsed = timer() - start_time
+    logger.info(
+        'exported %d notebooks in %.1fs (%.1f sessions/s)', num_exported, elapsed, num_exported / max(elapsed, 1e-9)
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write sessions out as .ipynb notebooks for inspection')
+    parser.add_argument('--session', action='append', default=[], help='trace:session to export (repeatable)')
+    parser.add_argument('--sessions-file', help='csv with trace and session columns of sessions to export')
+    parser.add_argument(
+        '--matching', action='append', default=[], help='LIKE pattern; export sessions having a matching cell'
+    )
+    parser.add_argument('--min-cells', type=int, default=50, help='Skip sessions with fewer cells (filters only)')
+    parser.add_argument('--raw', action='store_true', help='Export sources as recorded, without 2to3 conversion')
+    parser.add_argument('--no-source-cache', action='store_true', help='Do not use the persistent source cache')
+    parser.add_argument('--session-pack', help='Read cells from this session pack instead of cell_execs')
+    parser.add_argument('-o', '--output-dir', default='./data/notebooks')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    args = parser.parse_args()
+    sys.exit(main(args))
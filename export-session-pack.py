@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import random
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from session_pack import DEFAULT_SESSION_PACK, ZDICT_MAX_BYTES, SessionPack, build_session_pack
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+
+
+def iter_cell_execs(conn, min_cells):
+    # in (trace, session, counter) order, which is what the pack builder wants; the
+    # cell_execs(trace, session, counter) index makes this a single ordered scan
+    return conn.execute("""
+SELECT trace, session, counter, source FROM cell_execs
+WHERE (trace, session) IN (SELECT trace, session FROM cell_execs GROUP BY trace, session HAVING count(*) >= ?)
+ORDER BY trace, session, counter""", (min_cells,))
+
+
+def verify(conn, pack, num_sessions):
+    # compare a random sample of sessions against sql, timing both ways of reading them
+    keys = pack.session_keys()
+    sample = random.Random(0).sample(keys, min(num_sessions, len(keys)))
+    sql_time = 0.
+    pack_time = 0.
+    for trace, session in sample:
+        start_time = timer()
+        expected = conn.execute(
+            'SELECT counter, source FROM cell_execs WHERE trace = ? AND session = ? ORDER BY counter ASC',
+            (trace, session)
+        ).fetchall()
+        sql_time += timer() - start_time
+        start_time = timer()
+        actual = pack.get_session(trace, session)
+        pack_time += timer() - start_time
+        if [(counter, source or '') for counter, source in expected] != actual:
+            logger.error('trace %d session %d differs between the pack and cell_execs', trace, session)
+            return False
+    logger.info(
+        'verified %d sessions; read them in %.1fms from sql, %.1fms from the pack',
+        len(sample), 1000. * sql_time, 1000. * pack_time
+    )
+    return True
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    try:
+        start_time = timer()
+        stats = build_session_pack(iter_cell_execs(conn, args.min_cells), args.output, zdict_bytes=args.zdict_bytes)
+        logger.info(
+            'packed %d cells from %d sessions into %s in %.1fs',
+            stats['num_rows'], stats['num_sessions'], args.output, timer() - start_time
+        )
+        logger.info(
+            '%d unique cell bodies; %d bytes of source -> %d byte pack (%.1fx)',
+            stats['num_unique_bodies'], stats['raw_bytes'], stats['pack_bytes'],
+            stats['raw_bytes'] / max(stats['pack_bytes'], 1)
+        )
+        if args.verify > 0:
+            pack = SessionPack(args.output)
+            try:
+                if not verify(conn, pack, args.verify):
+                    return 1
+            finally:
+                pack.close()
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write cell_execs out as a deduplicated, compressed, mmap-able session pack'
+    )
+    parser.add_argument('-o', '--output', default=DEFAULT_SESSION_PACK)
+    parser.add_argument('--min-cells', type=int, default=0, help='Skip sessions with fewer cells')
+    parser.add_argument(
+        '--zdict-bytes', type=int, default=ZDICT_MAX_BYTES,
+        help='Size of the preset compression dictionary built from common cells (0 for none)'
+    )
+    parser.add_argument(
+        '--verify', type=int, default=0, metavar='N', help='Check N random sessions against cell_execs afterwards'
+    )
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -1,79 +1,344 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
-import glob
+import collections
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
 import pathlib
+import shutil
 import sqlite3
-import subprocess
 import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+import urllib.parse
+import urllib.request
+
+from schema import TRACE_DERIVED_TABLES, migrate
+from source_index import ensure_source_index
 
 DEFAULT_NUM_REPOS = 10
+DEFAULT_JOBS = 8
+# traces committed per write transaction
+DEFAULT_BATCH_SIZE = 50
+FETCH_TIMEOUT_SECONDS = 60
+CHUNK_BYTES = 1 << 20
 TEMP_DIR = pathlib.Path('./data/temp')
+TRACES_DB = './data/traces.sqlite'
+TRACES_JSON = './data/traces.json'
+# only read to adopt what was ingested before the manifest existed
+SEEN_TRACES_JSON = './data/seen-traces.json'
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def main(args, conn):
-    TEMP_DIR.mkdir(exist_ok=True)
-    with open('./data/traces.json') as f:
+def list_sources(args):
+    # (url, legacy trace id or None) of every history.sqlite to consider
+    if args.source_dir is not None:
+        return [(path.resolve().as_uri(), None) for path in sorted(pathlib.Path(args.source_dir).glob('*.sqlite'))]
+    with open(args.traces_json) as f:
         trace_json = json.loads(f.read())
-    successes = 0
-    curse = conn.cursor()
-    seen_traces = curse.execute('SELECT trace FROM cell_execs')
-    seen_traces = set(tup[0] for tup in seen_traces)
-    curse.close()
-    if os.path.exists('./data/seen-traces.json'):
-        with open('./data/seen-traces.json') as f:
-            seen_traces |= set(map(int, json.loads(f.read())['seen']))
-    for entry in trace_json:
-        trace_id = int(entry['id'])
-        if trace_id in seen_traces:
-            logger.info('Skipping already download nb trace %d', trace_id)
+    return [(entry['html_url'], entry.get('id')) for entry in trace_json]
+
+
+def get_local_path(url):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme == '':
+        return url
+    return None
+
+
+def copy_and_hash(src, dst=None):
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(CHUNK_BYTES)
+        if len(chunk) == 0:
+            return digest.hexdigest(), size
+        digest.update(chunk)
+        size += len(chunk)
+        if dst is not None:
+            dst.write(chunk)
+
+
+def read_history(path):
+    conn = sqlite3.connect(f'{pathlib.Path(path).resolve().as_uri()}?mode=ro', uri=True)
+    try:
+        return conn.execute('SELECT session, line, source FROM history').fetchall()
+    finally:
+        conn.close()
+
+
+def fetch_history(url, known_hash=None):
+    # runs on the fetch threads: download (unless the url is a local file), hash, and read out
+    # the rows, so the writer only ever has to insert them; returns (sha256, size, rows), where
+    # rows is None if the hash is `known_hash` (i.e. the file is unchanged since it was ingested)
+    path = get_local_path(url)
+    if path is not None:
+        with open(path, 'rb') as f:
+            content_hash, size = copy_and_hash(f)
+        return content_hash, size, None if content_hash == known_hash else read_history(path)
+    with tempfile.NamedTemporaryFile(dir=TEMP_DIR, suffix='.sqlite') as f:
+        with urllib.request.urlopen(f'{url}?raw=true', timeout=FETCH_TIMEOUT_SECONDS) as response:
+            content_hash, size = copy_and_hash(response, f)
+        f.flush()
+        return content_hash, size, None if content_hash == known_hash else read_history(f.name)
+
+
+def fetch_trace(url, known_hash=None):
+    # (url, content_hash, size, rows, error)
+    try:
+        return (url,) + fetch_history(url, known_hash=known_hash) + (None,)
+    except Exception as e:
+        logger.info('Exception while grabbing nb history %s: %s', url, e)
+        return url, None, None, None, str(e)
+
+
+def adopt_legacy_traces(conn, sources):
+    # Before the manifest, traces.json entries were numbered by make_trace_ids.py, ingested under
+    # those ids, and listed in seen-traces.json once tried. Record them in the manifest (without
+    # hashes) so they aren't fetched again; this is a no-op once every url is in the manifest.
+    known_urls = set(row[0] for row in conn.execute('SELECT url FROM ingest_manifest'))
+    ingested = set(row[0] for row in conn.execute('SELECT trace FROM traces'))
+    tried = set()
+    if os.path.exists(SEEN_TRACES_JSON):
+        with open(SEEN_TRACES_JSON) as f:
+            tried = set(map(int, json.loads(f.read())['seen']))
+    rows = []
+    for url, trace_id in sources:
+        if trace_id is None or url in known_urls:
             continue
-        seen_traces.add(trace_id)
-        logger.info("Working on entry %s", entry['html_url'])
+        trace_id = int(trace_id)
+        if trace_id in ingested:
+            rows.append((url, trace_id, None))
+        elif trace_id in tried:
+            rows.append((url, None, 'failed before the ingest manifest existed'))
+    if len(rows) == 0:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR IGNORE INTO ingest_manifest(url, trace, error) VALUES (?, ?, ?)', rows)
+    conn.execute('COMMIT')
+    logger.info('adopted %d traces ingested (or tried) before the ingest manifest existed', len(rows))
+
+
+def select_urls_to_fetch(conn, sources, args):
+    # (url, known hash) of new urls, failed ones with --retry-failed, and ingested ones that may
+    # have changed: local files always (hashing them is cheap), downloads only with --recheck.
+    # Files whose hash matches are skipped before their rows are even read
+    manifest = {
+        url: (content_hash, trace)
+        for url, content_hash, trace in conn.execute('SELECT url, content_hash, trace FROM ingest_manifest')
+    }
+    urls = []
+    for url, _ in sources:
+        if url not in manifest:
+            urls.append((url, None))
+            continue
+        content_hash, trace = manifest[url]
+        if trace is None:
+            if args.retry_failed:
+                urls.append((url, None))
+        elif args.recheck or get_local_path(url) is not None:
+            urls.append((url, content_hash))
+    return urls
+
+
+def get_next_trace_id(conn, sources):
+    # new traces are numbered past every id in use, including legacy traces.json ids that were
+    # never ingested, so adopt_legacy_traces can't mistake a new trace for an old one
+    max_trace = max(
+        conn.execute('SELECT max(trace) FROM traces').fetchone()[0] or 0,
+        conn.execute('SELECT max(trace) FROM ingest_manifest').fetchone()[0] or 0,
+        max((int(trace_id) for _, trace_id in sources if trace_id is not None), default=0),
+    )
+    return max_trace + 1
+
+
+def delete_trace_cells(conn, trace_id):
+    # the trace's cells along with everything derived from them: preprocessed sessions, replay
+    # results, queue entries etc. would otherwise describe cells that are no longer there
+    conn.execute('DELETE FROM cell_execs WHERE trace = ?', (trace_id,))
+    existing_tables = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table in TRACE_DERIVED_TABLES:
+        if table in existing_tables:
+            conn.execute(f'DELETE FROM {table} WHERE trace = ?', (trace_id,))
+
+
+def import_traces(conn, fetched, next_trace_id):
+    # One transaction for the whole batch of (url, content_hash, size, rows, error). Files whose
+    # hash is already in the manifest map to that trace instead of being inserted again; a url
+    # whose contents changed is reimported, in place unless other urls share its trace. Rows go
+    # through a temp table and into cell_execs with a single INSERT ... SELECT, since the source
+    # index triggers are several times slower when fired by one INSERT per row. Returns the next
+    # unused trace id and what happened to each file.
+    counts = collections.Counter()
+    now = time.time()
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS staged_cell_execs(trace, session, counter, source)')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for url, content_hash, size, rows, error in fetched:
+            existing = conn.execute('SELECT content_hash, trace FROM ingest_manifest WHERE url = ?', (url,)).fetchone()
+            old_hash, old_trace = existing if existing is not None else (None, None)
+            if error is not None:
+                counts['failed'] += 1
+                # a url that fails a recheck keeps its last good trace
+                if old_trace is None:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO ingest_manifest(url, error, ingested_at) VALUES (?, ?, ?)',
+                        (url, error, now)
+                    )
+                continue
+            if old_trace is not None and old_hash in (content_hash, None):
+                # a trace adopted from before the manifest has no hash to compare with, so take
+                # it to be this file rather than reimport it
+                if old_hash is None:
+                    conn.execute(
+                        'UPDATE ingest_manifest SET content_hash = ?, size = ? WHERE url = ?', (content_hash, size, url)
+                    )
+                counts['unchanged'] += 1
+                continue
+            duplicate_of = conn.execute(
+                'SELECT trace FROM ingest_manifest WHERE content_hash = ? AND trace IS NOT NULL LIMIT 1',
+                (content_hash,)
+            ).fetchone()
+            if duplicate_of is not None:
+                trace_id = duplicate_of[0]
+                counts['deduplicated'] += 1
+            else:
+                num_sharing = 0
+                if old_trace is not None:
+                    num_sharing = conn.execute(
+                        'SELECT count(*) FROM ingest_manifest WHERE trace = ?', (old_trace,)
+                    ).fetchone()[0]
+                if num_sharing == 1:
+                    trace_id = old_trace
+                    delete_trace_cells(conn, trace_id)
+                    counts['changed'] += 1
+                else:
+                    trace_id = next_trace_id
+                    next_trace_id += 1
+                    counts['imported'] += 1
+                conn.executemany(
+                    'INSERT INTO temp.staged_cell_execs VALUES (?, ?, ?, ?)',
+                    ((trace_id, session, counter, source) for session, counter, source in rows)
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO traces(trace, url, num_cells, ingested_at) VALUES (?, ?, ?, ?)',
+                    (trace_id, url, len(rows), now)
+                )
+                counts['cells'] += len(rows)
+            conn.execute(
+                'INSERT OR REPLACE INTO ingest_manifest(url, content_hash, size, trace, ingested_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, content_hash, size, trace_id, now)
+            )
+            if old_trace is not None and old_trace != trace_id and conn.execute(
+                'SELECT count(*) FROM ingest_manifest WHERE trace = ?', (old_trace,)
+            ).fetchone()[0] == 0:
+                # the url changed into a copy of another file, and nothing else refers to its old trace
+                delete_trace_cells(conn, old_trace)
+                conn.execute('DELETE FROM traces WHERE trace = ?', (old_trace,))
+        conn.execute(
+            'INSERT INTO cell_execs(trace, session, counter, source) '
+            'SELECT trace, session, counter, source FROM temp.staged_cell_execs'
+        )
+        conn.execute('DELETE FROM temp.staged_cell_execs')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return next_trace_id, counts
+
+
+def main(args, conn):
+    TEMP_DIR.mkdir(parents=True, exist_ok=True)
+    migrate(conn)
+    # set up the index (and its triggers) before ingesting so that new rows get indexed
+    ensure_source_index(conn)
+    sources = list_sources(args)
+    adopt_legacy_traces(conn, sources)
+    urls = select_urls_to_fetch(conn, sources, args)
+    next_trace_id = get_next_trace_id(conn, sources)
+    logger.info('%d of %d files to fetch or check for changes', len(urls), len(sources))
+    counts = collections.Counter()
+    num_new = 0
+    fetched = []
+    start_time = timer()
+
+    def _flush():
+        nonlocal fetched, next_trace_id
+        if len(fetched) == 0:
+            return
+        next_trace_id, batch_counts = import_traces(conn, fetched, next_trace_id)
+        counts.update(batch_counts)
+        counts['files'] += len(fetched)
+        fetched = []
+        elapsed = timer() - start_time
+        logger.info(
+            'processed %d files in %.1fs (%.1f traces/s, %.0f cells/s): %d imported, %d changed, '
+            '%d duplicates of existing traces, %d unchanged, %d failed',
+            counts['files'], elapsed, counts['files'] / max(elapsed, 1e-9), counts['cells'] / max(elapsed, 1e-9),
+            counts['imported'], counts['changed'], counts['deduplicated'], counts['unchanged'], counts['failed']
+        )
+
+    # fetches run ahead of the writer by at most a couple of batches, which bounds memory
+    max_in_flight = max(args.jobs, args.batch_size) * 2
+    urls = iter(urls)
+    in_flight = set()
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
         try:
-            subprocess.check_output(['wget', '-q', '-O', './data/temp/temp.sqlite', f'{entry["html_url"]}?raw=true'])
-            curse = conn.cursor()
-            curse.execute('attach "./data/temp/temp.sqlite" as t')
-            curse.execute(f"""
-INSERT INTO cell_execs
-SELECT {trace_id}, session, line AS counter, source
-FROM t.history""".strip())
-            conn.commit()
+            while True:
+                done = 0 < args.num_repos <= num_new
+                while not done and len(in_flight) < max_in_flight:
+                    url, known_hash = next(urls, (None, None))
+                    if url is None:
+                        break
+                    in_flight.add(executor.submit(fetch_trace, url, known_hash))
+                if done or len(in_flight) == 0:
+                    break
+                finished, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    url, content_hash, size, rows, error = future.result()
+                    fetched.append((url, content_hash, size, rows, error))
+                    # unchanged files and failures don't count towards --num-repos
+                    if rows is not None:
+                        num_new += 1
+                if len(fetched) >= args.batch_size:
+                    _flush()
         except KeyboardInterrupt:
-            break
-        except Exception as e:
-            logger.info("Exception while grabbing nb history for repo: %s", e)
-            continue
+            logger.info('interrupted; committing what has been fetched so far')
         finally:
-            try:
-                curse.execute('detach t')
-            except Exception as e:
-                logger.info("Exception while detaching from temp.sqlite: %s", e)
-            finally:
-                curse.close()
-                subprocess.check_call(['rm', '-f'] + glob.glob('./data/temp/*'))
-        successes += 1
-        if 0 < args.num_repos <= successes:
-            break
-    seen_traces = {'seen': sorted(seen_traces)}
-    with open('./data/seen-traces.json', 'w') as f:
-        f.write(json.dumps(seen_traces, indent=2))
+            for future in in_flight:
+                future.cancel()
+            _flush()
+    return 0
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Grab notebook traces from github')
-    parser.add_argument('--num-repos', type=int, default=DEFAULT_NUM_REPOS)
+    parser.add_argument(
+        '--num-repos', type=int, default=DEFAULT_NUM_REPOS, help='Stop after this many new or changed files (0 for all)'
+    )
+    parser.add_argument('--traces-json', default=TRACES_JSON)
+    parser.add_argument('--source-dir', help='Ingest every *.sqlite file in this directory instead (e.g. for testing)')
+    parser.add_argument('--recheck', action='store_true', help='Fetch already ingested files again to look for changes')
+    parser.add_argument('--retry-failed', action='store_true', help='Try files that failed before again')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help='Number of concurrent fetches')
+    parser.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Traces to import per write transaction'
+    )
     args = parser.parse_args()
-    conn = sqlite3.connect('./data/traces.sqlite')
+    conn = sqlite3.connect(TRACES_DB, timeout=30, isolation_level=None)
     try:
         sys.exit(main(args, conn))
     finally:
-        conn.commit()
         conn.close()
-        subprocess.check_call(['rm', '-f'] + glob.glob('./data/temp/*'))
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
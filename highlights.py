@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+
+class CellSet(object):
+    # Immutable set of cell ids stored as the bits of a python int. Cell ids are small and dense
+    # (they're handed out by a counter), so unions, differences and truncation are a handful of
+    # word-sized operations instead of a loop over every highlighted cell, and keeping the
+    # previous step's highlights around is just holding on to a reference.
+    __slots__ = ('bits',)
+
+    def __init__(self, cell_ids=(), bits=0):
+        for cell_id in cell_ids:
+            bits |= 1 << cell_id
+        self.bits = bits
+
+    def __contains__(self, cell_id):
+        return cell_id >= 0 and (self.bits >> cell_id) & 1 == 1
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __or__(self, other):
+        return CellSet(bits=self.bits | other.bits)
+
+    def __and__(self, other):
+        return CellSet(bits=self.bits & other.bits)
+
+    def __sub__(self, other):
+        return CellSet(bits=self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, CellSet) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return f'CellSet({sorted(self)})'
+
+    def before(self, position):
+        # the cells positioned strictly before `position`
+        if position <= 0:
+            return CellSet()
+        return CellSet(bits=self.bits & ((1 << position) - 1))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import ast
+import importlib.util
+import json
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+IMPORT_PROBE_SCRIPT = pathlib.Path(__file__).resolve()
+
+
+def _find_spec(name):
+    try:
+        return importlib.util.find_spec(name)
+    except (ImportError, ValueError, AttributeError):
+        return None
+
+
+def _rule_out(stmt):
+    # find_spec on a top-level name only looks at sys.path without importing anything, so a miss
+    # proves the statement can't work; anything deeper (submodules, names imported from modules,
+    # broken extension modules, ...) needs a real import to tell
+    if isinstance(stmt, ast.Import):
+        names = [alias.name for alias in stmt.names]
+    elif isinstance(stmt, ast.ImportFrom) and stmt.level == 0 and stmt.module is not None:
+        names = [stmt.module]
+    else:
+        return None
+    for name in names:
+        top_level = name.split('.')[0]
+        if top_level not in sys.modules and _find_spec(top_level) is None:
+            return f'ModuleNotFoundError: No module named {top_level!r}'
+    return None
+
+
+def probe_import(source):
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        return False, f'SyntaxError: {e}'
+    for stmt in tree.body:
+        error = _rule_out(stmt)
+        if error is not None:
+            return False, error
+    try:
+        exec(compile(tree, filename='<import probe>', mode='exec'), {})
+    except BaseException as e:  # noqa: some packages sys.exit() on import
+        return False, f'{e.__class__.__name__}: {e}'
+    return True, None
+
+
+def serve():
+    # one json list of import statements per line in, one json list of [ok, error] per line out;
+    # whatever the imported packages print goes to /dev/null instead of the protocol pipe
+    out = os.fdopen(os.dup(1), 'w')
+    devnull_fd = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull_fd, 1)
+    os.dup2(devnull_fd, 2)
+    for line in sys.stdin:
+        if line.strip() == '':
+            continue
+        results = [probe_import(source) for source in json.loads(line)]
+        out.write(json.dumps(results) + '\n')
+        out.flush()
+    return 0
+
+
+class ImportProbe(object):
+    # Long-lived worker process that checks whether import statements work. Modules it imports
+    # stay imported, so it has to be restarted whenever the environment changes (i.e. after a
+    # pip install), which `environment_changed` is for.
+    def __init__(self):
+        self._worker = None
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.poll() is None:
+            return self._worker
+        if self._worker is not None:
+            logger.warning('import probe exited with code %d; restarting', self._worker.returncode)
+        self._worker = subprocess.Popen(
+            [sys.executable, str(IMPORT_PROBE_SCRIPT)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+        return self._worker
+
+    def probe(self, import_stmts):
+        # returns one (ok, error) pair per statement source
+        import_stmts = list(import_stmts)
+        if len(import_stmts) == 0:
+            return []
+        worker = self._ensure_worker()
+        try:
+            worker.stdin.write(json.dumps(import_stmts) + '\n')
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+        except BrokenPipeError:
+            line = ''
+        if line == '':
+            # most likely an import that took the whole interpreter down; find out which one(s)
+            worker.wait()
+            if len(import_stmts) > 1:
+                return [result for import_stmt in import_stmts for result in self.probe([import_stmt])]
+            error = f'import probe exited with code {worker.returncode}'
+            logger.error('%s while probing %s', error, import_stmts[0])
+            return [(False, error)]
+        return [tuple(result) for result in json.loads(line)]
+
+    def environment_changed(self):
+        self.close()
+
+    def close(self):
+        if self._worker is None:
+            return
+        try:
+            self._worker.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._worker.wait()
+        self._worker = None
+
+
+_import_probe = None
+
+
+def get_import_probe():
+    global _import_probe
+    if _import_probe is None:
+        _import_probe = ImportProbe()
+    return _import_probe
+
+
+if __name__ == '__main__':
+    sys.exit(serve())
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import ast
+import collections
+import contextlib
+import hashlib
+import re
+
+from preprocessing import unwrap_cell
+
+# same lines nbsafety drops before parsing a cell
+_MAGIC_LINE_PATTERN = re.compile(r'(^%|^!|^cd |\?$)')
+# anything that can bind globals without naming them
+_OPAQUE_CALLS = {'exec', 'eval', 'globals', 'vars', 'setattr', '__import__'}
+_SYNTAX_ERROR = object()
+
+
+def _source_digest(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _bound_names(node):
+    bound = set()
+    for target in ast.walk(node):
+        if isinstance(target, ast.Name) and isinstance(target.ctx, (ast.Store, ast.Del)):
+            bound.add(target.id)
+        elif isinstance(target, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(target.name)
+        elif isinstance(target, (ast.Import, ast.ImportFrom)):
+            for alias in target.names:
+                bound.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(target, (ast.Global, ast.Nonlocal)):
+            bound.update(target.names)
+    return bound
+
+
+def _stmt_bindings(stmts):
+    names = set()
+    bindings = []
+    opaque = False
+    for stmt in stmts:
+        mentioned = set()
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Name):
+                mentioned.add(node.id)
+                opaque = opaque or node.id in _OPAQUE_CALLS
+            elif isinstance(node, ast.ImportFrom):
+                opaque = opaque or any(alias.name == '*' for alias in node.names)
+        bound = _bound_names(stmt)
+        names |= mentioned | bound
+        is_definition = isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        bindings.append((bound, mentioned - bound, is_definition))
+    return frozenset(names), bindings, opaque
+
+
+class CellNames(object):
+    # What a cell's symbols can depend on, from its source alone: every name it mentions anywhere
+    # (function bodies included), and for each top level statement, which names it binds from
+    # which other names, and whether it defines a function / class (calling one touches whatever
+    # its body mentions). `opaque` cells (star imports, exec and friends) can touch anything.
+    # The exception handler replay-session.py wraps every cell in is kept apart: its names
+    # (exception_counts, num_exceptions, e, ...) only change when the cell raised.
+    def __init__(self, source):
+        cell = ast.parse('\n'.join(
+            line for line in source.strip().split('\n') if _MAGIC_LINE_PATTERN.search(line) is None
+        ))
+        body, handler = unwrap_cell(cell)
+        self.names, self.bindings, self.opaque = _stmt_bindings(body)
+        if handler is None:
+            self.handler_names, self.handler_bindings = frozenset(), []
+        else:
+            self.handler_names, self.handler_bindings, _ = _stmt_bindings([handler])
+
+
+class IncrementalCheckerMismatch(Exception):
+    pass
+
+
+class IncrementalChecker(object):
+    # Wraps nbsafety's per-cell check (`_check_cell_and_resolve_symbols`: parse the cell, then
+    # resolve the symbols it reads and kills) with a cache, so that after each execution only the
+    # cells whose dependencies might have changed are parsed and resolved again. The stale /
+    # fresh / refresher aggregation in `check_and_link_multiple_cells` still sees every cell.
+    #
+    # A cached resolution is reused when the cell's source hash and dependency state match. The
+    # dependency state is a version per name the cell mentions; executing a cell bumps every name
+    # it mentions and, transitively, every name earlier cells bound from those (or, for functions
+    # and classes, that their bodies mention). Staleness itself moves without any rebinding, so it
+    # is always recomputed from the cached live symbols.
+    def __init__(self, safety):
+        self.safety = safety
+        self.hits = 0
+        self.misses = 0
+        self._check_cell = safety._check_cell_and_resolve_symbols
+        self._names_by_digest = {}
+        self._results_by_digest = {}
+        self._name_versions = collections.Counter()
+        self._dependents = collections.defaultdict(set)
+        self._generation = 0
+        self._enabled = False
+        safety._check_cell_and_resolve_symbols = self._cached_check_cell
+
+    def _cell_names(self, digest, source):
+        if digest not in self._names_by_digest:
+            try:
+                self._names_by_digest[digest] = CellNames(source)
+            except (SyntaxError, ValueError):
+                self._names_by_digest[digest] = None
+        return self._names_by_digest[digest]
+
+    def cell_executed(self, source, raised=False):
+        cell_names = self._cell_names(_source_digest(source), source)
+        if cell_names is None or cell_names.opaque:
+            # can't tell what it touched
+            self._generation += 1
+            return
+        names, bindings = cell_names.names, cell_names.bindings
+        if raised:
+            names = names | cell_names.handler_names
+            bindings = bindings + cell_names.handler_bindings
+        for bound, mentioned, is_definition in bindings:
+            for name in mentioned:
+                self._dependents[name] |= bound
+            if is_definition:
+                for name in bound:
+                    self._dependents[name] |= mentioned
+        dirty = set()
+        frontier = list(names)
+        while len(frontier) > 0:
+            name = frontier.pop()
+            if name in dirty:
+                continue
+            dirty.add(name)
+            frontier.extend(self._dependents.get(name, ()))
+        for name in dirty:
+            self._name_versions[name] += 1
+
+    def _dependency_state(self, cell_names, args):
+        return (
+            self._generation,
+            args,
+            tuple(self._name_versions[name] for name in sorted(cell_names.names | cell_names.handler_names)),
+        )
+
+    @staticmethod
+    def _with_fresh_staleness(result):
+        stale = {dsym for dsym in (result['live'] if isinstance(result, dict) else result.live) if dsym.is_stale}
+        if isinstance(result, dict):
+            return dict(result, stale=stale)
+        return result._replace(stale=stale)
+
+    def _cached_check_cell(self, cell, *args):
+        if not self._enabled or not isinstance(cell, str):
+            return self._check_cell(cell, *args)
+        digest = _source_digest(cell)
+        cell_names = self._cell_names(digest, cell)
+        if cell_names is None:
+            self.misses += 1
+            return self._check_cell(cell, *args)
+        state = self._dependency_state(cell_names, args)
+        cached_state, result = self._results_by_digest.get(digest, (None, None))
+        if cached_state == state:
+            self.hits += 1
+            if result is _SYNTAX_ERROR:
+                raise SyntaxError('cell does not parse')
+            return self._with_fresh_staleness(result)
+        self.misses += 1
+        try:
+            result = self._check_cell(cell, *args)
+        except SyntaxError:
+            self._results_by_digest[digest] = (state, _SYNTAX_ERROR)
+            raise
+        self._results_by_digest[digest] = (state, result)
+        return result
+
+    @contextlib.contextmanager
+    def _caching(self, enabled):
+        self._enabled = enabled
+        try:
+            yield
+        finally:
+            self._enabled = False
+
+    def check_and_link_multiple_cells(self, content_by_cell_id, order_index_by_cell_id=None, validate=False):
+        with self._caching(True):
+            result = self.safety.check_and_link_multiple_cells(
+                content_by_cell_id, order_index_by_cell_id=order_index_by_cell_id
+            )
+        if validate:
+            with self._caching(False):
+                expected = self.safety.check_and_link_multiple_cells(
+                    content_by_cell_id, order_index_by_cell_id=order_index_by_cell_id
+                )
+            for key in ('fresh_cells', 'stale_cells', 'refresher_links'):
+                if set(result[key]) != set(expected[key]):
+                    raise IncrementalCheckerMismatch(
+                        f'incremental checker disagrees on {key}: '
+                        f'got {sorted(result[key])}, expected {sorted(expected[key])}'
+                    )
+        return result
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import sqlite3
+import sys
+
+from schema import MIGRATIONS, benchmark_queries, get_schema_version, migrate
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+
+
+def get_benchmark_params(conn, args):
+    # some session from the middle of the table, so that lookups can't get lucky on the first page
+    row = conn.execute(
+        'SELECT trace, session FROM cell_execs WHERE rowid >= (SELECT max(rowid) / 2 FROM cell_execs) LIMIT 1'
+    ).fetchone()
+    trace, session = row if row is not None else (0, 0)
+    return dict(min_cells=args.min_cells, trace=trace, session=session, version=args.version)
+
+
+def log_benchmark(label, results):
+    for name, (elapsed, plan) in results.items():
+        logger.info('%s %s: %.1fms (%s)', label, name, 1000. * elapsed, '; '.join(plan))
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30, isolation_level=None)
+    try:
+        schema_version = get_schema_version(conn)
+        logger.info('schema version %d of %d', schema_version, len(MIGRATIONS))
+        before = None
+        if args.benchmark:
+            params = get_benchmark_params(conn, args)
+            before = benchmark_queries(conn, params, repeat=args.repeat)
+            log_benchmark('before', before)
+        logger.info('applied %d migration(s)', migrate(conn))
+        if args.benchmark:
+            after = benchmark_queries(conn, params, repeat=args.repeat)
+            log_benchmark('after', after)
+            for name, (elapsed, _) in after.items():
+                if name in before:
+                    logger.info(
+                        '%s: %.1fms -> %.1fms (%.1fx)',
+                        name, 1000. * before[name][0], 1000. * elapsed, before[name][0] / max(elapsed, 1e-9)
+                    )
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create / upgrade every table and index in traces.sqlite')
+    parser.add_argument('--benchmark', action='store_true', help='Time the hot queries before and after migrating')
+    parser.add_argument('--repeat', type=int, default=3, help='Report the best of this many runs of each query')
+    parser.add_argument('--min-cells', type=int, default=50, help='For the session selection benchmark')
+    parser.add_argument('-v', '--version', type=int, default=-1, help='For the already replayed benchmark')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+NOTEBOOK_METADATA = {
+    'kernelspec': {
+        'display_name': 'Python 3',
+        'language': 'python',
+        'name': 'python3',
+    },
+    'language_info': {
+        'name': 'python',
+    },
+}
+
+
+def make_code_cell(source, execution_count=None):
+    lines = source.split('\n')
+    return {
+        'cell_type': 'code',
+        'execution_count': execution_count,
+        'metadata': {},
+        'outputs': [],
+        'source': [line + '\n' for line in lines[:-1]] + [lines[-1]],
+    }
+
+
+def make_notebook(cells):
+    # cells are (counter, source) pairs; written as plain nbformat 4 json so that nothing has to
+    # round-trip through jupytext (or even import nbformat)
+    return {
+        'cells': [make_code_cell(source, execution_count=counter) for counter, source in cells],
+        'metadata': NOTEBOOK_METADATA,
+        'nbformat': 4,
+        'nbformat_minor': 4,
+    }
+
+
+def strip_cell_marker(cell_source):
+    # preprocessed cells start with the '# + Cell N' marker that jupytext used to split cells on
+    if cell_source.startswith('# + '):
+        return cell_source.partition('\n')[2]
+    return cell_source
+
+
+def write_notebook(path, cells):
+    with open(path, 'w') as f:
+        json.dump(make_notebook(cells), f, indent=1, ensure_ascii=False)
+        f.write('\n')
+
+
+def session_notebook_name(trace, session):
+    return f'trace-{trace}-session-{session}.ipynb'
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import logging
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from environments import (
+    DEFAULT_ENV_ROOT, DEFAULT_MAX_ENV_REQUIREMENTS, build_environment, cluster_sessions, get_known_pins,
+    get_session_requirements, get_unbuilt_environments, mark_environment_built, store_environment_plan
+)
+from preprocessing import gather_session_imports
+from source_cache import SOURCE_CACHE_DB
+from wheelhouse import get_wheelhouse_pip_args
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+
+
+def plan(conn, args):
+    cache_conn = sqlite3.connect(SOURCE_CACHE_DB, timeout=30)
+    try:
+        known_pins = get_known_pins(cache_conn)
+    finally:
+        cache_conn.close()
+    requirements_by_session = {
+        session: get_session_requirements(imports, known_pins)
+        for session, imports in gather_session_imports(conn, args.min_cells).items()
+    }
+    num_conflicting = sum(requirements is None for requirements in requirements_by_session.values())
+    clusters = cluster_sessions(requirements_by_session, max_requirements=args.max_requirements)
+    clusters.sort(key=lambda cluster: -len(cluster[2]))
+    for env_id, requirements, sessions in clusters:
+        logger.info('environment %s: %d sessions, %d requirements', env_id, len(sessions), len(requirements))
+        logger.debug('environment %s requirements: %s', env_id, ' '.join(requirements))
+    logger.info(
+        'planned %d environments for %d sessions; %d sessions have conflicting pins and will resolve at replay time',
+        len(clusters), len(requirements_by_session) - num_conflicting, num_conflicting
+    )
+    store_environment_plan(conn, clusters, args.env_root, requirements_by_session)
+
+
+def build(conn, args):
+    unbuilt = get_unbuilt_environments(conn)
+    logger.info('building %d environments', len(unbuilt))
+    start_time = timer()
+
+    pip_args = args.pip_args
+    if args.wheelhouse is not None:
+        pip_args += ' ' + get_wheelhouse_pip_args(args.wheelhouse)
+
+    def _build(env):
+        env_id, requirements, path = env
+        return env_id, build_environment(path, requirements, pip_args=pip_args)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for env_id, failed in executor.map(_build, unbuilt):
+            if len(failed) > 0:
+                logger.warning('environment %s built without: %s', env_id, ' '.join(failed))
+            mark_environment_built(conn, env_id, failed)
+    logger.info('built %d environments in %.1fs', len(unbuilt), timer() - start_time)
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    try:
+        if not args.build_only:
+            plan(conn, args)
+        if args.build or args.build_only:
+            build(conn, args)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Group sessions by dependencies and prebuild an environment per group')
+    parser.add_argument('--min-cells', type=int, default=50)
+    parser.add_argument(
+        '--max-requirements', type=int, default=DEFAULT_MAX_ENV_REQUIREMENTS,
+        help='Most packages to plan into one environment (sessions needing more get their own)'
+    )
+    parser.add_argument('--env-root', default=DEFAULT_ENV_ROOT, help='Where environments get built')
+    parser.add_argument('--build', action='store_true', help='Also build any planned environments not built yet')
+    parser.add_argument('--build-only', action='store_true', help='Build planned environments without replanning')
+    parser.add_argument('--pip-args', default='', help='Extra arguments for every pip install')
+    parser.add_argument('--wheelhouse', help='Build environments only from this local wheelhouse')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of environments to build in parallel')
+    args = parser.parse_args()
+    sys.exit(main(args))
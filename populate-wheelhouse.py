@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import logging
+import pathlib
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from preprocessing import gather_session_imports
+from wheelhouse import DEFAULT_WHEELHOUSE, add_to_wheelhouse, get_corpus_requirements
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    try:
+        requirements = get_corpus_requirements(gather_session_imports(conn, args.min_cells))
+    finally:
+        conn.close()
+    wheelhouse = pathlib.Path(args.wheelhouse)
+    wheelhouse.mkdir(parents=True, exist_ok=True)
+    logger.info('adding %d requirements to %s', len(requirements), wheelhouse)
+    start_time = timer()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        succeeded = list(executor.map(lambda req: add_to_wheelhouse(wheelhouse, req, args.pip_args), requirements))
+    failed = [requirement for requirement, ok in zip(requirements, succeeded) if not ok]
+    with open(wheelhouse.joinpath('unavailable.txt'), 'w') as f:
+        for requirement in failed:
+            f.write(requirement + '\n')
+    logger.info(
+        'wheelhouse has %d of %d requirements (%.1fs); the rest are listed in %s',
+        len(requirements) - len(failed), len(requirements), timer() - start_time, wheelhouse.joinpath('unavailable.txt')
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download wheels for everything the corpus imports')
+    parser.add_argument('--min-cells', type=int, default=50, help='Only look at sessions with at least this many cells')
+    parser.add_argument('--wheelhouse', default=DEFAULT_WHEELHOUSE)
+    parser.add_argument('--pip-args', default='', help='Extra arguments for pip wheel (e.g. an --index-url)')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of requirements to fetch in parallel')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+from timeit import default_timer as timer
+
+from preprocessing import (
+    PREPROCESS_VERSION, CellWrapper, Python2Converter, get_preprocessed_digests, get_session_keys,
+    get_session_sources, preprocess_session, session_source_digest, store_preprocessed_sessions
+)
+from source_cache import SOURCE_CACHE_DB
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACES_DB = './data/traces.sqlite'
+# sessions read, preprocessed and stored at a time
+STORE_BATCH_SIZE = 200
+
+converter = None
+cell_wrapper = None
+
+
+def init_worker(source_cache_db):
+    global converter
+    global cell_wrapper
+    converter = Python2Converter(db_path=source_cache_db)
+    cell_wrapper = CellWrapper(db_path=source_cache_db)
+
+
+def preprocess_one(item):
+    trace, session, digest, cell_sources = item
+    preprocessed = preprocess_session(cell_sources, converter, cell_wrapper)
+    # the replay loop only needs these; converted cells are recomputed if a session file is requested
+    del preprocessed['converted_cells']
+    del preprocessed['preprocess_times']
+    return trace, session, digest, preprocessed
+
+
+def iter_stale_chunks(conn, args, stats):
+    # sources are read one chunk of sessions at a time, and each read finishes before the chunk is
+    # stored (an open read cursor would keep the writes from committing), so memory stays bounded
+    # by the chunk rather than by the whole database
+    stored_digests = {} if args.force else get_preprocessed_digests(conn)
+    session_keys = get_session_keys(conn, args.min_cells)
+    for start in range(0, len(session_keys), STORE_BATCH_SIZE):
+        chunk = []
+        for trace, session in session_keys[start:start + STORE_BATCH_SIZE]:
+            stats['seen'] += 1
+            cell_sources = get_session_sources(conn, trace, session)
+            digest = session_source_digest(cell_sources)
+            if stored_digests.get((trace, session)) == digest:
+                stats['up_to_date'] += 1
+                continue
+            chunk.append((trace, session, digest, cell_sources))
+        if len(chunk) > 0:
+            yield chunk
+
+
+def main(args):
+    conn = sqlite3.connect(TRACES_DB, timeout=30)
+    stats = {'seen': 0, 'up_to_date': 0, 'preprocessed': 0}
+    start_time = timer()
+    source_cache_db = None if args.no_source_cache else SOURCE_CACHE_DB
+    try:
+        with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(source_cache_db,)) as pool:
+            for chunk in iter_stale_chunks(conn, args, stats):
+                batch = list(pool.imap_unordered(preprocess_one, chunk, chunksize=4))
+                store_preprocessed_sessions(conn, batch)
+                stats['preprocessed'] += len(batch)
+    finally:
+        conn.close()
+    logger.info(
+        'preprocessing version %s: %d sessions, %d already up to date, %d preprocessed in %.1fs',
+        PREPROCESS_VERSION, stats['seen'], stats['up_to_date'], stats['preprocessed'], timer() - start_time
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess sessions once so that replays can skip it')
+    parser.add_argument('--min-cells', type=int, default=50)
+    parser.add_argument('--force', action='store_true', help='Redo sessions even if their stored digest matches')
+    parser.add_argument('--no-source-cache', action='store_true', help='Do not use the persistent source cache')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of worker processes')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+import ast
+import copy
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+from timeit import default_timer as timer
+import warnings
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    try:
+        from lib2to3 import refactor
+    except ImportError:  # removed in python 3.13
+        refactor = None
+
+from ast_utils import FilenameExtractTransformer, GatherImports
+from schema import PREPROCESSED_SESSIONS_DDL
+from source_cache import SOURCE_CACHE_DB, SourceCache
+
+logger = logging.getLogger(__name__)
+
+# bump whenever wrap_cell_source / convert_python2_source would produce different output for the same input
+CELL_WRAPPER_VERSION = 1
+PYTHON2_CONVERTER_VERSION = 1
+# bump whenever preprocess_session changes in some other way
+SESSION_PREPROCESSOR_VERSION = 2
+PREPROCESS_VERSION = f'{SESSION_PREPROCESSOR_VERSION}.{PYTHON2_CONVERTER_VERSION}.{CELL_WRAPPER_VERSION}'
+
+IPYTHON_RE = re.compile(r'^(' + '|'.join([
+    r'get_ipython\(\)\.',
+    r'ip\.',
+    r'ipy\.',
+]) + r')')
+
+LINE_FILTER_RE = re.compile(r'^(' + '|'.join([
+    r'help\(',
+    r'pdb\.',
+    r'set_trace\(',
+    r'ipdb\.',
+]) + r')')
+
+# the names referenced here live in replay-session.py's (i.e., the ipython user) namespace
+EXCEPTION_HANDLER_SOURCE = """
+try:
+    pass
+except Exception as e:
+    exception_counts[e.__class__.__name__] += 1
+    num_exceptions += 1
+    should_test_prediction = False
+    import traceback
+    logger.error('An exception occurred: %s', e)
+    logger.error('%s', e.__class__.__name__)
+    logger.warning(traceback.format_exc())"""
+
+EXCEPTION_HANDLER_TEMPLATE = ast.parse(EXCEPTION_HANDLER_SOURCE)
+
+
+def filter_cell_lines(cell_source):
+    new_lines = []
+    num_non_comment_lines = 0
+    for line in cell_source.split('\n'):
+        stripped = line.strip()
+        match = IPYTHON_RE.match(stripped)
+        if match is not None:
+            if 'pylab' not in line and ('time' not in line or 'timedelta' in line):
+                continue
+        match = LINE_FILTER_RE.match(stripped)
+        if match is not None:
+            continue
+        if not stripped.startswith('#'):
+            num_non_comment_lines += 1
+        new_lines.append(line)
+    return new_lines, num_non_comment_lines
+
+
+def indent_lines(lines):
+    return '\n'.join('    ' + line for line in lines)
+
+
+def wrap_cell_source_textually(cell_source):
+    # only used for cells that don't parse, in which case ipython will report the syntax error anyway
+    return EXCEPTION_HANDLER_SOURCE.replace('    pass', indent_lines(cell_source.split('\n')), 1).strip()
+
+
+def wrap_cell_source(cell_source):
+    # unparsing can fail too (deeply nested expressions, some f-string / constant edge cases);
+    # either way the cell falls back to textual wrapping rather than failing the whole session
+    try:
+        body = ast.parse(cell_source).body
+        wrapper = copy.deepcopy(EXCEPTION_HANDLER_TEMPLATE)
+        wrapper.body[0].body = body or [ast.Pass()]
+        return ast.unparse(wrapper)
+    except (SyntaxError, ValueError, TypeError, RecursionError):
+        return wrap_cell_source_textually(cell_source)
+
+
+def unwrap_cell(tree):
+    # splits a wrap_cell_source'd cell into the statements it runs and the exception handler
+    # around them; cells that aren't wrapped come back as they are, with no handler
+    if len(tree.body) == 1 and isinstance(tree.body[0], ast.Try):
+        stmt = tree.body[0]
+        template = EXCEPTION_HANDLER_TEMPLATE.body[0]
+        if (
+            len(stmt.handlers) == 1 and not stmt.orelse and not stmt.finalbody
+            and ast.dump(stmt.handlers[0]) == ast.dump(template.handlers[0])
+        ):
+            return stmt.body, stmt.handlers[0]
+    return tree.body, None
+
+
+class CellWrapper(object):
+    def __init__(self, db_path=SOURCE_CACHE_DB):
+        self.cache = SourceCache('cell_wrapper', CELL_WRAPPER_VERSION, db_path=db_path)
+
+    def wrap(self, cell_source):
+        return self.cache.get_or_compute(cell_source, wrap_cell_source)
+
+    def close(self):
+        self.cache.close()
+
+
+def parses_as_python3(source):
+    try:
+        ast.parse(source)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+_refactoring_tool = None
+
+
+def _get_refactoring_tool():
+    global _refactoring_tool
+    if _refactoring_tool is None:
+        # same fixers that `2to3 -w -n` applies by default
+        _refactoring_tool = refactor.RefactoringTool(refactor.get_fixers_from_package('lib2to3.fixes'))
+    return _refactoring_tool
+
+
+def convert_python2_source(source):
+    if refactor is None:
+        return source
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            converted = str(_get_refactoring_tool().refactor_string(source + '\n', '<cell>'))
+        except Exception:  # noqa
+            # lib2to3 can't parse it either (ipython magics, genuinely broken code, ...)
+            return source
+    return converted[:-1] if converted.endswith('\n') else converted
+
+
+class Python2Converter(object):
+    # only cells that don't already parse as python 3 go through 2to3 (which would otherwise
+    # happily rewrite e.g. print(a, b) into print((a, b)))
+    def __init__(self, db_path=SOURCE_CACHE_DB):
+        self.cache = SourceCache('2to3', PYTHON2_CONVERTER_VERSION, db_path=db_path)
+        self.num_converted = 0
+        if refactor is None:
+            logger.warning('lib2to3 unavailable; python 2 cells will be run unconverted')
+
+    def convert(self, source):
+        if parses_as_python3(source):
+            return source
+        self.num_converted += 1
+        return self.cache.get_or_compute(source, convert_python2_source)
+
+    def close(self):
+        self.cache.close()
+
+
+def session_source_digest(cell_sources):
+    return hashlib.sha1(json.dumps(cell_sources).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def preprocess_session(cell_sources, converter, cell_wrapper):
+    # everything deterministic that happens to a session's sources before replay; returns the cells
+    # to run as [counter, source to match against earlier cells, wrapped source to execute]
+    converted_cells = []
+    cells = []
+    preprocess_times = []
+    for idx, cell_source in enumerate(cell_sources):
+        start_time = timer()
+        cell_marker = f'# + Cell {idx + 1}'
+        cell_source = converter.convert(cell_source).rstrip()
+        converted_cells.append(f'{cell_marker}\n{cell_source}'.strip())
+        lines, num_non_comment_lines = filter_cell_lines(cell_source)
+        cell_source = '\n'.join(lines)
+        if cell_source.strip() == '' or num_non_comment_lines == 0:
+            continue
+        # the marker goes on after wrapping, so that the wrapper cache is keyed on the cell alone
+        # and the same cell hits it no matter where in a session it runs
+        wrapped_source = cell_wrapper.wrap(cell_source)
+        cells.append([idx + 1, indent_lines([cell_marker] + lines), f'{cell_marker}\n{wrapped_source}'])
+        preprocess_times.append(timer() - start_time)
+    import_gatherer = GatherImports()
+    filename_extractor = FilenameExtractTransformer()
+    for cell_source in converted_cells:
+        try:
+            tree = ast.parse(cell_source)
+        except (SyntaxError, ValueError):
+            continue
+        import_gatherer.visit(tree)
+        filename_extractor.visit(tree)
+    return {
+        'converted_cells': converted_cells,
+        'cells': cells,
+        'imports': [[ast.unparse(stmt), list(pkg_names)] for stmt, pkg_names in import_gatherer.import_stmts],
+        'file_names': sorted(filename_extractor.file_names),
+        'preprocess_times': preprocess_times,
+    }
+
+
+def get_import_stmts(preprocessed):
+    return [(ast.parse(stmt_source).body[0], tuple(pkg_names)) for stmt_source, pkg_names in preprocessed['imports']]
+
+
+def load_preprocessed_session(conn, trace, session):
+    try:
+        row = conn.execute("""
+SELECT cells, imports, file_names FROM preprocessed_sessions
+WHERE trace = ? AND session = ? AND preprocess_version = ?""", (trace, session, PREPROCESS_VERSION)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if row is None:
+        return None
+    cells, imports, file_names = map(json.loads, row)
+    return {'cells': cells, 'imports': imports, 'file_names': file_names, 'preprocess_times': [0.] * len(cells)}
+
+
+def get_preprocessed_digests(conn):
+    conn.execute(PREPROCESSED_SESSIONS_DDL)
+    return {
+        (trace, session): digest for trace, session, digest in conn.execute(
+            'SELECT trace, session, source_digest FROM preprocessed_sessions WHERE preprocess_version = ?',
+            (PREPROCESS_VERSION,)
+        )
+    }
+
+
+def store_preprocessed_sessions(conn, rows):
+    # rows are (trace, session, source_digest, preprocessed); entries from older versions are dropped
+    with conn:
+        conn.execute(PREPROCESSED_SESSIONS_DDL)
+        conn.executemany(
+            'DELETE FROM preprocessed_sessions WHERE trace = ? AND session = ?',
+            [(trace, session) for trace, session, _, _ in rows]
+        )
+        conn.executemany("""
+INSERT INTO preprocessed_sessions(trace, session, preprocess_version, source_digest, cells, imports, file_names)
+VALUES (?, ?, ?, ?, ?, ?, ?)""", [
+            (
+                trace, session, PREPROCESS_VERSION, digest, json.dumps(preprocessed['cells']),
+                json.dumps(preprocessed['imports']), json.dumps(preprocessed['file_names'])
+            )
+            for trace, session, digest, preprocessed in rows
+        ])
+
+
+def get_session_keys(conn, min_cells):
+    return conn.execute("""
+SELECT trace, session
+FROM cell_execs
+GROUP BY trace, session
+HAVING count(*) >= ?
+ORDER BY trace, session""", (min_cells,)).fetchall()
+
+
+def get_session_sources(conn, trace, session):
+    rows = conn.execute(
+        'SELECT source FROM cell_execs WHERE trace = ? AND session = ? ORDER BY counter', (trace, session)
+    ).fetchall()
+    return [source for source, in rows]
+
+
+def get_preprocessed_imports(conn):
+    try:
+        rows = conn.execute(
+            'SELECT trace, session, imports FROM preprocessed_sessions WHERE preprocess_version = ?',
+            (PREPROCESS_VERSION,)
+        )
+        return {(trace, session): json.loads(imports) for trace, session, imports in rows}
+    except sqlite3.OperationalError:
+        return {}
+
+
+def gather_session_imports(conn, min_cells, db_path=SOURCE_CACHE_DB):
+    # (trace, session) -> [import stmt source, [top-level names]] for every session with at least
+    # min_cells cells, preferring what preprocess-sessions.py stored over preprocessing here; only
+    # the sessions that aren't stored get their sources read, one session at a time
+    converter = Python2Converter(db_path=db_path)
+    cell_wrapper = CellWrapper(db_path=db_path)
+    stored_imports = get_preprocessed_imports(conn)
+    imports_by_session = {}
+    num_preprocessed = 0
+    try:
+        for trace, session in get_session_keys(conn, min_cells):
+            imports = stored_imports.get((trace, session))
+            if imports is None:
+                num_preprocessed += 1
+                imports = preprocess_session(
+                    get_session_sources(conn, trace, session), converter, cell_wrapper
+                )['imports']
+            imports_by_session[trace, session] = imports
+    finally:
+        converter.close()
+        cell_wrapper.close()
+    logger.info(
+        'gathered imports for %d sessions (%d not in the preprocessed store)', len(imports_by_session), num_preprocessed
+    )
+    return imports_by_session
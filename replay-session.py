@@ -1,32 +1,44 @@
 #!/usr/bin/env ipython3
 # -*- coding: utf-8 -*-
 import argparse
-import ast
-import black
 import collections
 import contextlib
+import importlib
+import json
 import logging
 import numpy
 import numpy as np
 import os
-import re
-import subprocess
+import shlex
 import sqlite3
+import struct
 import sys
 from timeit import default_timer as timer
 
 
 from IPython import get_ipython
 
-try:
-    from cfuzzyset import cFuzzySet as FuzzySet
-except ImportError:
-    from fuzzyset import FuzzySet
-
-from ast_utils import FilenameExtractTransformer, GatherImports
-from replay_stats_group import ReplayStatsGroup
+from ast_utils import FilenameExtractTransformer
+from cell_matching import CELL_MATCHERS, MATCHING_CELL_THRESHOLD, make_cell_matcher
+from cell_stats import make_cell_stats_row
+from highlights import CellSet
+from import_probe import get_import_probe
+from incremental_checker import IncrementalChecker
+from notebook_export import session_notebook_name, strip_cell_marker, write_notebook
+from preprocessing import (
+    PREPROCESS_VERSION, CellWrapper, Python2Converter, get_import_stmts, load_preprocessed_session, preprocess_session
+)
+from replay_stats_group import ANALYTIC_BASELINE, DEFAULT_NUM_BASELINE_SAMPLES, RANDOM_BASELINES, ReplayStatsGroup
+from resource_accounting import MemoryWatchdog, ResourceAccountant
+from resolution_cache import ImportResolutionCache
 from resolvers import PipResolver
-from timeout import timeout
+from result_sink import make_result_sink, make_session_results
+from session_pack import SessionPack
+from source_cache import SOURCE_CACHE_DB
+from timeout import (
+    DEFAULT_CELL_RUNTIME_MULTIPLIER, DEFAULT_CELL_SECONDS, DEFAULT_MIN_CELL_SECONDS, TimeoutEngine
+)
+from wheelhouse import get_wheelhouse_pip_args
 
 logger = logging.getLogger(__name__)
 
@@ -38,26 +50,11 @@ class IdentityDict(dict):
         return self[x]
 
 
-CELL_ID_BY_SOURCE = {}
-MATCHING_CELL_THRESHOLD = 0.8
-EXECUTED_CELLS = FuzzySet()
-
-IPYTHON_RE = re.compile(r'^(' + '|'.join([
-    r'get_ipython\(\)\.',
-    r'ip\.',
-    r'ipy\.',
-]) + r')')
-
-LINE_FILTER_RE = re.compile(r'^(' + '|'.join([
-    r'help\(',
-    r'pdb\.',
-    r'set_trace\(',
-    r'ipdb\.',
-]) + r')')
+TRACES_DB = './data/traces.sqlite'
+cell_matcher = None
 
 
-@timeout(15)
-def timeout_run_cell(cell_id, cell_source, safety=None):
+def run_cell(cell_id, cell_source, safety=None):
     if safety is None:
         get_ipython().run_cell(cell_source, silent=True)
         return False
@@ -68,6 +65,11 @@ def timeout_run_cell(cell_id, cell_source, safety=None):
 
 
 def setup_logging(log_to_stderr=True, prefix='session'):
+    # forked sessions set up logging again, so first drop any handlers left over from the parent
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        logging.root.removeHandler(old_handler)
+        old_handler.close()
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
@@ -170,31 +172,14 @@ def redirect_std_streams_to(redirect_fname):
 
 
 def get_cell_id_for_source(source):
-    match = EXECUTED_CELLS.get(source)
-    if match is None:
-        score, old_source = -1, None
-    else:
-        score, old_source = match[0]
-    if score >= MATCHING_CELL_THRESHOLD:
-        cell_id = CELL_ID_BY_SOURCE[old_source]
-    else:
-        cell_id = get_new_cell_id()
-    CELL_ID_BY_SOURCE[source] = cell_id
-    EXECUTED_CELLS.add(source)
-    return cell_id
+    return cell_matcher.get_cell_id(source)
 
 
-def resolve_packages(cell_submissions):
-    import_gatherer = GatherImports()
-    for cell_source in cell_submissions:
-        try:
-            import_gatherer.visit(ast.parse(cell_source))
-        except SyntaxError:
-            continue
+def resolve_packages(import_stmts, resolution_cache=None, pip_args=''):
     success_packages = []
     failed_packages = []
     imports_by_pkg = collections.defaultdict(list)
-    for import_stmt, pkg_names in import_gatherer.import_stmts:
+    for import_stmt, pkg_names in import_stmts:
         for pkg in pkg_names:
             imports_by_pkg[pkg].append(import_stmt)
     for pkg, import_stmts in imports_by_pkg.items():
@@ -202,43 +187,79 @@ def resolve_packages(cell_submissions):
         if pkg == 'readline':
             continue
         logger.info('resolving package %s...', pkg)
-        resolver = PipResolver(pkg, import_stmts)
+        resolver = PipResolver(pkg, import_stmts, cache=resolution_cache, pip_args=pip_args)
         if resolver.resolve():
             success_packages.append(pkg)
         else:
             failed_packages.append(pkg)
+    # anything the probe imported would otherwise stay resident for the rest of the session
+    get_import_probe().close()
     for pkg in success_packages:
         logger.info('resolving package %s succeeded', pkg)
     for pkg in failed_packages:
         logger.info('resolving package %s failed', pkg)
 
 
-def resolve_files(cell_submissions):
-    filename_extractor = FilenameExtractTransformer()
-    for cell_source in cell_submissions:
-        try:
-            filename_extractor.visit(ast.parse(cell_source))
-        except SyntaxError:
-            continue
-    return filename_extractor
-
-
 # these are accessed in ipython context and so need to be defined here
 num_exceptions = 0
 exception_counts = collections.Counter()
 should_test_prediction = True
 
 
-def discard_highlights_after_position(highlight_set, pos_idx):
-    to_discard = []
-    for cell_id in highlight_set:
-        if cell_id >= pos_idx:
-            to_discard.append(cell_id)
-    for cell_id in to_discard:
-        highlight_set.discard(cell_id)
+ipython_warmed_up = False
+
+
+def warm_up_ipython(use_nbsafety):
+    global ipython_warmed_up
+    if ipython_warmed_up:
+        return
+    get_ipython().run_line_magic('matplotlib', 'inline')
+    get_ipython().run_cell('import numpy as np', silent=True)
+    get_ipython().run_cell('import pandas as pd', silent=True)
+    if use_nbsafety:
+        importlib.import_module('nbsafety.safety')
+    ipython_warmed_up = True
 
 
 def main(args, conn):
+    global cell_matcher
+    cell_matcher = make_cell_matcher(args.cell_matcher, get_new_cell_id, threshold=MATCHING_CELL_THRESHOLD)
+    accountant = ResourceAccountant()
+    result_sink = make_result_sink(args.result_sink, TRACES_DB)
+
+    def _write_resource_stats_before_exit(memory_cap_exceeded=False):
+        if args.no_stats_logging:
+            return
+        result_sink.write(make_session_results(
+            args.version, args.trace, args.session,
+            resource_stats=accountant.make_rows(
+                args.version, args.trace, args.session, memory_cap_exceeded=memory_cap_exceeded
+            ),
+        ))
+
+    memory_watchdog = None
+    if args.max_memory_mb is not None:
+        memory_watchdog = MemoryWatchdog(
+            args.max_memory_mb * 1024 * 1024, lambda: _write_resource_stats_before_exit(memory_cap_exceeded=True)
+        )
+        memory_watchdog.start()
+    timeouts = TimeoutEngine(
+        cell_seconds=args.cell_timeout,
+        adaptive=args.adaptive_cell_timeout,
+        min_cell_seconds=args.min_cell_timeout,
+        runtime_multiplier=args.cell_timeout_multiplier,
+        session_seconds=args.session_timeout,
+        on_stuck=_write_resource_stats_before_exit,
+    )
+    try:
+        return replay_session(args, conn, accountant, timeouts, result_sink)
+    finally:
+        timeouts.close()
+        if memory_watchdog is not None:
+            memory_watchdog.stop()
+
+
+def replay_session(args, conn, accountant, timeouts, result_sink):
     global num_exceptions
     global should_test_prediction
     if args.forward_only_propagation:
@@ -248,61 +269,91 @@ def main(args, conn):
     tracer_time = 0.
     checker_time = 0.
     conn.execute("PRAGMA read_uncommitted = true;")
-    cell_submissions = conn.execute(f"""
+    write_session_files = args.write_session_file or args.write_session_ipynb
+    preprocessed = None
+    if not args.no_preprocessed_store and not write_session_files:
+        preprocessed = load_preprocessed_session(conn, args.trace, args.session)
+    if preprocessed is None:
+        cell_submissions = None
+        if args.session_pack is not None:
+            pack = SessionPack(args.session_pack)
+            try:
+                if (args.trace, args.session) in pack:
+                    cell_submissions = [source for _, source in pack.get_session(args.trace, args.session)]
+                else:
+                    logger.warning('session not in %s; reading it from cell_execs', args.session_pack)
+            finally:
+                pack.close()
+        if cell_submissions is None:
+            cell_submissions = conn.execute(f"""
 SELECT source FROM cell_execs
 WHERE trace = {args.trace} AND session = {args.session}
 ORDER BY counter ASC
     """).fetchall()
-    cell_submissions = list(map(lambda t: t[0], cell_submissions))
-
-    session_fname = f'trace-{args.trace}-session-{args.session}.py'
-    with open(session_fname, 'w') as f:
-        for idx, cell in enumerate(cell_submissions):
-            f.write(f'# + Cell {idx + 1}\n')
-            f.write(cell)
-            f.write('\n\n')
-
-    with open('/dev/null', 'w') as devnull:
-        subprocess.call(f'2to3 {session_fname} -w -n', shell=True, stdout=devnull, stderr=subprocess.STDOUT)
+            cell_submissions = list(map(lambda t: t[0], cell_submissions))
+        with accountant.phase('conversion'):
+            source_cache_db = None if args.no_source_cache else SOURCE_CACHE_DB
+            converter = Python2Converter(db_path=source_cache_db)
+            cell_wrapper = CellWrapper(db_path=source_cache_db)
+            preprocessed = preprocess_session(cell_submissions, converter, cell_wrapper)
+            logger.info(
+                'Converted %d of %d cells from python 2 (%d cache hits); %d wrapper cache hits, %d misses',
+                converter.num_converted, len(cell_submissions), converter.cache.hits,
+                cell_wrapper.cache.hits, cell_wrapper.cache.misses
+            )
+            converter.close()
+            cell_wrapper.close()
+    else:
+        logger.info('Loaded preprocessed session (preprocessing version %s)', PREPROCESS_VERSION)
 
-    with open(session_fname) as f:
-        cell_submissions = f.read().split('# + Cell ')
-        cell_submissions = map(lambda cell: cell.strip(), cell_submissions)
-        cell_submissions = filter(lambda cell: len(cell) > 0, cell_submissions)
-        cell_submissions = map(lambda cell: '# + Cell ' + cell, cell_submissions)
-        cell_submissions = list(cell_submissions)
+    if args.write_session_file:
+        with open(f'trace-{args.trace}-session-{args.session}.py', 'w') as f:
+            for cell in preprocessed['converted_cells']:
+                f.write(cell)
+                f.write('\n\n')
 
     if args.write_session_ipynb:
-        with open('/dev/null', 'w') as devnull:
-            subprocess.call(
-                f'jupytext --to ipynb {session_fname} --output {os.path.splitext(session_fname)[0]}.ipynb',
-                shell=True, stdout=devnull, stderr=subprocess.STDOUT
-            )
-
-    if not args.write_session_file:
-        os.remove(session_fname)
+        write_notebook(
+            session_notebook_name(args.trace, args.session),
+            [(idx + 1, strip_cell_marker(cell)) for idx, cell in enumerate(preprocessed['converted_cells'])]
+        )
 
     if args.write_session_ipynb:
         return 0
 
-    filename_extractor = resolve_files(cell_submissions)
     if args.just_log_files:
-        for fname in filename_extractor.file_names:
+        for fname in preprocessed['file_names']:
             logger.info(fname)
         return 0
 
-    resolve_packages(cell_submissions)
+    if args.no_package_resolution:
+        logger.info('skipping package resolution; running in prebuilt environment %s', sys.prefix)
+    else:
+        with accountant.phase('package_resolution'):
+            resolution_cache = None if args.no_resolution_cache else ImportResolutionCache(db_path=SOURCE_CACHE_DB)
+            pip_args = '' if args.wheelhouse is None else get_wheelhouse_pip_args(args.wheelhouse)
+            resolve_packages(get_import_stmts(preprocessed), resolution_cache=resolution_cache, pip_args=pip_args)
+            if resolution_cache is not None:
+                logger.info(
+                    'import resolution cache: %d hits, %d misses', resolution_cache.hits, resolution_cache.misses
+                )
+                resolution_cache.close()
     if args.just_log_imports:
         return 0
 
+    random_baseline_kwargs = dict(
+        random_baseline=args.random_baseline,
+        num_samples=args.random_baseline_samples,
+        seed=(args.random_baseline_seed, args.trace, args.session),
+    )
     next_stats = ReplayStatsGroup('next_cell')
-    random_stats = ReplayStatsGroup('random_cell')
+    random_stats = ReplayStatsGroup('random_cell', **random_baseline_kwargs)
     live_stats = ReplayStatsGroup('live_cells')
     new_live_stats = ReplayStatsGroup('new_live_cells')
     new_or_refresher_stats = ReplayStatsGroup('new_or_refresher_cells')
     refresher_stats = ReplayStatsGroup('refresher_cells')
     new_refresher_stats = ReplayStatsGroup('new_refresher_cells')
-    random_like_new_refresher_stats = ReplayStatsGroup('random_like_new_refresher_cells')
+    random_like_new_refresher_stats = ReplayStatsGroup('random_like_new_refresher_cells', **random_baseline_kwargs)
     stale_stats = ReplayStatsGroup('stale_cells')
     new_stale_stats = ReplayStatsGroup('new_stale_cells')
     all_stats_groups = [
@@ -319,16 +370,14 @@ ORDER BY counter ASC
     ]
 
     prev_cell_id = None
-    live_cells = set()
-    stale_cells = set()
-    refresher_cells = set()
-    prev_stale_cells = set()
-    prev_live_cells = set()
-    prev_refresher_cells = set()
-
-    get_ipython().run_line_magic('matplotlib', 'inline')
-    get_ipython().run_cell('import numpy as np', silent=True)
-    get_ipython().run_cell('import pandas as pd', silent=True)
+    live_cells = CellSet()
+    stale_cells = CellSet()
+    refresher_cells = CellSet()
+    prev_stale_cells = CellSet()
+    prev_live_cells = CellSet()
+    prev_refresher_cells = CellSet()
+
+    warm_up_ipython(args.use_nbsafety)
     if args.use_nbsafety:
         import nbsafety.safety
         safety = nbsafety.safety.NotebookSafety(cell_magic_name='_NBSAFETY_STATE', skip_unsafe=False, store_history=False)
@@ -339,49 +388,36 @@ ORDER BY counter ASC
         # get_ipython().run_line_magic('safety', 'trace_messages enable')
     else:
         safety = None
+    incremental_checker = None
+    if safety is not None and (args.incremental_checker or args.validate_incremental_checker):
+        incremental_checker = IncrementalChecker(safety)
     # get_ipython().ast_transformers.extend([ExceptionWrapTransformer(), filename_extractor])
-    get_ipython().ast_transformers.extend([filename_extractor])
+    get_ipython().ast_transformers.extend([FilenameExtractTransformer()])
     num_safety_errors = 0
     exec_count_orig = 0
     exec_count_replay = 0
     exec_count_replay_successes = 0
     notebook_state = {}
-    for cell_source in cell_submissions:
-        lines = cell_source.split('\n')
-        new_lines = []
-        exec_count_orig += 1
-        num_non_comment_lines = 0
-        for line in lines:
-            stripped = line.strip()
-            match = IPYTHON_RE.match(stripped)
-            if match is not None:
-                if 'pylab' not in line and ('time' not in line or 'timedelta' in line):
-                    continue
-            match = LINE_FILTER_RE.match(stripped)
-            if match is not None:
-                continue
-            if not stripped.startswith('#'):
-                num_non_comment_lines += 1
-            new_lines.append('    ' + line)
-        cell_source = '\n'.join(new_lines)
-        if cell_source.strip() == '' or num_non_comment_lines == 0:
-            continue
-        cell_id = get_cell_id_for_source(cell_source)
-        cell_source = f"""
-try:
-{cell_source}
-except Exception as e:
-    exception_counts[e.__class__.__name__] += 1
-    num_exceptions += 1
-    should_test_prediction = False
-    import traceback
-    logger.error('An exception occurred: %s', e)
-    logger.error('%s', e.__class__.__name__)
-    logger.warning(traceback.format_exc())""".strip()
-        try:
-            cell_source = black.format_file_contents(cell_source, fast=False, mode=black.FileMode())
-        except:  # noqa
-            pass
+    preprocess_time = 0.
+    session_abandoned = False
+    cell_stats_rows = []
+    for (exec_count_orig, match_source, cell_source), cell_preprocess_time in zip(
+        preprocessed['cells'], preprocessed['preprocess_times']
+    ):
+        if timeouts.session_budget_exceeded() or (
+            args.max_timeouts is not None and timeouts.num_timeouts >= args.max_timeouts
+        ):
+            logger.error(
+                'Abandoning session before cell counter %d: %d cell timeouts, %.1fs elapsed',
+                exec_count_orig, timeouts.num_timeouts, timer() - timeouts.session_start_time
+            )
+            session_abandoned = True
+            break
+        start_time = timer()
+        cell_id = get_cell_id_for_source(match_source)
+        cell_preprocess_time += timer() - start_time
+        preprocess_time += cell_preprocess_time
+        logger.info('Preprocessed cell %d in %.2fms', cell_id, 1000. * cell_preprocess_time)
         logger.info('About to run cell %d (cell counter %d)', cell_id, exec_count_orig)
 
         if 'os.path.join' in cell_source and 'IMDb' not in cell_source:
@@ -389,17 +425,22 @@ except Exception as e:
         this_cell_had_safety_errors = False
         should_test_prediction = True
         num_safety_errors += (cell_id in stale_cells)
+        num_exceptions_before = num_exceptions
+        num_timeouts_before = timeouts.num_timeouts
+        start_time = timer()
         try:
             exec_count_replay += 1
 
-            start_time = timer()
-            this_cell_had_safety_errors = timeout_run_cell(cell_id, cell_source, safety=safety)
+            with accountant.phase('execution'):
+                with timeouts.cell():
+                    this_cell_had_safety_errors = run_cell(cell_id, cell_source, safety=safety)
             tracer_time += timer() - start_time
         except Exception as outer_e:
             exception_counts[outer_e.__class__.__name__] += 1
             num_exceptions += 1
             should_test_prediction = False
         finally:
+            cell_run_time = timer() - start_time
             exec_count_replay_successes += should_test_prediction
             os.path.join = os_path_join
 
@@ -425,26 +466,51 @@ except Exception as e:
                     stale_stats.update(cell_id, stale_cells, num_available_cells)
                     new_stale_stats.update(cell_id, stale_cells - prev_stale_cells, num_available_cells)
 
-        prev_stale_cells = set(stale_cells)
-        prev_live_cells = set(live_cells)
-        prev_refresher_cells = set(refresher_cells)
+        prev_stale_cells = stale_cells
+        prev_live_cells = live_cells
+        prev_refresher_cells = refresher_cells
         assert cell_id is not None
         notebook_state[cell_id] = cell_source
+        if incremental_checker is not None:
+            incremental_checker.cell_executed(cell_source, raised=num_exceptions > num_exceptions_before)
+        cell_checking_time = None
         if safety is not None:
-            for highlight_set in (live_cells, stale_cells, refresher_cells):
-                discard_highlights_after_position(highlight_set, cell_id)
+            live_cells = live_cells.before(cell_id)
+            stale_cells = stale_cells.before(cell_id)
+            refresher_cells = refresher_cells.before(cell_id)
             # logger.info('active pos: %d', safety.active_cell_position_idx)
             start_time = timer()
-            precheck = safety.check_and_link_multiple_cells(notebook_state, order_index_by_cell_id=cell_order_idx)
-            checker_time += timer() - start_time
-            live_cells |= set(precheck['fresh_cells'])
+            with accountant.phase('checking'):
+                if incremental_checker is None:
+                    precheck = safety.check_and_link_multiple_cells(
+                        notebook_state, order_index_by_cell_id=cell_order_idx
+                    )
+                else:
+                    precheck = incremental_checker.check_and_link_multiple_cells(
+                        notebook_state, order_index_by_cell_id=cell_order_idx,
+                        validate=args.validate_incremental_checker
+                    )
+            cell_checking_time = timer() - start_time
+            checker_time += cell_checking_time
+            live_cells |= CellSet(precheck['fresh_cells'])
             # logger.info('live cells: %s', live_cells)
-            stale_cells |= set(precheck['stale_cells'])
+            stale_cells |= CellSet(precheck['stale_cells'])
             # logger.info('stale cells: %s', stale_cells)
-            refresher_cells |= set(precheck['refresher_links'].keys())
+            refresher_cells |= CellSet(precheck['refresher_links'].keys())
             # logger.info('refresher cells: %s', refresher_cells)
+        cell_stats_rows.append(make_cell_stats_row(
+            args.version, args.trace, args.session, exec_count_replay, cell_id, exec_count_orig, match_source,
+            cell_preprocess_time, cell_run_time, cell_checking_time, traced=safety is not None,
+            raised=num_exceptions > num_exceptions_before, timed_out=timeouts.num_timeouts > num_timeouts_before,
+        ))
         prev_cell_id = cell_id
 
+    logger.info('Spent %.1fms preprocessing cells', 1000. * preprocess_time)
+    logger.info('%d cell(s) timed out', timeouts.num_timeouts)
+    if incremental_checker is not None:
+        logger.info(
+            'incremental checker: %d cell checks reused, %d redone', incremental_checker.hits, incremental_checker.misses
+        )
     if num_safety_errors > 0:
         logger.error('Session had %d safety errors!', num_safety_errors)
     else:
@@ -465,41 +531,109 @@ except Exception as e:
         tracer_time=tracer_time,
         checker_time=checker_time,
         wall_time=tracer_time + checker_time,
+        num_timeouts=timeouts.num_timeouts,
+        session_abandoned=int(session_abandoned),
     )
     for stats_group in all_stats_groups:
         upsert_row.update(stats_group.make_dict())
-    sql = f"""
-    INSERT OR REPLACE INTO replay_stats({','.join(upsert_row.keys())})
-    VALUES ({','.join(repr(v) for v in upsert_row.values())})
-    """
-    logger.warning(sql)
-    with conn:
-        conn.execute(sql)
-    sql = f'DELETE FROM replay_exception_stats WHERE trace={args.trace} AND session={args.session}'
-    logger.warning(sql)
-    with conn:
-        conn.execute(sql)
-        for exc_name, exc_count in exception_counts.items():
-            upsert_row = dict(
-                trace=args.trace,
-                session=args.session,
-                exception=exc_name,
-                count=exc_count
-            )
-            sql = f"""
-            INSERT INTO replay_exception_stats({','.join(upsert_row.keys())})
-            VALUES ({','.join(repr(v) for v in upsert_row.values())})
-            """
-            logger.warning(sql)
-            conn.execute(sql)
+    start_time = timer()
+    result_sink.write(make_session_results(
+        args.version, args.trace, args.session,
+        replay_stats=upsert_row,
+        exception_counts=exception_counts,
+        resource_stats=accountant.make_rows(args.version, args.trace, args.session),
+        cell_stats=cell_stats_rows,
+    ))
+    logger.info('Handed off session results in %.1fms', 1000. * (timer() - start_time))
+    return 0
+
+
+def run_session(args):
+    setup_logging(log_to_stderr=args.log_to_stderr, prefix=args.logprefix)
+    conn = sqlite3.connect(TRACES_DB, timeout=30, isolation_level=None)
+    ret = 0
+    try:
+        with redirect_std_streams_to('/dev/null'):
+            ret = main(args, conn)
+    except Exception as e:
+        logger.error('Exception occurred in outer context: %s', e)
+        ret = 1
+    finally:
+        conn.close()
+    return ret
+
+
+def serve_forked_sessions(parser, args):
+    # do all the expensive imports / ipython setup once, then fork a fresh child per session
+    # read from stdin (one line of replay-session.py args per session); results go to stdout
+    setup_logging(log_to_stderr=True, prefix='fork-server')
+    start_time = timer()
+    # stdout is the protocol pipe, and the warm-up can print (e.g. about the gui event loop)
+    with contextlib.redirect_stdout(sys.stderr):
+        warm_up_ipython(args.use_nbsafety)
+    warm_up_seconds = timer() - start_time
+    logger.info('fork server warmed up in %.2fs', warm_up_seconds)
+    out = sys.stdout
+
+    def _reply(result):
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    for line in sys.stdin:
+        if line.strip() == '':
+            continue
+        start_time = timer()
+        try:
+            session_args = parser.parse_args(shlex.split(line))
+        except SystemExit:
+            _reply({'args': line.strip(), 'ret': 2, 'error': 'unable to parse session args'})
+            continue
+        if session_args.trace is None or session_args.session is None or session_args.fork_server:
+            # checked before forking, since a child without a session would fail much later
+            _reply({'args': line.strip(), 'ret': 2, 'error': 'session args need --trace and --session'})
+            continue
+        # the child reports when it is ready to start replaying, so that what forking it cost can
+        # be set against what warming up a fresh process would have
+        ready_read_fd, ready_write_fd = os.pipe()
+        fork_time = timer()
+        pid = os.fork()
+        if pid == 0:
+            ret = 1
+            try:
+                os.close(ready_read_fd)
+                # keep whatever the session does from writing into the protocol pipe
+                devnull_fd = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull_fd, 0)
+                os.dup2(devnull_fd, 1)
+                os.write(ready_write_fd, struct.pack('d', timer()))
+                os.close(ready_write_fd)
+                ret = run_session(session_args)
+            finally:
+                logging.shutdown()
+                os._exit(ret)
+        os.close(ready_write_fd)
+        with os.fdopen(ready_read_fd, 'rb') as ready_pipe:
+            ready_message = ready_pipe.read(struct.calcsize('d'))
+        _, status = os.waitpid(pid, 0)
+        result = {
+            'trace': session_args.trace,
+            'session': session_args.session,
+            'ret': os.waitstatus_to_exitcode(status),
+            'session_time': timer() - start_time,
+        }
+        if len(ready_message) == struct.calcsize('d'):
+            fork_overhead = struct.unpack('d', ready_message)[0] - fork_time
+            result['fork_overhead'] = fork_overhead
+            result['startup_saved'] = max(warm_up_seconds - fork_overhead, 0.)
+        _reply(result)
     return 0
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--version', type=int, default=-1)
-    parser.add_argument('-t', '--trace', type=int, help='Which trace the session to run is in', required=True)
-    parser.add_argument('-s', '--session', type=int, help='Which session to run', required=True)
+    parser.add_argument('-t', '--trace', type=int, help='Which trace the session to run is in')
+    parser.add_argument('-s', '--session', type=int, help='Which session to run')
     parser.add_argument('--use-nbsafety', '--nbsafety', action='store_true', help='Whether to use nbsafety')
     parser.add_argument('--log-to-stderr', '--stderr', action='store_true', help='Whether to log to stderr')
     parser.add_argument('--just-log-files', action='store_true', help='If true, just log paths of files w/out running')
@@ -509,17 +643,60 @@ if __name__ == '__main__':
     parser.add_argument('--no-stats-logging', action='store_true', help='No writing to db tables if true')
     parser.add_argument('--forward-only-propagation', action='store_true', help='Only propagate staleness forwards if true')
     parser.add_argument('--naive-refresher-computation', action='store_true', help='Use quadratic refresher computation if true')
+    parser.add_argument(
+        '--incremental-checker', action='store_true',
+        help='Only recheck cells whose dependencies may have changed since the last check'
+    )
+    parser.add_argument(
+        '--validate-incremental-checker', action='store_true',
+        help='Run both the incremental and the full check and assert that they agree (implies --incremental-checker)'
+    )
     parser.add_argument('--logprefix', default='session')
+    parser.add_argument(
+        '--result-sink', help='If set, send results to the result writer listening on this socket instead of the db'
+    )
+    parser.add_argument(
+        '--cell-matcher', choices=sorted(CELL_MATCHERS.keys()), default='fuzzyset',
+        help='How to match executed cells up with cells that ran earlier in the session'
+    )
+    parser.add_argument(
+        '--no-preprocessed-store', action='store_true', help='Preprocess the session here even if already stored'
+    )
+    parser.add_argument(
+        '--no-package-resolution', action='store_true', help='Assume all packages are installed already'
+    )
+    parser.add_argument(
+        '--no-resolution-cache', action='store_true', help='Resolve every import even if known to work already'
+    )
+    parser.add_argument('--wheelhouse', help='If set, only pip install from this local wheelhouse')
+    parser.add_argument('--session-pack', help='If set, read cells from this session pack instead of cell_execs')
+    parser.add_argument('--no-source-cache', action='store_true', help='Only cache preprocessed cells in memory')
+    parser.add_argument(
+        '--random-baseline', choices=RANDOM_BASELINES, default=ANALYTIC_BASELINE,
+        help='Score random cell picks by their expected outcome or by averaging seeded random draws'
+    )
+    parser.add_argument('--random-baseline-samples', type=int, default=DEFAULT_NUM_BASELINE_SAMPLES)
+    parser.add_argument('--random-baseline-seed', type=int, default=0)
+    parser.add_argument(
+        '--cell-timeout', type=float, default=DEFAULT_CELL_SECONDS,
+        help='Seconds each cell gets (the most it gets with --adaptive-cell-timeout)'
+    )
+    parser.add_argument(
+        '--adaptive-cell-timeout', action='store_true',
+        help='If true, give each cell --cell-timeout-multiplier times the longest runtime seen so far instead'
+    )
+    parser.add_argument('--min-cell-timeout', type=float, default=DEFAULT_MIN_CELL_SECONDS)
+    parser.add_argument('--cell-timeout-multiplier', type=float, default=DEFAULT_CELL_RUNTIME_MULTIPLIER)
+    parser.add_argument('--session-timeout', type=float, help='If set, abandon the session after this many seconds')
+    parser.add_argument('--max-timeouts', type=int, help='If set, abandon the session after this many cell timeouts')
+    parser.add_argument('--max-memory-mb', type=int, help='If set, kill the session once its rss exceeds this')
+    parser.add_argument(
+        '--fork-server', action='store_true',
+        help='If true, warm up once and then fork a replay per line of session args read from stdin'
+    )
     args = parser.parse_args()
-    setup_logging(log_to_stderr=args.log_to_stderr, prefix=args.logprefix)
-    conn = sqlite3.connect('./data/traces.sqlite', timeout=30, isolation_level=None)
-    ret = 0
-    try:
-        with redirect_std_streams_to('/dev/null'):
-            ret = main(args, conn)
-    except Exception as e:
-        logger.error('Exception occurred in outer context: %s', e)
-        ret = 1
-    finally:
-        conn.close()
-        sys.exit(ret)
+    if args.fork_server:
+        sys.exit(serve_forked_sessions(parser, args))
+    if args.trace is None or args.session is None:
+        parser.error('--trace and --session are required')
+    sys.exit(run_session(args))
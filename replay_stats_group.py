@@ -1,36 +1,139 @@
 # -*- coding: utf-8 -*-
-import random
+import collections
+import zlib
 
 import numpy as np
 
+ANALYTIC_BASELINE = 'analytic'
+MONTE_CARLO_BASELINE = 'monte-carlo'
+RANDOM_BASELINES = [ANALYTIC_BASELINE, MONTE_CARLO_BASELINE]
+DEFAULT_NUM_BASELINE_SAMPLES = 1000
+# every group replay-session.py keeps, in replay_stats column order
+STATS_GROUP_SUFFIXES = [
+    'next_cell',
+    'random_cell',
+    'live_cells',
+    'new_live_cells',
+    'new_or_refresher_cells',
+    'refresher_cells',
+    'new_refresher_cells',
+    'random_like_new_refresher_cells',
+    'stale_cells',
+    'new_stale_cells',
+]
+
+
+def get_stats_group_columns(group_suffix):
+    # the replay_stats columns ReplayStatsGroup.make_dict fills in for this group
+    columns = [
+        f'predictive_power_{group_suffix}',
+        f'macro_predictive_power_{group_suffix}',
+        f'normalized_predictive_power_{group_suffix}',
+    ]
+    if group_suffix != 'next_cell':
+        columns += [f'avg_num_{group_suffix}', f'median_num_{group_suffix}']
+    return columns
+
+
+class OnlineMoments(object):
+    # welford's running mean / variance
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self._m2 = 0.
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count > 0 else 0.
+
+
+class StreamingMedian(object):
+    # The values are cell counts, i.e. small integers with few distinct values, so a histogram
+    # gives the exact median (same as np.median) in memory bounded by the number of cells.
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+
+    def add(self, value):
+        self.counts[value] += 1
+        self.total += 1
+
+    def _value_at(self, rank):
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen > rank:
+                return value
+
+    def median(self):
+        if self.total == 0:
+            return None
+        if self.total % 2 == 1:
+            return float(self._value_at(self.total // 2))
+        return (self._value_at(self.total // 2 - 1) + self._value_at(self.total // 2)) / 2.
+
 
 class ReplayStatsGroup(object):
-    def __init__(self, group_suffix):
+    # Updates given an int number of choices (rather than a set) are random baselines: a uniformly
+    # random pick of that many of the available cells. Whether a given cell is among them is a
+    # bernoulli trial with p = choices / available, so the analytic baseline uses its expectation,
+    # and the monte carlo one averages `num_samples` seeded draws.
+    def __init__(
+        self, group_suffix, random_baseline=ANALYTIC_BASELINE, num_samples=DEFAULT_NUM_BASELINE_SAMPLES, seed=None
+    ):
         self.group_suffix = group_suffix
+        self.random_baseline = random_baseline
+        self.num_samples = num_samples
+        if seed is not None:
+            seed = list(seed) + [zlib.crc32(group_suffix.encode('utf-8'))]
+        self.rng = np.random.default_rng(seed)
         self.num_correct = 0.
         self.num_attempts = 0
         self.pp_micro_den = 0.
         self.pp_macro_sum = 0.
         self.pp_normalized_sum = 0.
-        self.num_cells_at_each_attempt = []
+        self.num_cells_moments = OnlineMoments()
+        self.num_cells_median = StreamingMedian()
+
+    def _random_hit_rate(self, cell_id, num_choices, available_choices):
+        if num_choices > len(available_choices):
+            raise ValueError('Sample larger than population or is negative')
+        if cell_id not in available_choices:
+            return 0.
+        prob_hit = float(num_choices) / len(available_choices)
+        if self.random_baseline == ANALYTIC_BASELINE:
+            return prob_hit
+        return self.rng.binomial(self.num_samples, prob_hit) / float(self.num_samples)
 
     def update(self, cell_id, cell_choices, available_choices):
         if isinstance(cell_choices, int):
             assert not isinstance(available_choices, int)
-            cell_choices = set(random.sample(list(available_choices), cell_choices))
+            num_choices = cell_choices
+            if num_choices == 0 or len(available_choices) <= 1:
+                return
+            was_correct = self._random_hit_rate(cell_id, num_choices, available_choices)
             available_choices = len(available_choices)
-        if len(cell_choices) == 0:
-            return
-        if available_choices <= 1:
-            return
-        was_correct = float(cell_id in cell_choices)
-        prob_random_correct = float(len(cell_choices)) / available_choices
+        else:
+            num_choices = len(cell_choices)
+            if num_choices == 0:
+                return
+            if available_choices <= 1:
+                return
+            was_correct = float(cell_id in cell_choices)
+        prob_random_correct = float(num_choices) / available_choices
         self.pp_micro_den += prob_random_correct
         self.pp_macro_sum += was_correct / prob_random_correct
         self.pp_normalized_sum += ((was_correct / prob_random_correct) - 1.) / (available_choices - 1.)
         self.num_correct += was_correct
         self.num_attempts += 1
-        self.num_cells_at_each_attempt.append(float(len(cell_choices)))
+        self.num_cells_moments.add(float(num_choices))
+        self.num_cells_median.add(num_choices)
 
     def make_dict(self):
         ret = {}
@@ -44,7 +147,7 @@ class ReplayStatsGroup(object):
         })
         if self.group_suffix != 'next_cell':
             ret.update({
-                f'avg_num_{self.group_suffix}': np.mean(self.num_cells_at_each_attempt),
-                f'median_num_{self.group_suffix}': np.median(self.num_cells_at_each_attempt),
+                f'avg_num_{self.group_suffix}': self.num_cells_moments.mean,
+                f'median_num_{self.group_suffix}': self.num_cells_median.median(),
             })
         return ret
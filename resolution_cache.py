@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import importlib.metadata
+import logging
+import sqlite3
+import sys
+
+from schema import IMPORT_RESOLUTIONS_DDL
+from source_cache import SOURCE_CACHE_DB
+
+logger = logging.getLogger(__name__)
+
+_environment_fingerprint = None
+
+
+def get_environment_fingerprint():
+    # the interpreter plus every installed distribution and its version, so any pip install /
+    # uninstall / upgrade (by us or anyone else) yields a new fingerprint
+    global _environment_fingerprint
+    if _environment_fingerprint is None:
+        dists = sorted(
+            f'{dist.metadata["Name"]}=={dist.version}' for dist in importlib.metadata.distributions()
+        )
+        h = hashlib.sha1()
+        for part in [sys.executable, sys.version] + dists:
+            h.update(part.encode('utf-8'))
+            h.update(b'\n')
+        _environment_fingerprint = h.hexdigest()
+    return _environment_fingerprint
+
+
+def invalidate_environment_fingerprint():
+    global _environment_fingerprint
+    _environment_fingerprint = None
+    importlib.invalidate_caches()
+
+
+class ImportResolutionCache(object):
+    # Remembers, per environment fingerprint, which import statements are known to work and what
+    # had to be installed to get there: a row with a null package means the import already worked
+    # in that environment, otherwise installing package (at version, if pinned) made it work.
+    # Only successes are recorded, since failed installs can be transient. Like SourceCache, the
+    # persistent side is best-effort.
+    def __init__(self, db_path=SOURCE_CACHE_DB):
+        self.db_path = db_path
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_conn(self):
+        if self._conn is None and self.db_path is not None:
+            try:
+                self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+                self._conn.execute('PRAGMA journal_mode = WAL')
+                self._conn.execute(IMPORT_RESOLUTIONS_DDL)
+            except sqlite3.Error as e:
+                logger.warning('unable to open import resolution cache at %s: %s', self.db_path, e)
+                self.db_path = None
+                self._conn = None
+        return self._conn
+
+    def get_resolutions(self, fingerprint, import_stmts):
+        conn = self._get_conn()
+        if conn is None:
+            return {}
+        import_stmts = list(import_stmts)
+        try:
+            rows = conn.execute(
+                f'SELECT import_stmt, package, version FROM import_resolutions '
+                f'WHERE env_fingerprint = ? AND import_stmt IN ({",".join("?" for _ in import_stmts)})',
+                [fingerprint] + import_stmts
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning('import resolution cache lookup failed: %s', e)
+            return {}
+        return {import_stmt: (package, version) for import_stmt, package, version in rows}
+
+    def lookup(self, fingerprint, import_stmts):
+        # returns (True, None) if every statement is known good as-is, (True, (package, version)) if
+        # every statement was made good by the same install, and (False, None) otherwise
+        import_stmts = set(import_stmts)
+        resolutions = self.get_resolutions(fingerprint, import_stmts)
+        if len(resolutions) < len(import_stmts) or len(set(resolutions.values())) != 1:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        package, version = next(iter(resolutions.values()))
+        return True, None if package is None else (package, version)
+
+    def record(self, fingerprint, libname, import_stmts, package=None, version=None):
+        conn = self._get_conn()
+        if conn is None:
+            return
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO import_resolutions(env_fingerprint, import_stmt, libname, package, version) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(fingerprint, import_stmt, libname, package, version) for import_stmt in set(import_stmts)]
+            )
+        except sqlite3.Error as e:
+            logger.warning('import resolution cache write failed: %s', e)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -2,13 +2,16 @@
 import ast
 import logging
 import kaggle
-import pathlib
-import pickle
-import shutil
 import subprocess
 
+from import_probe import get_import_probe
+from resolution_cache import get_environment_fingerprint, invalidate_environment_fingerprint
+
 logger = logging.getLogger(__name__)
 
+# so that one hung install can't take the whole session down with it
+PIP_INSTALL_TIMEOUT_SECONDS = 600
+
 PACKAGES_BY_IMPORT = {
     'sklearn': {
         'package': 'scikit-learn',
@@ -36,37 +39,73 @@ class ImportResolver(Resolver):
 
 
 class PipResolver(ImportResolver):
+    def __init__(self, libname, imports_involving_lib, cache=None, pip_args=''):
+        super().__init__(libname, imports_involving_lib)
+        self.cache = cache
+        self.pip_args = pip_args
+        self.installed = None
 
-    # huge hack using pickle to get around not having the actual text source code
     def _try_imports(self):
-        unique_imports = set()
-        for import_stmt in self.imports_involving_lib:
-            mod = ast.Module([import_stmt], [])
-            unique_imports.add(pickle.dumps(mod))
+        unique_imports = sorted(set(ast.unparse(import_stmt) for import_stmt in self.imports_involving_lib))
         logger.info('total unique imports: %d vs %d non-dedupped', len(unique_imports), len(self.imports_involving_lib))
-        pickled_import_dir = pathlib.Path('pickled_imports')
-        try:
-            shutil.rmtree(pickled_import_dir)
-        except:
-            pass
-        pickled_import_dir.mkdir(exist_ok=True)
-        for idx, import_dump in enumerate(unique_imports):
-            with open(pickled_import_dir.joinpath(f'pickled.{idx}.dump'), 'wb') as f:
-                f.write(import_dump)
+        results = get_import_probe().probe(unique_imports)
+        total_failing = 0
+        for import_stmt, (ok, error) in zip(unique_imports, results):
+            if not ok:
+                total_failing += 1
+                logger.info('import failed: %s (%s)', import_stmt, error)
+        logger.info('total failing: %d', total_failing)
+        return total_failing
+
+    def _pip_install(self, pypi_package, version=None):
+        requirement = pypi_package if version is None else f'{pypi_package}=={version}'
+        upgrade = '--upgrade ' if version is None else ''
+        command = f'pip install {self.pip_args} {upgrade}{requirement}'
         try:
             with open('/dev/null', 'w') as devnull:
-                total_failing = subprocess.call(
-                    'python try-imports.py', shell=True, stdout=devnull, stderr=subprocess.STDOUT
+                subprocess.check_call(
+                    command, shell=True, stdout=devnull, stderr=subprocess.STDOUT, timeout=PIP_INSTALL_TIMEOUT_SECONDS
                 )
-                logger.info('total failing: %d', total_failing)
+        except subprocess.TimeoutExpired:
+            logger.error('pip install of %s timed out', requirement)
+            raise subprocess.CalledProcessError(-1, command)
         finally:
-            shutil.rmtree(pickled_import_dir)
-        return total_failing
+            # even a failed install may have changed what's installed
+            invalidate_environment_fingerprint()
+            get_import_probe().environment_changed()
+        self.installed = (pypi_package, version)
 
     def resolve(self):
         if self.libname == 'itertools':
             return True
+        if self.cache is None:
+            return self._resolve()
+
+        import_stmts = [ast.unparse(import_stmt) for import_stmt in self.imports_involving_lib]
+        fingerprint = get_environment_fingerprint()
+        known_good, install = self.cache.lookup(fingerprint, import_stmts)
+        resolved = False
+        if known_good and install is None:
+            logger.info('imports involving %s are known to work in this environment', self.libname)
+            return True
+        elif known_good:
+            logger.info('installing %s (version %s), which resolved these imports before', *install)
+            try:
+                self._pip_install(*install)
+                resolved = self._try_imports() == 0
+            except subprocess.CalledProcessError:
+                pass
+        if not resolved:
+            resolved = self._resolve()
+        if resolved:
+            if self.installed is None:
+                self.cache.record(fingerprint, self.libname, import_stmts)
+            else:
+                self.cache.record(fingerprint, self.libname, import_stmts, *self.installed)
+                self.cache.record(get_environment_fingerprint(), self.libname, import_stmts)
+        return resolved
 
+    def _resolve(self):
         if self._try_imports() == 0:
             return True
 
@@ -76,33 +115,23 @@ class PipResolver(ImportResolver):
         best = (-float('inf'), None, None)
         package = PACKAGES_BY_IMPORT.get(self.libname, {'package': self.libname})
         pypi_package = package['package']
-        with open('/dev/null', 'w') as devnull:
-            if 'versions' in package:
-                for v in package['versions']:
-                    try:
-                        subprocess.check_call(
-                            f'pip install {pypi_package}=={v}',
-                            shell=True, stdout=devnull, stderr=subprocess.STDOUT
-                        )
-                    except:
-                        continue
-                    best = max(best, (-self._try_imports(), _version_tuple(v), v))
-                    if best[0] == 0:  # short-circuit if we find one that fixes all imports
-                        return True
-                if best[2] is None:
-                    logger.error('error: unable to find working package for %s', package)
-                    return False
-                subprocess.check_call(
-                    f'pip install {pypi_package}=={best[2]}',
-                    shell=True, stdout=devnull, stderr=subprocess.STDOUT
-                )
-                logger.warning('warning: %d import(s) still failing', -best[0])
-            else:
-                subprocess.check_call(
-                    f'pip install --upgrade {pypi_package}',
-                    shell=True, stdout=devnull, stderr=subprocess.STDOUT
-                )
-                return self._try_imports() == 0
+        if 'versions' in package:
+            for v in package['versions']:
+                try:
+                    self._pip_install(pypi_package, v)
+                except:
+                    continue
+                best = max(best, (-self._try_imports(), _version_tuple(v), v))
+                if best[0] == 0:  # short-circuit if we find one that fixes all imports
+                    return True
+            if best[2] is None:
+                logger.error('error: unable to find working package for %s', package)
+                return False
+            self._pip_install(pypi_package, best[2])
+            logger.warning('warning: %d import(s) still failing', -best[0])
+        else:
+            self._pip_install(pypi_package)
+            return self._try_imports() == 0
 
         return False
 
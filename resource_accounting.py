@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import logging
+import os
+import resource
+import threading
+
+from schema import RESOURCE_STATS_DDL
+
+logger = logging.getLogger(__name__)
+
+# ru_inblock / ru_oublock are counted in 512-byte blocks
+RUSAGE_BLOCK_BYTES = 512
+MEMORY_CAP_EXIT_CODE = 3
+TOTAL_PHASE = 'total'
+
+ACCUMULATED_FIELDS = [
+    'user_time',
+    'system_time',
+    'voluntary_ctx_switches',
+    'involuntary_ctx_switches',
+    'read_bytes',
+    'write_bytes',
+]
+
+
+def take_snapshot():
+    # subprocesses (2to3, pip, ...) only show up in RUSAGE_CHILDREN once they've been reaped
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'peak_rss_kb': max(own.ru_maxrss, children.ru_maxrss),
+        'user_time': own.ru_utime + children.ru_utime,
+        'system_time': own.ru_stime + children.ru_stime,
+        'voluntary_ctx_switches': own.ru_nvcsw + children.ru_nvcsw,
+        'involuntary_ctx_switches': own.ru_nivcsw + children.ru_nivcsw,
+        'read_bytes': (own.ru_inblock + children.ru_inblock) * RUSAGE_BLOCK_BYTES,
+        'write_bytes': (own.ru_oublock + children.ru_oublock) * RUSAGE_BLOCK_BYTES,
+    }
+
+
+def get_current_rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class ResourceAccountant(object):
+    def __init__(self):
+        self.start_snapshot = take_snapshot()
+        self.usage_by_phase = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # phases can be entered many times (e.g. once per cell); usage accumulates across entries
+        before = take_snapshot()
+        try:
+            yield
+        finally:
+            after = take_snapshot()
+            usage = self.usage_by_phase.setdefault(name, dict.fromkeys(ACCUMULATED_FIELDS, 0))
+            for field in ACCUMULATED_FIELDS:
+                usage[field] += after[field] - before[field]
+            # rusage only gives a high-water mark, so this is the peak as of the end of the phase
+            usage['peak_rss_kb'] = max(usage.get('peak_rss_kb', 0), after['peak_rss_kb'])
+
+    def totals(self):
+        now = take_snapshot()
+        totals = {field: now[field] - self.start_snapshot[field] for field in ACCUMULATED_FIELDS}
+        totals['peak_rss_kb'] = now['peak_rss_kb']
+        return totals
+
+    def make_rows(self, version, trace, session, memory_cap_exceeded=False):
+        rows = []
+        usage_by_phase = list(self.usage_by_phase.items()) + [(TOTAL_PHASE, self.totals())]
+        for phase, usage in usage_by_phase:
+            row = dict(version=version, trace=trace, session=session, phase=phase)
+            row.update(usage)
+            row['memory_cap_exceeded'] = int(memory_cap_exceeded)
+            rows.append(row)
+        return rows
+
+
+def insert_resource_stats(conn, rows):
+    # runs inside whatever transaction the caller has open (see result_sink.py)
+    if len(rows) == 0:
+        return
+    columns = list(rows[0].keys())
+    conn.execute(RESOURCE_STATS_DDL)
+    conn.executemany(
+        f"INSERT OR REPLACE INTO replay_resource_stats({','.join(columns)}) "
+        f"VALUES ({','.join('?' for _ in columns)})",
+        [tuple(row[col] for col in columns) for row in rows]
+    )
+
+
+class MemoryWatchdog(threading.Thread):
+    # polls rss from a background thread, since an rlimit would just surface as a MemoryError
+    # inside whatever cell happens to be allocating (which the cell wrapper swallows)
+    def __init__(self, max_rss_bytes, on_exceeded, poll_interval=0.25):
+        super().__init__(daemon=True)
+        self.max_rss_bytes = max_rss_bytes
+        self.on_exceeded = on_exceeded
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.poll_interval):
+            rss = get_current_rss_bytes()
+            if rss > self.max_rss_bytes:
+                logger.error('rss of %d bytes exceeds memory cap of %d bytes; killing session', rss, self.max_rss_bytes)
+                try:
+                    self.on_exceeded()
+                finally:
+                    logging.shutdown()
+                    os._exit(MEMORY_CAP_EXIT_CODE)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import sqlite3
+import threading
+from timeit import default_timer as timer
+
+from cell_stats import insert_cell_stats
+from resource_accounting import insert_resource_stats
+from schema import REPLAY_EXCEPTION_STATS_DDL, REPLAY_STATS_DDL, ensure_replay_stats_columns
+from work_queue import complete_sessions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_BATCH_SECONDS = 5.
+# a batch that keeps failing for some other reason than a locked database is dropped after this
+# many commits; sessions whose queue entries it would have completed are retried by a later sweep
+MAX_COMMIT_ATTEMPTS = 3
+CLOSE_MESSAGE = 'close'
+
+
+def make_session_results(
+    version, trace, session, replay_stats=None, exception_counts=None, resource_stats=(), cell_stats=None,
+    complete_queue_entry=False
+):
+    # everything a replay writes, as one picklable message; None means leave that table alone
+    # (e.g. the resource stats written by a watchdog right before it kills the session).
+    # `complete_queue_entry` marks the session done in replay_queue in the same transaction.
+    return dict(
+        version=version,
+        trace=trace,
+        session=session,
+        replay_stats=replay_stats,
+        exception_counts=None if exception_counts is None else dict(exception_counts),
+        resource_stats=list(resource_stats),
+        cell_stats=None if cell_stats is None else list(cell_stats),
+        complete_queue_entry=complete_queue_entry,
+    )
+
+
+def write_session_results(conn, batch):
+    # one transaction for the whole batch, with one executemany per statement
+    replay_stats_by_columns = collections.defaultdict(list)
+    exception_rows = []
+    resource_rows = []
+    for results in batch:
+        if results['replay_stats'] is not None:
+            row = results['replay_stats']
+            replay_stats_by_columns[tuple(row.keys())].append(tuple(row.values()))
+        if results['exception_counts'] is not None:
+            exception_rows.append((results['trace'], results['session'], results['exception_counts']))
+        resource_rows.extend(results['resource_stats'])
+    completed = [
+        (results['version'], results['trace'], results['session'])
+        for results in batch if results.get('complete_queue_entry')
+    ]
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        if len(replay_stats_by_columns) > 0:
+            conn.execute(REPLAY_STATS_DDL)
+            ensure_replay_stats_columns(conn)
+        if len(exception_rows) > 0:
+            conn.execute(REPLAY_EXCEPTION_STATS_DDL)
+        for columns, rows in replay_stats_by_columns.items():
+            conn.executemany(
+                f"INSERT OR REPLACE INTO replay_stats({','.join(columns)}) VALUES ({','.join('?' for _ in columns)})",
+                rows
+            )
+        conn.executemany(
+            'DELETE FROM replay_exception_stats WHERE trace = ? AND session = ?',
+            [(trace, session) for trace, session, _ in exception_rows]
+        )
+        conn.executemany(
+            'INSERT INTO replay_exception_stats(trace, session, exception, count) VALUES (?, ?, ?, ?)',
+            [
+                (trace, session, exc_name, exc_count)
+                for trace, session, exception_counts in exception_rows
+                for exc_name, exc_count in exception_counts.items()
+            ]
+        )
+        insert_resource_stats(conn, resource_rows)
+        for results in batch:
+            if results['cell_stats'] is not None:
+                insert_cell_stats(
+                    conn, results['version'], results['trace'], results['session'], results['cell_stats']
+                )
+        complete_sessions(conn, completed)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+class LocalResultSink(object):
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def write(self, results):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            write_session_results(conn, [results])
+        finally:
+            conn.close()
+
+
+class RemoteResultSink(object):
+    # hands results to a ResultWriter; falls back to writing them directly if it's gone
+    def __init__(self, address, db_path):
+        self.address = address
+        self.db_path = db_path
+
+    def write(self, results):
+        try:
+            with multiprocessing.connection.Client(self.address, family='AF_UNIX') as conn:
+                conn.send(results)
+                conn.recv()
+        except (OSError, EOFError) as e:
+            logger.warning('result writer at %s unavailable (%s); writing results directly', self.address, e)
+            LocalResultSink(self.db_path).write(results)
+
+
+def make_result_sink(address, db_path):
+    if address is None:
+        return LocalResultSink(db_path)
+    return RemoteResultSink(address, db_path)
+
+
+def is_transient_error(e):
+    return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+
+def serve_results(address, db_path, batch_size, batch_seconds, ready):
+    # Single writer for concurrent replays: an accept thread queues each session's results and
+    # acks as soon as they're queued, so sessions never wait on the database; the main loop
+    # commits whatever has arrived once `batch_size` results are in or the oldest has waited
+    # `batch_seconds`, and flushes everything on CLOSE_MESSAGE. An ack only means queued, so the
+    # scheduler doesn't mark a session done itself: it queues a `complete_queue_entry` message
+    # after the session's results, and the entry is marked done in the commit that writes them.
+    # Results lost with the writer leave their entries leased, to be retried once the lease expires.
+    listener = multiprocessing.connection.Listener(address, family='AF_UNIX')
+    pending = queue.Queue()
+
+    def _accept():
+        while True:
+            try:
+                client = listener.accept()
+            except OSError:
+                return
+            with client:
+                try:
+                    pending.put(client.recv())
+                    client.send(True)
+                except (OSError, EOFError) as e:
+                    logger.warning('dropped connection from replay: %s', e)
+
+    threading.Thread(target=_accept, name='result-writer-accept', daemon=True).start()
+    ready.set()
+    conn = sqlite3.connect(db_path, timeout=30)
+    batch = []
+    deadline = None
+    num_failed_commits = 0
+    num_written = 0
+    num_dropped = 0
+    write_time = 0.
+
+    def _flush():
+        nonlocal batch, deadline, num_failed_commits, num_written, num_dropped, write_time
+        if len(batch) == 0:
+            return
+        sessions = sorted({(results['trace'], results['session']) for results in batch})
+        start_time = timer()
+        try:
+            write_session_results(conn, batch)
+        except sqlite3.Error as e:
+            if not is_transient_error(e):
+                num_failed_commits += 1
+            if num_failed_commits >= MAX_COMMIT_ATTEMPTS:
+                logger.exception(
+                    'dropping results for %d session(s) after %d failed commits: %s', len(sessions), num_failed_commits,
+                    ', '.join(f'trace {trace} session {session}' for trace, session in sessions)
+                )
+                num_dropped += len(sessions)
+            else:
+                # keep the batch and try again once another batch_seconds have passed
+                logger.exception('unable to commit results for %d session(s); will retry', len(sessions))
+                deadline = timer() + batch_seconds
+                return
+        else:
+            write_time += timer() - start_time
+            num_written += len(sessions)
+            logger.info('committed results for %d session(s) in %.3fs', len(sessions), timer() - start_time)
+        batch = []
+        deadline = None
+        num_failed_commits = 0
+
+    try:
+        while True:
+            try:
+                message = pending.get(timeout=None if deadline is None else max(deadline - timer(), 0.))
+            except queue.Empty:
+                message = None
+            if message == CLOSE_MESSAGE:
+                break
+            if message is not None:
+                batch.append(message)
+                if deadline is None:
+                    deadline = timer() + batch_seconds
+            if len(batch) >= batch_size or (deadline is not None and timer() >= deadline):
+                _flush()
+        _flush()
+    finally:
+        listener.close()
+        conn.close()
+        logger.info(
+            'result writer committed %d session results in %.1fs (%d dropped)', num_written, write_time, num_dropped
+        )
+
+
+class ResultWriter(object):
+    def __init__(self, address, db_path, batch_size=DEFAULT_BATCH_SIZE, batch_seconds=DEFAULT_BATCH_SECONDS):
+        self.address = str(address)
+        if os.path.exists(self.address):
+            # left over from a sweep that didn't shut down cleanly
+            os.unlink(self.address)
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(
+            target=serve_results,
+            args=(self.address, str(db_path), batch_size, batch_seconds, ready),
+            name='result-writer',
+            daemon=True,
+        )
+        self._process.start()
+        while not ready.wait(0.1):
+            if not self._process.is_alive():
+                raise RuntimeError(f'result writer exited with code {self._process.exitcode} before starting')
+
+    def complete_queue_entry(self, version, trace, session):
+        # queued behind the results the session handed off before it exited, so its replay_queue
+        # entry is marked done in the same commit as they are
+        try:
+            with multiprocessing.connection.Client(self.address, family='AF_UNIX') as conn:
+                conn.send(make_session_results(version, trace, session, complete_queue_entry=True))
+                conn.recv()
+        except (OSError, EOFError) as e:
+            logger.error('unable to reach result writer at %s: %s', self.address, e)
+            return False
+        return True
+
+    def close(self):
+        try:
+            with multiprocessing.connection.Client(self.address, family='AF_UNIX') as conn:
+                conn.send(CLOSE_MESSAGE)
+                conn.recv()
+        except (OSError, EOFError) as e:
+            logger.error('unable to shut down result writer cleanly: %s', e)
+        self._process.join()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
@@ -1,15 +1,36 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
+import collections
+import concurrent.futures
 import logging
+import os
+import pathlib
+import shutil
 import sqlite3
-import subprocess
 import sys
+import threading
+from timeit import default_timer as timer
 import traceback
 
+from cost_model import estimate_session_costs, predict_makespan
+from environments import get_session_environments
+from result_sink import DEFAULT_BATCH_SECONDS, DEFAULT_BATCH_SIZE, ResultWriter
+from schema import migrate
+from session_runners import ForkServerSessionRunner, SubprocessSessionRunner
+from source_cache import SOURCE_CACHE_DB
+from source_index import ensure_source_index, format_sessions_matching_any
+from work_queue import (
+    DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, FAILED, WorkQueue, make_lease_owner
+)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TRACES_DB = pathlib.Path('./data/traces.sqlite')
+SOURCE_CACHE_DB = pathlib.Path(SOURCE_CACHE_DB)
+SHARED_TRANSIENT_DIR = pathlib.Path('./data/transient')
+RESULT_WRITER_ADDRESS = pathlib.Path('./data/result-writer.sock')
 
 FILTER_PATTERNS = [
     '%get_ipython().magic(%run%',
@@ -57,18 +78,40 @@ FILTER_PATTERNS = [
 ]
 
 
-def format_filter_pattern(patt):
-    return f"""
-             SELECT DISTINCT trace, session
-             FROM cell_execs
-             WHERE source LIKE {repr(patt)}
-    """.strip()
+def make_worker_dir(worker_root, worker_idx):
+    # each worker gets its own cwd so that session logs, session files, and pickled imports of
+    # one session don't clobber those of another; data/transient is filled per session
+    # (see refresh_worker_transient_dir)
+    worker_dir = worker_root.joinpath(f'worker-{worker_idx}')
+    worker_dir.joinpath('data').mkdir(parents=True, exist_ok=True)
+    for shared_db in (TRACES_DB, SOURCE_CACHE_DB):
+        worker_db = worker_dir.joinpath('data', shared_db.name)
+        if not os.path.lexists(worker_db):
+            worker_db.symlink_to(shared_db.resolve())
+    return worker_dir
+
+
+def refresh_worker_transient_dir(worker_dir):
+    # A fresh copy of the shared data/transient before every session. Copies rather than
+    # symlinks, since a session that opens a linked file for writing would overwrite the shared
+    # one; copying per session also picks up files added to the shared dir since the last one
+    # and drops whatever the previous session wrote.
+    worker_transient_dir = worker_dir.joinpath('data', 'transient')
+    shutil.rmtree(worker_transient_dir, ignore_errors=True)
+    if SHARED_TRANSIENT_DIR.exists():
+        shutil.copytree(SHARED_TRANSIENT_DIR, worker_transient_dir, symlinks=True)
+    else:
+        worker_transient_dir.mkdir(parents=True)
 
 
 def main(args, conn):
+    num_migrations = migrate(conn)
+    if num_migrations > 0:
+        logger.info('applied %d schema migration(s) to %s', num_migrations, TRACES_DB)
     conn.execute("PRAGMA read_uncommitted = true;")
-    ret = 0
-    newline = '\n'
+    use_source_index = not args.no_source_index and ensure_source_index(conn)
+    filtered_sessions_sql, filter_params = format_sessions_matching_any(FILTER_PATTERNS, use_index=use_source_index)
+    start_time = timer()
     results = conn.execute(f"""
 SELECT trace, session
 FROM cell_execs
@@ -80,27 +123,173 @@ FROM (
          SELECT trace, session
          FROM bad_sessions
          UNION
-         {(
-            newline + 'UNION' + newline
-          ).join(format_filter_pattern(patt) for patt in FILTER_PATTERNS)}
+         {filtered_sessions_sql}
         {'UNION SELECT trace, session FROM replay_stats WHERE version = ' + str(args.version) if args.skip_already_replayed else ''}
      )
-    """).fetchall()
-    command_template = './replay-session.py -- -t {trace} -s {session} -v {version}'
+    """, filter_params).fetchall()
+    logger.info('Selected %d candidate sessions in %.1fs', len(results), timer() - start_time)
+    session_args_template = '-t {trace} -s {session} -v {version}'
     if not args.no_nbsafety:
-        command_template += ' --nbsafety'
+        session_args_template += ' --nbsafety'
     if args.forward_only_propagation:
-        command_template += ' --forward-only-propagation'
+        session_args_template += ' --forward-only-propagation'
     if args.naive_refresher_computation:
-        command_template += ' --naive-refresher-computation'
-    for idx, (trace, session) in enumerate(results):
-        logger.info('Running trace %d session, %d (%d of %d total)', trace, session, idx + 1, len(results))
-        command = command_template.format(trace=trace, session=session, version=args.version)
-        session_ret = subprocess.call(command, shell=True)
-        if session_ret != 0:
-            logger.warning('trace %d, session %d got nonzero return code %d', trace, session, session_ret)
-        ret += session_ret
-    return ret
+        session_args_template += ' --naive-refresher-computation'
+    if args.incremental_checker:
+        session_args_template += ' --incremental-checker'
+    if args.session_timeout is not None:
+        session_args_template += f' --session-timeout {args.session_timeout}'
+    if args.max_timeouts is not None:
+        session_args_template += f' --max-timeouts {args.max_timeouts}'
+    if args.adaptive_cell_timeout:
+        session_args_template += ' --adaptive-cell-timeout'
+    if args.wheelhouse is not None:
+        session_args_template += f' --wheelhouse {pathlib.Path(args.wheelhouse).resolve()}'
+    if args.session_pack is not None:
+        session_args_template += f' --session-pack {pathlib.Path(args.session_pack).resolve()}'
+    result_writer = None
+    if args.jobs > 1:
+        # one process does all the result writes, so replays never wait on each other's commits
+        result_writer = ResultWriter(
+            RESULT_WRITER_ADDRESS.resolve(), TRACES_DB,
+            batch_size=args.result_batch_size, batch_seconds=args.result_batch_seconds
+        )
+        session_args_template += f' --result-sink {result_writer.address}'
+    work_queue = WorkQueue(TRACES_DB, args.version, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    try:
+        return run_queue(args, conn, work_queue, result_writer, results, session_args_template)
+    finally:
+        work_queue.close()
+        if result_writer is not None:
+            result_writer.close()
+
+
+def run_queue(args, conn, work_queue, result_writer, results, session_args_template):
+    if args.reset_queue:
+        logger.info('Cleared %d queued sessions for version %d', work_queue.reset(), args.version)
+    elif args.retry_failed:
+        logger.info('Retrying %d quarantined sessions', work_queue.reset(states=[FAILED]))
+    work_queue.reclaim_expired_leases()
+    if args.no_cost_ordering:
+        costs = None
+    else:
+        # longest job first, so that parallel sweeps don't end waiting on one straggler
+        costs = estimate_session_costs(conn, results)
+    logger.info('Enqueued %d sessions', work_queue.enqueue(results, priorities=costs))
+    logger.info('Queue state for version %d: %s', args.version, work_queue.counts())
+    pending = work_queue.pending_sessions()
+    for trace, session, cost in pending[:args.log_dispatch_order]:
+        logger.info('Dispatch order: trace %d session %d (estimated %.1fs)', trace, session, cost)
+    predicted_makespan = None
+    if costs is not None:
+        predicted_makespan = predict_makespan([cost for _, _, cost in pending], args.jobs)
+        logger.info(
+            'Predicted makespan for %d pending sessions on %d worker(s): %.1fs',
+            len(pending), args.jobs, predicted_makespan
+        )
+
+    if args.jobs > 1:
+        worker_dirs = [make_worker_dir(pathlib.Path(args.worker_root), idx) for idx in range(args.jobs)]
+    else:
+        worker_dirs = [None]
+    stats_lock = threading.Lock()
+    stats = collections.Counter()
+
+    if args.use_environments:
+        session_environments = get_session_environments(conn)
+        logger.info('%d sessions have a prebuilt environment', len(session_environments))
+    else:
+        session_environments = {}
+
+    def _make_runner(worker_dir, python):
+        if args.fork_server:
+            return ForkServerSessionRunner(
+                worker_dir, python=python, server_args='' if args.no_nbsafety else '--nbsafety'
+            )
+        else:
+            return SubprocessSessionRunner(worker_dir, python=python)
+
+    def _worker(worker_dir):
+        owner = make_lease_owner()
+        # one runner per environment, since a fork server can only fork sessions into its own
+        runners = {}
+        try:
+            _worker_loop(worker_dir, owner, runners)
+        finally:
+            for runner in runners.values():
+                runner.close()
+
+    def _worker_loop(worker_dir, owner, runners):
+        while True:
+            item = work_queue.lease(owner)
+            if item is None:
+                return
+            trace, session, attempt = item
+            python = session_environments.get((trace, session))
+            if python not in runners:
+                runners[python] = _make_runner(worker_dir, python)
+            runner = runners[python]
+            session_args = session_args_template.format(trace=trace, session=session, version=args.version)
+            if python is not None:
+                # everything the session imports was installed when its environment was built
+                session_args += ' --no-package-resolution'
+            logger.info(
+                'Running trace %d session %d (attempt %d) in %s', trace, session, attempt, worker_dir or os.getcwd()
+            )
+            start_time = timer()
+            session_info = {}
+            try:
+                if worker_dir is not None:
+                    refresh_worker_transient_dir(worker_dir)
+                session_ret, session_info = runner.run(
+                    session_args,
+                    lambda: work_queue.heartbeat(trace, session, owner),
+                    args.heartbeat_seconds,
+                )
+                error = session_info.get('error', f'nonzero return code {session_ret}')
+            except Exception as e:
+                session_ret = 1
+                error = f'{e.__class__.__name__}: {e}'
+            session_time = timer() - start_time
+            if session_ret == 0:
+                if result_writer is None:
+                    work_queue.complete(trace, session)
+                elif not result_writer.complete_queue_entry(args.version, trace, session):
+                    logger.error('leaving trace %d session %d leased, to be retried once it expires', trace, session)
+            else:
+                logger.warning('trace %d, session %d failed: %s', trace, session, error)
+                work_queue.fail(trace, session, error)
+            with stats_lock:
+                stats['finished'] += 1
+                stats['failed'] += session_ret != 0
+                stats['ret'] += session_ret
+                stats['session_time'] += session_time
+                if 'startup_saved' in session_info:
+                    stats['forked'] += 1
+                    stats['startup_saved'] += session_info['startup_saved']
+                logger.info(
+                    'Finished trace %d session %d in %.1fs (%d finished this sweep)',
+                    trace, session, session_time, stats['finished']
+                )
+
+    sweep_start_time = timer()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for future in [executor.submit(_worker, worker_dir) for worker_dir in worker_dirs]:
+            future.result()
+    makespan = timer() - sweep_start_time
+    logger.info(
+        'Replayed %d sessions (%d failed) using %d worker(s): %.1fs elapsed, %.1fs total session time',
+        stats['finished'], stats['failed'], args.jobs, makespan, stats['session_time']
+    )
+    if predicted_makespan is not None:
+        logger.info('Predicted vs actual makespan: %.1fs vs %.1fs', predicted_makespan, makespan)
+    if stats['forked'] > 0:
+        logger.info(
+            'Fork servers saved %.1fs of startup over %d forked sessions (%.2fs per session)',
+            stats['startup_saved'], stats['forked'], stats['startup_saved'] / stats['forked']
+        )
+    logger.info('Queue state for version %d: %s', args.version, work_queue.counts())
+    return stats['ret']
 
 
 if __name__ == '__main__':
@@ -111,9 +300,41 @@ if __name__ == '__main__':
     parser.add_argument('--forward-only-propagation', action='store_true', help='Only propagate staleness forwards if true')
     parser.add_argument('--naive-refresher-computation', action='store_true', help='Use quadratic refresher computation if true')
     parser.add_argument('--no-nbsafety', action='store_true', help='if true, run without nbsafety')
+    parser.add_argument('--incremental-checker', action='store_true', help='Only recheck cells whose dependencies changed')
+    parser.add_argument('--no-source-index', action='store_true', help='Filter sessions by scanning cell_execs')
+    parser.add_argument('--reset-queue', action='store_true', help='Forget queued sessions for this version first')
+    parser.add_argument('--retry-failed', action='store_true', help='Give quarantined sessions another chance')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help='Quarantine sessions after this many failures')
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS)
+    parser.add_argument('--heartbeat-seconds', type=float, default=30.)
+    parser.add_argument('--no-cost-ordering', action='store_true', help='Dispatch in SQL order instead of longest first')
+    parser.add_argument('--log-dispatch-order', type=int, default=20, help='How many of the first sessions to dispatch to log')
+    parser.add_argument('--fork-server', action='store_true', help='Fork sessions from a warmed-up replay process per worker')
+    parser.add_argument(
+        '--use-environments', action='store_true',
+        help='Replay sessions in the environments prebuilt by plan-environments.py, without resolving packages'
+    )
+    parser.add_argument('--session-timeout', type=float, help='Abandon sessions after this many seconds of replay')
+    parser.add_argument('--max-timeouts', type=int, help='Abandon sessions after this many cell timeouts')
+    parser.add_argument(
+        '--adaptive-cell-timeout', action='store_true',
+        help='Scale cell timeouts with the longest cell runtime so far instead of a fixed 15s'
+    )
+    parser.add_argument('--wheelhouse', help='Only pip install from this local wheelhouse (see populate-wheelhouse.py)')
+    parser.add_argument('--session-pack', help='Replay cells from this session pack (see export-session-pack.py)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of sessions to replay in parallel')
+    parser.add_argument(
+        '--result-batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+        help='With --jobs > 1, commit results once this many sessions have finished'
+    )
+    parser.add_argument(
+        '--result-batch-seconds', type=float, default=DEFAULT_BATCH_SECONDS,
+        help='With --jobs > 1, commit results at least this often'
+    )
+    parser.add_argument('--worker-root', default='./data/workers', help='Where per-worker working dirs go if --jobs > 1')
     args = parser.parse_args()
     ret = 0
-    conn = sqlite3.connect('./data/traces.sqlite', timeout=30, isolation_level=None)
+    conn = sqlite3.connect(TRACES_DB, timeout=30, isolation_level=None)
     try:
         ret = main(args, conn)
     except:
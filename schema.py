@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+from timeit import default_timer as timer
+
+from replay_stats_group import STATS_GROUP_SUFFIXES, get_stats_group_columns
+
+logger = logging.getLogger(__name__)
+
+# Every table in traces.sqlite and cache.sqlite is defined here. Modules still create the tables
+# they use on first use (so scratch databases keep working), but `migrate` is what brings an
+# existing traces.sqlite up to date: its PRAGMA user_version counts the MIGRATIONS applied so far.
+
+# id is an alias for the rowid, which the source index is keyed on; without an INTEGER PRIMARY
+# KEY, VACUUM is free to renumber rowids and the index would then point at the wrong cells
+CELL_EXECS_DDL = """
+CREATE TABLE IF NOT EXISTS cell_execs (
+    id INTEGER PRIMARY KEY,
+    trace INTEGER,
+    session INTEGER,
+    counter INTEGER,
+    source TEXT
+)"""
+
+# one row per trace in cell_execs, written by gather_traces.py as it ingests each one
+TRACES_DDL = """
+CREATE TABLE IF NOT EXISTS traces (
+    trace INTEGER PRIMARY KEY,
+    url TEXT,
+    num_cells INTEGER,
+    ingested_at REAL
+)"""
+
+# one row per history.sqlite url gather_traces.py has tried to ingest; byte-identical files
+# (forks and copies of the same repository) share the trace of whichever was ingested first
+INGEST_MANIFEST_DDL = """
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    url TEXT PRIMARY KEY,
+    content_hash TEXT,
+    size INTEGER,
+    trace INTEGER,
+    error TEXT,
+    ingested_at REAL
+)"""
+
+BAD_SESSIONS_DDL = """
+CREATE TABLE IF NOT EXISTS bad_sessions (
+    trace INTEGER,
+    session INTEGER
+)"""
+
+REPLAY_STATS_BASE_COLUMNS = {
+    'version': 'INTEGER NOT NULL',
+    'trace': 'INTEGER NOT NULL',
+    'session': 'INTEGER NOT NULL',
+    'num_cell_execs': 'INTEGER',
+    'num_successful_cell_execs': 'INTEGER',
+    'num_cells_created': 'INTEGER',
+    'num_exceptions': 'INTEGER',
+    'num_safety_errors': 'INTEGER',
+    'tracer_time': 'REAL',
+    'checker_time': 'REAL',
+    'wall_time': 'REAL',
+}
+
+# columns added since replay_stats' schema was first generated by hand
+REPLAY_STATS_ADDED_COLUMNS = {
+    'num_timeouts': 'INTEGER',
+    'session_abandoned': 'INTEGER',
+}
+
+REPLAY_STATS_DDL = 'CREATE TABLE IF NOT EXISTS replay_stats (\n{}\n)'.format(',\n'.join(
+    [f'    {column} {column_type}' for column, column_type in REPLAY_STATS_BASE_COLUMNS.items()]
+    + [
+        f'    {column} REAL'
+        for group_suffix in STATS_GROUP_SUFFIXES
+        for column in get_stats_group_columns(group_suffix)
+    ]
+    + [f'    {column} {column_type}' for column, column_type in REPLAY_STATS_ADDED_COLUMNS.items()]
+    + ['    PRIMARY KEY (version, trace, session)']
+))
+
+REPLAY_EXCEPTION_STATS_DDL = """
+CREATE TABLE IF NOT EXISTS replay_exception_stats (
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    exception TEXT NOT NULL,
+    count INTEGER NOT NULL
+)"""
+
+RESOURCE_STATS_DDL = """
+CREATE TABLE IF NOT EXISTS replay_resource_stats (
+    version INTEGER NOT NULL,
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    peak_rss_kb INTEGER,
+    user_time REAL,
+    system_time REAL,
+    voluntary_ctx_switches INTEGER,
+    involuntary_ctx_switches INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    memory_cap_exceeded INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (version, trace, session, phase)
+)"""
+
+CELL_STATS_DDL = """
+CREATE TABLE IF NOT EXISTS replay_cell_stats (
+    version INTEGER NOT NULL,
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    exec_index INTEGER NOT NULL,
+    cell_id INTEGER NOT NULL,
+    counter INTEGER NOT NULL,
+    source_bytes INTEGER NOT NULL,
+    preprocess_time REAL NOT NULL,
+    execution_time REAL,
+    tracing_time REAL,
+    checking_time REAL,
+    raised INTEGER NOT NULL DEFAULT 0,
+    timed_out INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (version, trace, session, exec_index)
+)"""
+
+PREPROCESSED_SESSIONS_DDL = """
+CREATE TABLE IF NOT EXISTS preprocessed_sessions (
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    preprocess_version TEXT NOT NULL,
+    source_digest TEXT NOT NULL,
+    cells TEXT NOT NULL,
+    imports TEXT NOT NULL,
+    file_names TEXT NOT NULL,
+    PRIMARY KEY (trace, session, preprocess_version)
+)"""
+
+QUEUE_DDL = """
+CREATE TABLE IF NOT EXISTS replay_queue (
+    version INTEGER NOT NULL,
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    priority REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    heartbeat REAL,
+    last_error TEXT,
+    updated REAL,
+    PRIMARY KEY (version, trace, session)
+)"""
+
+ENVIRONMENTS_DDL = """
+CREATE TABLE IF NOT EXISTS replay_environments (
+    env_id TEXT PRIMARY KEY,
+    requirements TEXT NOT NULL,
+    path TEXT NOT NULL,
+    built INTEGER NOT NULL DEFAULT 0,
+    failed_requirements TEXT
+)"""
+
+SESSION_ENVIRONMENTS_DDL = """
+CREATE TABLE IF NOT EXISTS session_environments (
+    trace INTEGER NOT NULL,
+    session INTEGER NOT NULL,
+    env_id TEXT NOT NULL,
+    packages TEXT,
+    PRIMARY KEY (trace, session)
+)"""
+
+SOURCE_INDEX_TABLE = 'cell_execs_fts'
+
+# external-content fts5 table so that the index doesn't store a second copy of every source;
+# the trigram tokenizer lets fts5 answer (case-insensitive) LIKE '%...%' queries from the index
+SOURCE_INDEX_DDL = [
+    f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {SOURCE_INDEX_TABLE}
+USING fts5(source, content='cell_execs', content_rowid='rowid', tokenize='trigram')""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS {SOURCE_INDEX_TABLE}_insert AFTER INSERT ON cell_execs BEGIN
+    INSERT INTO {SOURCE_INDEX_TABLE}(rowid, source) VALUES (new.rowid, new.source);
+END""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS {SOURCE_INDEX_TABLE}_delete AFTER DELETE ON cell_execs BEGIN
+    INSERT INTO {SOURCE_INDEX_TABLE}({SOURCE_INDEX_TABLE}, rowid, source) VALUES ('delete', old.rowid, old.source);
+END""",
+    f"""
+CREATE TRIGGER IF NOT EXISTS {SOURCE_INDEX_TABLE}_update AFTER UPDATE ON cell_execs BEGIN
+    INSERT INTO {SOURCE_INDEX_TABLE}({SOURCE_INDEX_TABLE}, rowid, source) VALUES ('delete', old.rowid, old.source);
+    INSERT INTO {SOURCE_INDEX_TABLE}(rowid, source) VALUES (new.rowid, new.source);
+END""",
+]
+
+# cache.sqlite
+
+SOURCE_CACHE_DDL = """
+CREATE TABLE IF NOT EXISTS source_cache (
+    namespace TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (namespace, version, key)
+)"""
+
+IMPORT_RESOLUTIONS_DDL = """
+CREATE TABLE IF NOT EXISTS import_resolutions (
+    env_fingerprint TEXT NOT NULL,
+    import_stmt TEXT NOT NULL,
+    libname TEXT NOT NULL,
+    package TEXT,
+    version TEXT,
+    PRIMARY KEY (env_fingerprint, import_stmt)
+)"""
+
+# Indexes for the hot queries. (trace, session, counter) covers session selection
+# (GROUP BY trace, session HAVING max(counter) / count(*)) without touching the sources, and
+# turns loading a session's cells in order into a range scan. replay_stats is looked up by
+# version (--skip-already-replayed; hand-made tables may lack the primary key) and by session
+# (replay history for the cost model).
+INDEX_DDL = [
+    'CREATE INDEX IF NOT EXISTS cell_execs_trace_session_counter ON cell_execs(trace, session, counter)',
+    'CREATE INDEX IF NOT EXISTS replay_stats_version_trace_session ON replay_stats(version, trace, session)',
+    'CREATE INDEX IF NOT EXISTS replay_stats_trace_session_wall_time ON replay_stats(trace, session, wall_time)',
+    'CREATE INDEX IF NOT EXISTS replay_exception_stats_trace_session ON replay_exception_stats(trace, session)',
+]
+
+# everything keyed by (trace, session) that was derived from a trace's cells; stale once the cells change
+TRACE_DERIVED_TABLES = [
+    'bad_sessions',
+    'replay_stats',
+    'replay_exception_stats',
+    'replay_resource_stats',
+    'replay_cell_stats',
+    'preprocessed_sessions',
+    'replay_queue',
+    'session_environments',
+]
+
+TRACES_DB_TABLES_DDL = [
+    CELL_EXECS_DDL,
+    BAD_SESSIONS_DDL,
+    REPLAY_STATS_DDL,
+    REPLAY_EXCEPTION_STATS_DDL,
+    RESOURCE_STATS_DDL,
+    CELL_STATS_DDL,
+    PREPROCESSED_SESSIONS_DDL,
+    QUEUE_DDL,
+    ENVIRONMENTS_DDL,
+    SESSION_ENVIRONMENTS_DDL,
+]
+
+
+def ensure_replay_stats_columns(conn):
+    existing_columns = {row[1] for row in conn.execute('PRAGMA table_info(replay_stats)')}
+    if len(existing_columns) == 0:
+        return
+    for column, column_type in REPLAY_STATS_ADDED_COLUMNS.items():
+        if column not in existing_columns:
+            conn.execute(f'ALTER TABLE replay_stats ADD COLUMN {column} {column_type}')
+
+
+def ensure_session_environments_columns(conn):
+    # packages (the session's own requirements, json) came after the table did
+    existing_columns = {row[1] for row in conn.execute('PRAGMA table_info(session_environments)')}
+    if len(existing_columns) > 0 and 'packages' not in existing_columns:
+        conn.execute('ALTER TABLE session_environments ADD COLUMN packages TEXT')
+
+
+def _create_tables(conn):
+    for ddl in TRACES_DB_TABLES_DDL:
+        conn.execute(ddl)
+    ensure_replay_stats_columns(conn)
+
+
+def _create_indexes(conn):
+    for ddl in INDEX_DDL:
+        conn.execute(ddl)
+    # sampled statistics are plenty for the planner, and a full ANALYZE reads every index
+    conn.execute('PRAGMA analysis_limit = 1000')
+    conn.execute('ANALYZE')
+
+
+def _create_traces(conn):
+    conn.execute(TRACES_DDL)
+    # backfill traces ingested before the table existed (their urls are lost); this is one pass
+    # over the cell_execs(trace, session, counter) index
+    conn.execute(
+        'INSERT OR IGNORE INTO traces(trace, num_cells) SELECT trace, count(*) FROM cell_execs GROUP BY trace'
+    )
+
+
+def _create_ingest_manifest(conn):
+    conn.execute(INGEST_MANIFEST_DDL)
+    conn.execute('CREATE INDEX IF NOT EXISTS ingest_manifest_content_hash ON ingest_manifest(content_hash)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ingest_manifest_trace ON ingest_manifest(trace)')
+    # traces ingested before the manifest existed; their hashes are unknown until rechecked
+    conn.execute("""
+INSERT OR IGNORE INTO ingest_manifest(url, trace, ingested_at)
+SELECT url, trace, ingested_at FROM traces WHERE url IS NOT NULL""")
+
+
+def _add_session_environment_packages(conn):
+    ensure_session_environments_columns(conn)
+
+
+def _add_cell_execs_primary_key(conn):
+    # rebuilds cell_execs around an INTEGER PRIMARY KEY, keeping every row's rowid so that an
+    # existing source index stays valid. This copies the table once, as a VACUUM would
+    if any(pk for _, _, _, _, _, pk in conn.execute('PRAGMA table_info(cell_execs)')):
+        return
+    # the old table's index and source index triggers go along with it
+    conn.execute('ALTER TABLE cell_execs RENAME TO cell_execs_without_id')
+    conn.execute(CELL_EXECS_DDL)
+    conn.execute("""
+INSERT INTO cell_execs(id, trace, session, counter, source)
+SELECT rowid, trace, session, counter, source FROM cell_execs_without_id ORDER BY rowid""")
+    conn.execute('DROP TABLE cell_execs_without_id')
+    for ddl in INDEX_DDL:
+        if ' ON cell_execs(' in ddl:
+            conn.execute(ddl)
+    has_source_index = conn.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (SOURCE_INDEX_TABLE,)
+    ).fetchone()[0] > 0
+    if has_source_index:
+        for ddl in SOURCE_INDEX_DDL:
+            if ddl.strip().startswith('CREATE TRIGGER'):
+                conn.execute(ddl)
+    conn.execute('ANALYZE cell_execs')
+
+
+# applied in order, each in its own transaction; never edit one that has shipped, add another
+MIGRATIONS = [
+    _create_tables,
+    _create_indexes,
+    _create_traces,
+    _create_ingest_manifest,
+    _add_session_environment_packages,
+    _add_cell_execs_primary_key,
+]
+
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def enable_wal(conn):
+    # persistent for the database file: readers stop blocking the writer and vice versa
+    mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+    if mode.lower() != 'wal':
+        logger.warning('unable to switch to WAL mode; journal mode is %s', mode)
+    return mode
+
+
+def migrate(conn):
+    # brings the database up to the latest schema version; returns the number of migrations run.
+    # conn must be in autocommit mode (isolation_level=None), since this manages transactions
+    enable_wal(conn)
+    schema_version = get_schema_version(conn)
+    for idx in range(schema_version, len(MIGRATIONS)):
+        start_time = timer()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            MIGRATIONS[idx](conn)
+            conn.execute(f'PRAGMA user_version = {idx + 1}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        logger.info('applied migration %d (%s) in %.1fs', idx + 1, MIGRATIONS[idx].__name__, timer() - start_time)
+    return max(len(MIGRATIONS) - schema_version, 0)
+
+
+BENCHMARK_QUERIES = {
+    'session_selection': """
+SELECT trace, session FROM cell_execs GROUP BY trace, session HAVING max(counter) >= :min_cells""",
+    'session_sources': """
+SELECT source FROM cell_execs WHERE trace = :trace AND session = :session ORDER BY counter ASC""",
+    'already_replayed': """
+SELECT trace, session FROM replay_stats WHERE version = :version""",
+    'replay_history': """
+SELECT trace, session, avg(wall_time) FROM replay_stats WHERE wall_time IS NOT NULL GROUP BY trace, session""",
+}
+
+
+def benchmark_queries(conn, params, repeat=3):
+    # best of `repeat` wall times per query, along with how sqlite plans to run it
+    results = {}
+    for name, sql in BENCHMARK_QUERIES.items():
+        try:
+            plan = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        except sqlite3.OperationalError as e:
+            logger.warning('skipping benchmark query %s: %s', name, e)
+            continue
+        best = None
+        for _ in range(repeat):
+            start_time = timer()
+            conn.execute(sql, params).fetchall()
+            elapsed = timer() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = (best, plan)
+    return results
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import collections
+import functools
+import hashlib
+import mmap
+import os
+import pathlib
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+DEFAULT_SESSION_PACK = './data/sessions.pack'
+
+# A pack is one file laid out so that every table can be used in place through np.frombuffer
+# on an mmap of it:
+#
+#   header       MAGIC, then the offset and length of each section below
+#   zdict        preset zlib dictionary shared by every body (common cells seed it)
+#   blobs        BLOB_DTYPE per unique cell body: where its compressed bytes are and how long
+#   hashes       sha1 of each body (in blob order), so bodies are content addressed
+#   sessions     SESSION_DTYPE per session, sorted by key = trace << 32 | session
+#   cells        CELL_DTYPE per cell execution; a session is cells[start:start + count]
+#   data         the compressed bodies, back to back
+#
+# Every body is stored once no matter how many sessions (or forks of the same repository)
+# execute it, and is compressed on its own so that reading a session only inflates its cells.
+MAGIC = b'NBSPACK1'
+SECTIONS = ['zdict', 'blobs', 'hashes', 'sessions', 'cells', 'data']
+HEADER_STRUCT = struct.Struct('<8s' + 'QQ' * len(SECTIONS))
+BLOB_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('raw_length', '<u4')])
+HASH_DTYPE = np.dtype('S20')
+SESSION_DTYPE = np.dtype([('key', '<i8'), ('start', '<u8'), ('count', '<u8')])
+CELL_DTYPE = np.dtype([('counter', '<i4'), ('blob', '<u4')])
+
+# small on purpose: zlib has to load the dictionary again for every body it inflates
+ZDICT_MAX_BYTES = 4 * 1024
+# rows buffered up front to pick the preset dictionary from
+ZDICT_SAMPLE_ROWS = 100000
+COMPRESSION_LEVEL = 9
+
+
+def session_key(trace, session):
+    return (int(trace) << 32) | int(session)
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def make_zdict(sources, max_bytes=ZDICT_MAX_BYTES):
+    # zlib looks for matches closest to the end of the dictionary first, so the most common
+    # bodies go last
+    counts = collections.Counter(source for source in sources if len(source) > 0)
+    picked = []
+    total = 0
+    for source, count in counts.most_common():
+        encoded = source.encode('utf-8', 'surrogatepass')
+        if count < 2 or total + len(encoded) > max_bytes:
+            continue
+        picked.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(picked))
+
+
+class SessionPackWriter(object):
+    # add rows in (trace, session, counter) order, then finish(); bodies stream to a temp file
+    # as they're first seen, so memory stays proportional to the number of unique bodies
+    def __init__(self, path, zdict=b''):
+        self.path = pathlib.Path(path)
+        self.zdict = zdict
+        self.num_rows = 0
+        self.raw_bytes = 0
+        self._blob_ids = {}
+        self._blobs = []
+        self._hashes = []
+        self._sessions = []
+        self._counters = []
+        self._cell_blobs = []
+        self._data = tempfile.TemporaryFile(dir=self.path.parent)
+        self._data_length = 0
+        self._last_key = None
+
+    def _add_blob(self, source):
+        encoded = source.encode('utf-8', 'surrogatepass')
+        digest = hashlib.sha1(encoded).digest()
+        blob_id = self._blob_ids.get(digest)
+        if blob_id is not None:
+            return blob_id
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=self.zdict)
+        compressed = compressor.compress(encoded) + compressor.flush()
+        blob_id = len(self._blobs)
+        self._blob_ids[digest] = blob_id
+        self._blobs.append((self._data_length, len(compressed), len(encoded)))
+        self._hashes.append(digest)
+        self._data.write(compressed)
+        self._data_length += len(compressed)
+        return blob_id
+
+    def add(self, trace, session, counter, source):
+        source = source or ''
+        key = session_key(trace, session)
+        if key != self._last_key:
+            if self._last_key is not None and key < self._last_key:
+                raise ValueError('rows must be added in (trace, session, counter) order')
+            self._sessions.append([key, len(self._counters), 0])
+            self._last_key = key
+        self._sessions[-1][2] += 1
+        self._counters.append(counter)
+        self._cell_blobs.append(self._add_blob(source))
+        self.num_rows += 1
+        self.raw_bytes += len(source)
+
+    def finish(self):
+        blobs = np.array(self._blobs, dtype=BLOB_DTYPE) if self._blobs else np.zeros(0, dtype=BLOB_DTYPE)
+        hashes = np.array(self._hashes, dtype=HASH_DTYPE)
+        sessions = np.zeros(len(self._sessions), dtype=SESSION_DTYPE)
+        if len(self._sessions) > 0:
+            sessions['key'], sessions['start'], sessions['count'] = zip(*self._sessions)
+        cells = np.zeros(len(self._counters), dtype=CELL_DTYPE)
+        cells['counter'] = self._counters
+        cells['blob'] = self._cell_blobs
+        sections = [self.zdict, blobs.tobytes(), hashes.tobytes(), sessions.tobytes(), cells.tobytes()]
+        # write to a temp name and rename, so readers never see half a pack
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            offset = _align(HEADER_STRUCT.size)
+            layout = []
+            for section in sections:
+                layout.append((offset, len(section)))
+                offset = _align(offset + len(section))
+            layout.append((offset, self._data_length))
+            f.write(HEADER_STRUCT.pack(MAGIC, *[value for entry in layout for value in entry]))
+            for (section_offset, _), section in zip(layout, sections):
+                f.seek(section_offset)
+                f.write(section)
+            f.seek(layout[-1][0])
+            self._data.seek(0)
+            shutil.copyfileobj(self._data, f)
+        self._data.close()
+        os.replace(tmp_path, self.path)
+        return dict(
+            num_rows=self.num_rows,
+            num_sessions=len(sessions),
+            num_unique_bodies=len(blobs),
+            raw_bytes=self.raw_bytes,
+            pack_bytes=self.path.stat().st_size,
+        )
+
+
+def build_session_pack(rows, path, zdict_bytes=ZDICT_MAX_BYTES):
+    # rows are (trace, session, counter, source) in that order, e.g. straight from cell_execs
+    rows = iter(rows)
+    sample = []
+    for row in rows:
+        sample.append(row)
+        if len(sample) >= ZDICT_SAMPLE_ROWS:
+            break
+    writer = SessionPackWriter(path, zdict=make_zdict((row[3] or '' for row in sample), max_bytes=zdict_bytes))
+    for row in sample:
+        writer.add(*row)
+    for row in rows:
+        writer.add(*row)
+    return writer.finish()
+
+
+class SessionPack(object):
+    def __init__(self, path, cache_size=4096):
+        self.path = pathlib.Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if header[0] != MAGIC:
+            raise ValueError(f'{self.path} is not a session pack')
+        layout = dict(zip(SECTIONS, zip(header[1::2], header[2::2])))
+        self._data_offset = layout['data'][0]
+        zdict_offset, zdict_length = layout['zdict']
+        self.zdict = self._mmap[zdict_offset:zdict_offset + zdict_length]
+        self.blobs = self._view(layout['blobs'], BLOB_DTYPE)
+        self.hashes = self._view(layout['hashes'], HASH_DTYPE)
+        self.sessions = self._view(layout['sessions'], SESSION_DTYPE)
+        self.cells = self._view(layout['cells'], CELL_DTYPE)
+        self.get_source = functools.lru_cache(maxsize=cache_size)(self._get_source)
+
+    def _view(self, section, dtype):
+        offset, length = section
+        return np.frombuffer(self._mmap, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+    def close(self):
+        self.get_source.cache_clear()
+        # views into the mmap have to go before it can be closed
+        self.blobs = self.hashes = self.sessions = self.cells = None
+        self._mmap.close()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, trace_session):
+        return self._find(*trace_session) is not None
+
+    def session_keys(self):
+        keys = self.sessions['key']
+        return list(zip((keys >> 32).tolist(), (keys & 0xffffffff).tolist()))
+
+    def _find(self, trace, session):
+        key = session_key(trace, session)
+        idx = int(np.searchsorted(self.sessions['key'], key))
+        if idx == len(self.sessions) or self.sessions['key'][idx] != key:
+            return None
+        return idx
+
+    def get_session_cells(self, trace, session):
+        # zero-copy CELL_DTYPE slice (counter, blob id) of the session, in counter order
+        idx = self._find(trace, session)
+        if idx is None:
+            return self.cells[:0]
+        start, count = int(self.sessions['start'][idx]), int(self.sessions['count'][idx])
+        return self.cells[start:start + count]
+
+    def _get_source(self, blob_id):
+        offset, length, _ = self.blobs[blob_id].tolist()
+        start = self._data_offset + offset
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        return decompressor.decompress(self._mmap[start:start + length]).decode('utf-8', 'surrogatepass')
+
+    def get_session(self, trace, session):
+        # [(counter, source)] like SELECT counter, source FROM cell_execs ... ORDER BY counter
+        cells = self.get_session_cells(trace, session)
+        return [
+            (counter, self.get_source(blob)) for counter, blob in zip(cells['counter'].tolist(), cells['blob'].tolist())
+        ]
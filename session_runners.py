@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import pathlib
+import select
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+REPLAY_SCRIPT = pathlib.Path(__file__).resolve().parent.joinpath('replay-session.py')
+
+
+def make_replay_command(python=None):
+    # replay-session.py is an ipython script; in another environment it has to go through that
+    # environment's interpreter rather than the shebang
+    if python is None:
+        return str(REPLAY_SCRIPT)
+    return f'{python} -m IPython {REPLAY_SCRIPT}'
+
+
+class SessionRunner(object):
+    def __init__(self, worker_dir=None, python=None):
+        self.worker_dir = worker_dir
+        self.python = python
+
+    def run(self, session_args, heartbeat, heartbeat_seconds):
+        # returns the session's return code along with a dict of whatever else the runner knows
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SubprocessSessionRunner(SessionRunner):
+    def run(self, session_args, heartbeat, heartbeat_seconds):
+        proc = subprocess.Popen(f'{make_replay_command(self.python)} -- {session_args}', shell=True, cwd=self.worker_dir)
+        while True:
+            try:
+                return proc.wait(timeout=heartbeat_seconds), {}
+            except subprocess.TimeoutExpired:
+                heartbeat()
+
+
+class ForkServerSessionRunner(SessionRunner):
+    def __init__(self, worker_dir=None, python=None, server_args=''):
+        super().__init__(worker_dir=worker_dir, python=python)
+        self.server_args = server_args
+        self._server = None
+
+    def _ensure_server(self):
+        if self._server is not None and self._server.poll() is None:
+            return self._server
+        if self._server is not None:
+            logger.warning('fork server in %s exited with code %d; restarting', self.worker_dir, self._server.returncode)
+        self._server = subprocess.Popen(
+            f'{make_replay_command(self.python)} -- --fork-server {self.server_args}',
+            shell=True, cwd=self.worker_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+        )
+        return self._server
+
+    def run(self, session_args, heartbeat, heartbeat_seconds):
+        server = self._ensure_server()
+        server.stdin.write(session_args + '\n')
+        server.stdin.flush()
+        while True:
+            readable, _, _ = select.select([server.stdout], [], [], heartbeat_seconds)
+            if len(readable) > 0:
+                break
+            heartbeat()
+        line = server.stdout.readline()
+        if line == '':
+            server.wait()
+            return 1, {'error': f'fork server exited with code {server.returncode}'}
+        result = json.loads(line)
+        return result['ret'], result
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.stdin.close()
+        self._server.wait()
+        self._server = None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import sqlite3
+
+from schema import SOURCE_CACHE_DDL
+
+logger = logging.getLogger(__name__)
+
+SOURCE_CACHE_DB = './data/cache.sqlite'
+
+
+def source_hash(source):
+    return hashlib.sha1(source.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class SourceCache(object):
+    # content-addressed cache of source -> derived source, kept in memory for the current process
+    # and in a sqlite db shared across sessions; bumping `version` orphans older entries. The
+    # persistent side is best-effort: if the db is unavailable we just recompute.
+    def __init__(self, namespace, version, db_path=SOURCE_CACHE_DB):
+        self.namespace = namespace
+        self.version = version
+        self.db_path = db_path
+        self._memo = {}
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_conn(self):
+        if self._conn is None and self.db_path is not None:
+            try:
+                self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+                self._conn.execute('PRAGMA journal_mode = WAL')
+                self._conn.execute(SOURCE_CACHE_DDL)
+            except sqlite3.Error as e:
+                logger.warning('unable to open source cache at %s: %s', self.db_path, e)
+                self.db_path = None
+                self._conn = None
+        return self._conn
+
+    def get(self, source):
+        key = source_hash(source)
+        if key in self._memo:
+            return self._memo[key]
+        conn = self._get_conn()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute(
+                'SELECT value FROM source_cache WHERE namespace = ? AND version = ? AND key = ?',
+                (self.namespace, self.version, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning('source cache lookup failed: %s', e)
+            return None
+        if row is None:
+            return None
+        self._memo[key] = row[0]
+        return row[0]
+
+    def put(self, source, value):
+        key = source_hash(source)
+        self._memo[key] = value
+        conn = self._get_conn()
+        if conn is None:
+            return
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO source_cache(namespace, version, key, value) VALUES (?, ?, ?, ?)',
+                (self.namespace, self.version, key, value)
+            )
+        except sqlite3.Error as e:
+            logger.warning('source cache write failed: %s', e)
+
+    def get_or_compute(self, source, compute):
+        value = self.get(source)
+        if value is None:
+            self.misses += 1
+            value = compute(source)
+            if value is not None:
+                self.put(source, value)
+        else:
+            self.hits += 1
+        return value
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+
+from schema import SOURCE_INDEX_DDL, SOURCE_INDEX_TABLE
+
+logger = logging.getLogger(__name__)
+
+
+def has_source_index(conn):
+    return conn.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (SOURCE_INDEX_TABLE,)
+    ).fetchone()[0] > 0
+
+
+def ensure_source_index(conn):
+    if has_source_index(conn):
+        return True
+    logger.info('building trigram index over cell_execs.source; this only happens once...')
+    try:
+        with conn:
+            for ddl in SOURCE_INDEX_DDL:
+                conn.execute(ddl)
+            conn.execute(f"INSERT INTO {SOURCE_INDEX_TABLE}({SOURCE_INDEX_TABLE}) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        # e.g. sqlite built without fts5, or too old for the trigram tokenizer
+        logger.warning('unable to build source index (%s); falling back to scanning cell_execs', e)
+        return False
+    logger.info('done building source index')
+    return True
+
+
+def format_sessions_matching_any(patterns, use_index=True):
+    # returns sql + params selecting distinct (trace, session) pairs having some cell whose source
+    # is LIKE any of `patterns`; without the index we at least do one scan instead of one per pattern
+    patterns = list(patterns)
+    if use_index:
+        rowid_queries = '\n        UNION\n'.join(
+            f'        SELECT rowid FROM {SOURCE_INDEX_TABLE} WHERE source LIKE ?' for _ in patterns
+        )
+        sql = f"""
+SELECT DISTINCT trace, session
+FROM cell_execs
+WHERE rowid IN (
+{rowid_queries}
+)"""
+    else:
+        sql = f"""
+SELECT DISTINCT trace, session
+FROM cell_execs
+WHERE {' OR '.join('source LIKE ?' for _ in patterns)}"""
+    return sql.strip(), patterns
@@ -1,27 +1,176 @@
 # -*- coding: utf-8 -*-
-# adapted from SO
-from functools import wraps
+import contextlib
+import ctypes
+import logging
+import os
 import signal
+import threading
+from timeit import default_timer as timer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CELL_SECONDS = 15.
+# only used for adaptive budgets
+DEFAULT_MIN_CELL_SECONDS = 5.
+DEFAULT_CELL_RUNTIME_MULTIPLIER = 10.
+DEFAULT_GRACE_SECONDS = 5.
+TIMEOUT_EXIT_CODE = 4
 
 
 class TimeoutException(Exception):
     pass
 
 
-def timeout(seconds=10):
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutException()
+def _set_async_exc(thread_id, exc_type):
+    # raises exc_type in the given thread the next time it runs python bytecode; None clears
+    # anything that hasn't been delivered yet
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id), None if exc_type is None else ctypes.py_object(exc_type)
+    )
+
+
+class TimeoutEngine(object):
+    # Enforces a wall clock budget per cell from a watchdog thread rather than with SIGALRM, so it
+    # has sub-second resolution and works for cells run off the main thread. Once a cell is over
+    # budget, the watchdog escalates:
+    #   1. raise TimeoutException in the cell's thread (lands at the next bytecode boundary),
+    #   2. after `grace_seconds`, if the cell runs on the main thread, signal it so that blocking
+    #      syscalls (sleep, socket reads, ...) return early and the exception can land,
+    #   3. after another `grace_seconds`, give up on the process: call `on_stuck` and exit with
+    #      TIMEOUT_EXIT_CODE, since code stuck in C can't be interrupted any other way.
+    # Each cell gets `cell_seconds`, or with `adaptive`, `runtime_multiplier` times the longest
+    # runtime seen so far, clamped to [min_cell_seconds, cell_seconds]; either way no more than
+    # whatever is left of the session budget.
+    def __init__(
+        self,
+        cell_seconds=DEFAULT_CELL_SECONDS,
+        adaptive=False,
+        min_cell_seconds=DEFAULT_MIN_CELL_SECONDS,
+        runtime_multiplier=DEFAULT_CELL_RUNTIME_MULTIPLIER,
+        session_seconds=None,
+        grace_seconds=DEFAULT_GRACE_SECONDS,
+        on_stuck=None,
+    ):
+        self.cell_seconds = cell_seconds
+        self.adaptive = adaptive
+        self.min_cell_seconds = min(min_cell_seconds, cell_seconds)
+        self.runtime_multiplier = runtime_multiplier
+        self.session_seconds = session_seconds
+        self.grace_seconds = grace_seconds
+        self.on_stuck = on_stuck
+        self.session_start_time = timer()
+        self.max_cell_runtime = 0.
+        self.num_timeouts = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread_id = None
+        self._deadline = None
+        self._fired_at = None
+        self._signaled = False
+        self._closed = False
+        self._can_signal = threading.current_thread() is threading.main_thread()
+        if self._can_signal:
+            signal.signal(signal.SIGALRM, self._handle_signal)
+        self._watchdog = threading.Thread(target=self._watch, name='timeout-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def session_time_left(self):
+        if self.session_seconds is None:
+            return None
+        return self.session_seconds - (timer() - self.session_start_time)
 
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
+    def session_budget_exceeded(self):
+        time_left = self.session_time_left()
+        return time_left is not None and time_left <= 0
+
+    def cell_budget(self):
+        budget = self.cell_seconds
+        if self.adaptive:
+            budget = min(budget, max(self.min_cell_seconds, self.runtime_multiplier * self.max_cell_runtime))
+        time_left = self.session_time_left()
+        if time_left is not None:
+            budget = min(budget, max(time_left, 0.))
+        return budget
+
+    @contextlib.contextmanager
+    def cell(self):
+        budget = self.cell_budget()
+        start_time = timer()
+        with self._lock:
+            self._thread_id = threading.get_ident()
+            self._deadline = start_time + budget
+            self._fired_at = None
+            self._signaled = False
+            self._wakeup.notify()
+        fired = False
+        try:
+            yield budget
+        except TimeoutException:
+            # only reaches here if it landed outside whatever try / except the cell has of its own
+            pass
+        finally:
+            # The TimeoutException, and the SIGALRM sent after it, can also land in here until the
+            # deadline is cleared. Each lands at most once per cell, and python only delivers them
+            # at calls and loops, so nesting the calls to _disarm three deep always gets through.
             try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
+                fired = self._disarm()
+            except TimeoutException:
+                try:
+                    fired = self._disarm()
+                except TimeoutException:
+                    fired = self._disarm()
+            runtime = timer() - start_time
+            if fired:
+                self.num_timeouts += 1
+                logger.warning('cell timed out after %.2fs (budget %.2fs)', runtime, budget)
+            else:
+                self.max_cell_runtime = max(self.max_cell_runtime, runtime)
+
+    def _disarm(self):
+        # once the deadline is cleared the watchdog leaves the cell alone, and clearing any
+        # exception it set that hasn't landed yet means none will
+        with self._lock:
+            self._deadline = None
+            _set_async_exc(self._thread_id, None)
+            return self._fired_at is not None
+
+    def _handle_signal(self, signum, frame):
+        # only ever sent by the watchdog while a timed out cell is running, but be careful anyway
+        if self._deadline is not None and self._fired_at is not None:
+            raise TimeoutException()
 
-        return wraps(func)(wrapper)
+    def _watch(self):
+        with self._lock:
+            while not self._closed:
+                if self._deadline is None:
+                    self._wakeup.wait()
+                    continue
+                now = timer()
+                if self._fired_at is None:
+                    if now < self._deadline:
+                        self._wakeup.wait(self._deadline - now)
+                        continue
+                    self._fired_at = now
+                    _set_async_exc(self._thread_id, TimeoutException)
+                elif now - self._fired_at >= 2 * self.grace_seconds:
+                    logger.error('cell still running %.1fs after timing out; killing session', now - self._fired_at)
+                    try:
+                        if self.on_stuck is not None:
+                            self.on_stuck()
+                    finally:
+                        logging.shutdown()
+                        os._exit(TIMEOUT_EXIT_CODE)
+                elif now - self._fired_at >= self.grace_seconds and not self._signaled:
+                    self._signaled = True
+                    if self._can_signal and self._thread_id == threading.main_thread().ident:
+                        signal.pthread_kill(self._thread_id, signal.SIGALRM)
+                self._wakeup.wait(self.grace_seconds / 4)
 
-    return decorator
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._deadline = None
+            self._wakeup.notify()
+        self._watchdog.join()
+        if self._can_signal:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
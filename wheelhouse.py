@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import logging
+import pathlib
+import subprocess
+
+from environments import IGNORED_IMPORTS
+from resolvers import PACKAGES_BY_IMPORT, PIP_INSTALL_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WHEELHOUSE = './data/wheelhouse'
+
+
+def get_wheelhouse_pip_args(wheelhouse):
+    # absolute, since replays run from per-worker directories
+    return f'--no-index --find-links {pathlib.Path(wheelhouse).resolve()}'
+
+
+def get_corpus_requirements(imports_by_session):
+    # every package imported anywhere in the corpus, plus each version PipResolver might try
+    # for the packages in PACKAGES_BY_IMPORT that it pins
+    import_names = set()
+    for imports in imports_by_session.values():
+        for _, pkg_names in imports:
+            import_names.update(pkg_names)
+    requirements = set()
+    for import_name in import_names - IGNORED_IMPORTS:
+        requirements.add(PACKAGES_BY_IMPORT.get(import_name, {'package': import_name})['package'])
+    for package in PACKAGES_BY_IMPORT.values():
+        requirements.add(package['package'])
+        requirements.update(f'{package["package"]}=={version}' for version in package.get('versions', []))
+    return sorted(requirements)
+
+
+def add_to_wheelhouse(wheelhouse, requirement, pip_args=''):
+    # `pip wheel` rather than `pip download` so that sdists are built once here instead of at
+    # every install, and so that dependencies land in the wheelhouse too
+    try:
+        with open('/dev/null', 'w') as devnull:
+            subprocess.check_call(
+                f'pip wheel --wheel-dir {wheelhouse} {pip_args} {requirement}',
+                shell=True, stdout=devnull, stderr=subprocess.STDOUT, timeout=PIP_INSTALL_TIMEOUT_SECONDS
+            )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logger.warning('unable to add %s to wheelhouse: %s', requirement, e)
+        return False
+    return True
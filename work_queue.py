@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from schema import QUEUE_DDL
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+COMPLETE_SQL = """
+UPDATE replay_queue SET state = 'done', lease_owner = NULL, lease_expires = NULL, last_error = NULL, updated = ?
+WHERE version = ? AND trace = ? AND session = ?"""
+
+
+def complete_sessions(conn, rows):
+    # rows are (version, trace, session); for callers that mark sessions done inside a transaction
+    # of their own, e.g. the one that commits their results
+    now = time.time()
+    conn.executemany(COMPLETE_SQL, [(now, version, trace, session) for version, trace, session in rows])
+
+
+def make_lease_owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def _is_dead_local_owner(owner):
+    try:
+        hostname, pid, _ = owner.split(':')
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if hostname != socket.gethostname() or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class WorkQueue(object):
+    # sessions are leased rather than popped so that whatever was in flight when a sweep died
+    # goes back to pending once its lease expires; attempts are counted at lease time so that
+    # sessions that take the whole sweep down with them also end up quarantined
+    def __init__(self, db_path, version, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.version = version
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute(QUEUE_DDL)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, sql, params=(), many=False):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if many:
+                    cursor = self._conn.executemany(sql, params)
+                else:
+                    cursor = self._conn.execute(sql, params)
+                rows = cursor.fetchall()
+                rowcount = cursor.rowcount
+                self._conn.execute('COMMIT')
+            except:  # noqa
+                self._conn.execute('ROLLBACK')
+                raise
+        return rows, rowcount
+
+    def enqueue(self, sessions, priorities=None):
+        now = time.time()
+        rows = []
+        for trace, session in sessions:
+            priority = 0. if priorities is None else priorities.get((trace, session), 0.)
+            rows.append((self.version, trace, session, priority, now))
+        # re-enqueueing refreshes the priority of sessions that haven't been picked up yet
+        _, rowcount = self._transaction("""
+INSERT INTO replay_queue(version, trace, session, priority, updated)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (version, trace, session) DO UPDATE SET priority = excluded.priority
+WHERE state = 'pending'""", rows, many=True)
+        return rowcount
+
+    def reset(self, states=None):
+        if states is None:
+            _, rowcount = self._transaction('DELETE FROM replay_queue WHERE version = ?', (self.version,))
+        else:
+            _, rowcount = self._transaction(f"""
+UPDATE replay_queue SET state = 'pending', attempts = 0, last_error = NULL, updated = ?
+WHERE version = ? AND state IN ({','.join('?' for _ in states)})""", (time.time(), self.version, *states))
+        return rowcount
+
+    def reclaim_expired_leases(self):
+        # leases held by schedulers on this host that are no longer running get reclaimed
+        # right away; everything else has to wait for its lease to run out
+        now = time.time()
+        with self._lock:
+            leases = self._conn.execute(
+                "SELECT trace, session, lease_owner, lease_expires FROM replay_queue WHERE version = ? AND state = 'leased'",
+                (self.version,)
+            ).fetchall()
+        to_reclaim = [
+            (self.max_attempts, now, self.version, trace, session)
+            for trace, session, owner, lease_expires in leases
+            if lease_expires < now or _is_dead_local_owner(owner)
+        ]
+        if len(to_reclaim) == 0:
+            return 0
+        _, rowcount = self._transaction("""
+UPDATE replay_queue
+SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+    last_error = 'lease expired', lease_owner = NULL, lease_expires = NULL, updated = ?
+WHERE version = ? AND trace = ? AND session = ? AND state = 'leased'""", to_reclaim, many=True)
+        if rowcount > 0:
+            logger.warning('reclaimed %d session(s) with expired leases', rowcount)
+        return rowcount
+
+    def lease(self, owner):
+        now = time.time()
+        rows, _ = self._transaction("""
+UPDATE replay_queue
+SET state = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, heartbeat = ?, updated = ?
+WHERE rowid = (
+    SELECT rowid FROM replay_queue
+    WHERE version = ? AND state = 'pending'
+    ORDER BY priority DESC, trace, session
+    LIMIT 1
+)
+RETURNING trace, session, attempts""", (owner, now + self.lease_seconds, now, now, self.version))
+        return rows[0] if len(rows) > 0 else None
+
+    def heartbeat(self, trace, session, owner):
+        now = time.time()
+        _, rowcount = self._transaction("""
+UPDATE replay_queue SET lease_expires = ?, heartbeat = ?
+WHERE version = ? AND trace = ? AND session = ? AND state = 'leased' AND lease_owner = ?""",
+            (now + self.lease_seconds, now, self.version, trace, session, owner))
+        return rowcount > 0
+
+    def complete(self, trace, session):
+        self._transaction(COMPLETE_SQL, (time.time(), self.version, trace, session))
+
+    def fail(self, trace, session, error):
+        rows, _ = self._transaction("""
+UPDATE replay_queue
+SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+    lease_owner = NULL, lease_expires = NULL, last_error = ?, updated = ?
+WHERE version = ? AND trace = ? AND session = ?
+RETURNING state, attempts""", (self.max_attempts, error, time.time(), self.version, trace, session))
+        if len(rows) > 0 and rows[0][0] == FAILED:
+            logger.error(
+                'quarantining trace %d session %d after %d failed attempts (%s)', trace, session, rows[0][1], error
+            )
+
+    def pending_sessions(self):
+        with self._lock:
+            return self._conn.execute("""
+SELECT trace, session, priority FROM replay_queue
+WHERE version = ? AND state = 'pending'
+ORDER BY priority DESC, trace, session""", (self.version,)).fetchall()
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT state, count(*) FROM replay_queue WHERE version = ? GROUP BY state', (self.version,)
+            ).fetchall()
+        return dict(rows)